@@ -0,0 +1,48 @@
+"""Time the check of a record against a config of 10 fields, one of each type.
+
+Run it from api/, before and after a change of config.py to compare them:
+
+> python benchmarks/config_check.py
+"""
+import argparse
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from config import Config
+
+CONFIG = {
+    "firstname": {"type": "str", "required": True, "primary_key": True},
+    "lastname": {"type": "str"},
+    "age": {"type": "integer"},
+    "email": {"type": "email"},
+    "website": {"type": "url"},
+    "bio": {"type": "long_str"},
+    "tags": {"type": "list", "additional_type_parameters": {"inner_type": "str"}},
+    "jedi": {"type": "toggle"},
+    "photo": {"type": "image", "additional_type_parameters": {"accepted_types": ["png", "jpg", "jpeg", "gif"]}},
+    "side": {"type": "select", "additional_type_parameters": {"allowed_values": ["light", "dark", "grey"]}},
+}
+RECORD = {
+    "firstname": "Luke",
+    "lastname": "Skywalker",
+    "age": 19,
+    "email": "luke@rebels.org",
+    "website": "http://x",
+    "bio": "Farm boy",
+    "tags": ["pilot", "jedi", "son"],
+    "jedi": True,
+    "photo": "abc.JPG",
+    "side": "light",
+}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--number", type=int, default=200000, help="Number of checks timed in a row")
+    parser.add_argument("--repeat", type=int, default=5, help="Number of times they are timed, the best one is kept")
+    args = parser.parse_args()
+    config = Config.from_dict(CONFIG)
+    best = min(timeit.repeat(lambda: config.check(RECORD, fields_to_skip=['id']), number=args.number, repeat=args.repeat))
+    print(f'{best / args.number * 1e6:.2f} us per record')
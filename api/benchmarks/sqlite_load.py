@@ -0,0 +1,111 @@
+"""Load test of the SQLite DB, with processes reading the contacts while others create some.
+
+Each process runs its own app, like the workers of gunicorn, against a new DB of 500 contacts in a
+temporary folder. Run it from api/, with the tuned settings of database.py, then with the defaults
+of SQLite to compare them:
+
+> python benchmarks/sqlite_load.py
+> python benchmarks/sqlite_load.py --sqlite-defaults
+"""
+import argparse
+from multiprocessing import Process, Queue
+import os
+import sys
+from tempfile import TemporaryDirectory
+import time
+
+API_FOLDER = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, API_FOLDER)
+
+# Settings of SQLite before it was tuned: rollback journal, full sync, default cache, and a new
+# connection for every checkout
+SQLITE_DEFAULTS = {
+    'SQLITE_JOURNAL_MODE': 'delete',
+    'SQLITE_SYNCHRONOUS': 'full',
+    'SQLITE_CACHE_SIZE': '-2000',
+    'SQLITE_MMAP_SIZE': '0',
+    'SQLITE_TEMP_STORE': 'default',
+    'DB_POOL_SIZE': '0',
+}
+CONFIG = '{"firstname": {"type": "str"}, "lastname": {"type": "str", "sort_key": 1}}'
+
+
+def _app_client(folder: str, sqlite_defaults: bool):
+    os.chdir(folder)
+    os.environ['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(folder, 'app.db')
+    os.environ['CONFIG_FILE'] = 'config.json'
+    os.environ['UPLOAD_FOLDER'] = os.path.join(folder, 'uploads')
+    # No background worker competing with the measured requests
+    os.environ['FILE_CLEANUP_INTERVAL'] = os.environ['CONFIG_MIGRATION_INTERVAL'] = '0'
+    if sqlite_defaults:
+        os.environ.update(SQLITE_DEFAULTS)
+    from main import create_app
+    return create_app().test_client()
+
+def _seed(folder: str, sqlite_defaults: bool, contacts: int) -> None:
+    client = _app_client(folder, sqlite_defaults)
+    for i in range(contacts):
+        client.post('/contact', json={"firstname": f"F{i}", "lastname": f"L{i}"})
+
+def _worker(folder: str, sqlite_defaults: bool, kind: str, start: float, duration: float, results: Queue) -> None:
+    client = _app_client(folder, sqlite_defaults)
+    done = errors = 0
+    latencies = []
+    time.sleep(max(0, start - time.time()))
+    while time.time() < start + duration:
+        started = time.perf_counter()
+        if kind == 'read':
+            resp = client.get('/contact?limit=50')
+        else:
+            resp = client.post('/contact', json={"firstname": "W", "lastname": "X"})
+        latencies.append(time.perf_counter() - started)
+        if resp.status_code == 200:
+            done += 1
+        else:
+            errors += 1
+    results.put((kind, done, errors, latencies))
+
+def run(readers: int, writers: int, duration: float, contacts: int, sqlite_defaults: bool) -> dict:
+    """Return by kind of request the number done per second, the number of errors and the 99th
+    percentile of their latencies in ms
+    """
+    with TemporaryDirectory() as folder:
+        with open(os.path.join(folder, 'config.json'), 'w') as file:
+            file.write(CONFIG)
+        seed = Process(target=_seed, args=(folder, sqlite_defaults, contacts))
+        seed.start()
+        seed.join()
+        results = Queue()
+        # Leave time to the processes to start their app before measuring
+        start = time.time() + 3
+        processes = [
+            Process(target=_worker, args=(folder, sqlite_defaults, kind, start, duration, results))
+            for kind in ['read'] * readers + ['write'] * writers
+        ]
+        for process in processes:
+            process.start()
+        rows = [results.get() for _ in processes]
+        for process in processes:
+            process.join()
+    report = {}
+    for kind in ('read', 'write'):
+        latencies = sorted(latency for row in rows if row[0] == kind for latency in row[3])
+        if latencies:
+            report[kind] = {
+                "per_second": sum(row[1] for row in rows if row[0] == kind) / duration,
+                "errors": sum(row[2] for row in rows if row[0] == kind),
+                "p99_ms": latencies[int(len(latencies) * 0.99)] * 1000,
+            }
+    return report
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--readers", type=int, default=4, help="Number of processes listing the contacts")
+    parser.add_argument("--writers", type=int, default=4, help="Number of processes creating contacts")
+    parser.add_argument("--duration", type=float, default=6, help="Seconds during which the requests are sent")
+    parser.add_argument("--contacts", type=int, default=500, help="Number of contacts in the DB at the start")
+    parser.add_argument("--sqlite-defaults", action='store_true', help="Use the settings of SQLite before they were tuned")
+    args = parser.parse_args()
+    report = run(args.readers, args.writers, args.duration, args.contacts, args.sqlite_defaults)
+    for kind, stats in report.items():
+        print(f'{kind}s: {stats["per_second"]:.0f}/s, {stats["errors"]} errors, p99 {stats["p99_ms"]:.0f} ms')
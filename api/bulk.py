@@ -0,0 +1,308 @@
+import csv
+from datetime import datetime
+from io import StringIO, TextIOWrapper
+from itertools import islice
+from json import dumps, loads, JSONDecodeError
+import re
+from typing import IO, Any, Dict, Iterable, Iterator, List, Optional, Tuple, Union
+
+from sqlalchemy import text
+from sqlalchemy.engine import Connection
+from sqlalchemy.exc import IntegrityError
+
+from config import (
+    Config,
+    IntegerFieldType,
+    ListFieldType,
+    TOGGLE_STRINGS,
+    ToggleFieldType,
+    value_error_body,
+    ValueException,
+)
+from models import (
+    add_upload_refs,
+    bump_data_version,
+    Contact,
+    db,
+    infos_to_json,
+    insert_search_rows,
+    is_duplicate_key_error,
+    record_inserted,
+    search_content,
+)
+
+# Kept under the default limit of 999 variables per statement of SQLite, as the primary keys of a
+# batch are looked up with a single IN
+BATCH_SIZE = 500
+# Number of rows fetched at once from the DB when exporting
+EXPORT_CHUNK_SIZE = 1000
+
+# Surrogate standing for a byte that could not be decoded from UTF-8
+UNDECODED_BYTE = re.compile('[\udc80-\udcff]')
+
+# Accepted formats, with the content types and file extensions they are detected from
+FORMATS = {
+    'json': ('application/json', '.json'),
+    'ndjson': ('application/x-ndjson', '.ndjson'),
+    'csv': ('text/csv', '.csv'),
+}
+
+
+class InvalidRecordException(Exception):
+
+    def __init__(self, message: str, *args: object) -> None:
+        self.code = 'INVALID_RECORD'
+        self.message = message
+        super().__init__(*args)
+
+
+def format_from_content_type(content_type: str) -> Optional[str]:
+    mimetype = content_type.split(';')[0].strip().lower()
+    return next((name for name, (type_, _) in FORMATS.items() if type_ == mimetype), None)
+
+def format_from_filename(filename: str) -> Optional[str]:
+    return next((name for name, (_, extension) in FORMATS.items() if filename.lower().endswith(extension)), None)
+
+
+def read_records(stream: IO[bytes], format_: str, config: Config) -> Iterator[Any]:
+    """Read the records from `stream` one by one. A record that cannot be read is returned as an
+    `InvalidRecordException` instead of a dict, so it is reported along with the others.
+    """
+    if format_ == 'json':
+        try:
+            records = loads(stream.read())
+        except (JSONDecodeError, UnicodeDecodeError):
+            raise InvalidRecordException('Body is not a valid JSON')
+        if not isinstance(records, list):
+            raise InvalidRecordException('Body must be a JSON array')
+        yield from records
+    elif format_ == 'ndjson':
+        for line in stream:
+            if not line.strip():
+                continue
+            try:
+                yield loads(line.decode('utf-8'))
+            except UnicodeDecodeError:
+                yield InvalidRecordException('Line is not valid UTF-8')
+            except JSONDecodeError:
+                yield InvalidRecordException('Line is not a valid JSON')
+    elif format_ == 'csv':
+        # The bytes that are not UTF-8 are kept as surrogates, to report the rows they are in
+        reader = csv.DictReader(TextIOWrapper(stream, encoding='utf-8', errors='surrogateescape', newline=''))
+        try:
+            if _has_undecoded(reader.fieldnames or ()):
+                raise InvalidRecordException('Header is not valid UTF-8')
+        except csv.Error as exp:
+            raise InvalidRecordException(f'Header is not a valid CSV: {exp}')
+        while True:
+            try:
+                row = next(reader)
+            except StopIteration:
+                return
+            except csv.Error as exp:
+                yield InvalidRecordException(f'Row is not a valid CSV: {exp}')
+                continue
+            if _has_undecoded(row.values()):
+                yield InvalidRecordException('Row is not valid UTF-8')
+            else:
+                yield _coerce_csv_row(row, config)
+
+def _has_undecoded(values: Iterable[Any]) -> bool:
+    # The values of the extra columns of a row are in a list
+    return any(
+        _has_undecoded(value) if isinstance(value, list) else isinstance(value, str) and UNDECODED_BYTE.search(value)
+        for value in values
+    )
+
+def _coerce_csv_row(row: Dict[str, str], config: Config) -> dict:
+    # CSV only has strings, convert the values of the fields with another type. Values that cannot
+    # be converted are kept as is, and reported by the validation.
+    record = {}
+    for name, value in row.items():
+        if name is None or value is None or value == '':
+            continue
+        field = config.fields_by_name.get(name)
+        field_type = field.field_type if field else None
+        if isinstance(field_type, IntegerFieldType):
+            try:
+                value = int(value)
+            except ValueError:
+                pass
+        elif isinstance(field_type, ToggleFieldType):
+            value = TOGGLE_STRINGS.get(value.lower(), value)
+        elif isinstance(field_type, ListFieldType):
+            try:
+                value = loads(value)
+            except JSONDecodeError:
+                value = [item.strip() for item in value.split(';') if item.strip()]
+        record[name] = value
+    return record
+
+
+def record_error(row: int, error: Union[InvalidRecordException, ValueException]) -> dict:
+    if isinstance(error, InvalidRecordException):
+        return {"row": row, "code": error.code, "message": error.message}
+    return dict({"row": row}, **value_error_body(error))
+
+
+def import_contacts(records: Iterable[Any], config: Config, batch_size: int=BATCH_SIZE, validate_only: bool=False) -> dict:
+    """Validate all the `records` against `config` and insert the valid ones, by batches of
+    `batch_size` records, each batch in a single transaction.
+
+    Returns the number of contacts inserted and the errors of the records that were not, with the
+    position of the record in the input. A record with several invalid values has an error for
+    each of them. With `validate_only`, nothing is inserted and the number of valid records is
+    returned instead.
+    """
+    inserted, errors = 0, []
+    seen_keys = set()
+    records = enumerate(records)
+    while True:
+        batch = list(islice(records, batch_size))
+        if not batch:
+            break
+        valid = []
+        for row, record in batch:
+            if not isinstance(record, dict):
+                error = record if isinstance(record, InvalidRecordException) else InvalidRecordException('Record must be a JSON object')
+                errors.append(record_error(row, error))
+                continue
+            record_errors = config.validate(record, fields_to_skip=['id'])
+            if record_errors:
+                errors.extend(record_error(row, error) for error in record_errors)
+                continue
+            infos = {key: value for key, value in record.items() if key != 'id'}
+            key = infos.get(config.primary_key) if config.primary_key else None
+            if key is not None:
+                # Duplicates within the input itself, the ones with the DB are checked by batch.
+                # Compared as JSON, the key can be a list, and 1 is not the same key as true.
+                seen_key = dumps(key, sort_keys=True)
+                if seen_key in seen_keys:
+                    errors.append(_duplicate_error(row, config.primary_key, key))
+                    continue
+                seen_keys.add(seen_key)
+            valid.append((row, infos))
+        valid = _exclude_saved_keys(valid, config, errors)
+        inserted += len(valid) if validate_only else _insert_batch(valid, config, errors)
+    # Stable, the errors of a record stay in the order of the fields
+    errors.sort(key=lambda error: error['row'])
+    return {"valid" if validate_only else "inserted": inserted, "errors": errors}
+
+def _duplicate_error(row: int, field: str, value: Any) -> dict:
+    return {"row": row, "code": 'DUPLICATE_VALUE', "field": field, "value": value}
+
+def _exclude_saved_keys(batch: List[Tuple[int, dict]], config: Config, errors: list) -> List[Tuple[int, dict]]:
+    if not config.primary_key or not batch:
+        return batch
+    # Use the primary key index to find the values already saved
+    field = Contact.info_field(config.primary_key)
+    # The keys that are lists or objects are only checked by the index when inserting them
+    keys = [
+        key for key in (infos.get(config.primary_key) for _, infos in batch)
+        if key is not None and not isinstance(key, (list, dict))
+    ]
+    existing = {value for (value,) in db.session.query(field).filter(field.in_(keys))} if keys else set()
+
+    def is_saved(key: Any) -> bool:
+        return not isinstance(key, (list, dict)) and key in existing
+
+    for row, infos in batch:
+        if is_saved(infos.get(config.primary_key)):
+            errors.append(_duplicate_error(row, config.primary_key, infos[config.primary_key]))
+    return [(row, infos) for row, infos in batch if not is_saved(infos.get(config.primary_key))]
+
+def _insert_batch(batch: List[Tuple[int, dict]], config: Config, errors: list) -> int:
+    if not batch:
+        return 0
+
+    try:
+        with db.engine.begin() as connection:
+            _insert(connection, [infos for _, infos in batch], config)
+        return len(batch)
+    except IntegrityError as exp:
+        if not is_duplicate_key_error(exp):
+            raise
+        # Another writer saved one of the keys in the meantime, insert the records one by one to
+        # find which ones
+        inserted = 0
+        for row, infos in batch:
+            try:
+                with db.engine.begin() as connection:
+                    _insert(connection, [infos], config)
+                inserted += 1
+            except IntegrityError as exp:
+                if not is_duplicate_key_error(exp):
+                    raise
+                errors.append(_duplicate_error(row, config.primary_key, infos.get(config.primary_key)))
+        return inserted
+
+def _insert(connection: Connection, batch: List[dict], config: Config) -> None:
+    now, version, updated_at = datetime.now(), bump_data_version(connection), datetime.utcnow()
+    rows = [
+        {'infos': dumps(infos), 'inserted_timestamp': now, 'updated_version': version, 'updated_at': updated_at}
+        for infos in batch
+    ]
+    table = Contact.__table__
+    if connection.dialect.name == 'postgresql':
+        # A single INSERT of all the rows, returning their ids in the same order
+        ids = [row[0] for row in connection.execute(table.insert().values(rows).returning(table.c.id))]
+    else:
+        connection.execute(table.insert(), rows)
+        # The mapper events keeping the search index up to date are not triggered by bulk inserts.
+        # The write lock is held until the end of the transaction, so the last ids are the ones
+        # just inserted, in the same order.
+        ids = [row[0] for row in connection.execute(
+            text('SELECT id FROM contact ORDER BY id DESC LIMIT :count'), count=len(batch)
+        )][::-1]
+    search_rows = [
+        {'id': id_contact, 'content': content}
+        for id_contact, content in ((id_contact, search_content(infos, config)) for id_contact, infos in zip(ids, batch))
+        if content
+    ]
+    if search_rows:
+        insert_search_rows(connection, search_rows)
+    record_inserted(connection, ids)
+    add_upload_refs(connection, [
+        infos[field] for infos in batch for field in config.file_fields if isinstance(infos.get(field), str) and infos[field]
+    ])
+
+
+def export_contacts(format_: str, config: Config, chunk_size: int=EXPORT_CHUNK_SIZE) -> Iterator[str]:
+    """Yield all the contacts, formatted as `format_`, chunk by chunk.
+
+    Rows are fetched from the DB `chunk_size` at a time and written out as they come, so the memory
+    used doesn't depend on the number of contacts. Values are exported as stored, without the full
+    URL of the file fields, so that the output can be imported back.
+    """
+    rows = db.session.query(Contact.id, Contact.infos).order_by(Contact.id).yield_per(chunk_size)
+    if format_ == 'csv':
+        yield from _export_csv(rows, config)
+        return
+
+    if format_ == 'json':
+        yield '['
+    separator = ''
+    for id_contact, infos in rows:
+        line = infos_to_json(id_contact, infos)
+        if format_ == 'json':
+            yield separator + line
+            separator = ','
+        else:
+            yield line + '\n'
+    if format_ == 'json':
+        yield ']'
+
+def _export_csv(rows: Iterable[Tuple[int, str]], config: Config) -> Iterator[str]:
+    buffer = StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=['id'] + [field.name for field in config.fields], extrasaction='ignore')
+    writer.writeheader()
+    for id_contact, infos in rows:
+        record = {
+            # Use the same representation as the one expected by the import
+            name: dumps(value) if isinstance(value, (list, dict)) else (str(value).lower() if isinstance(value, bool) else value)
+            for name, value in loads(infos).items()
+        }
+        writer.writerow(dict(record, id=id_contact))
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
@@ -0,0 +1,84 @@
+from collections import OrderedDict
+import os
+from threading import Lock
+from typing import Any, Dict, Hashable, Optional, Tuple
+
+# Number of contacts whose bodies are kept by default
+DEFAULT_CONTACT_CACHE_SIZE = 1024
+
+
+class ContactCache:
+    """LRU cache of the JSON bodies of the contacts, kept by each process of the app.
+
+    A body is found by the id of the contact and the version it was built from, so a contact
+    changed by another process is never served from here, only left to be evicted. Each contact can
+    have several variants of its body, eg. with only some of its fields, all evicted together.
+    """
+
+    def __init__(self, capacity: int) -> None:
+        self.capacity = capacity
+        self.hits = self.misses = self.evictions = 0
+        # Id of the contact -> variant -> (version, body)
+        self._entries: 'OrderedDict[int, Dict[Hashable, Tuple[Any, str]]]' = OrderedDict()
+        self._lock = Lock()
+
+    def get(self, id_contact: int, variant: Hashable, version: Any) -> Optional[str]:
+        """Return the body of the `variant` of the contact `id_contact` at `version`, or None if it
+        is not cached
+        """
+        with self._lock:
+            entry = self._entries.get(id_contact, {}).get(variant)
+            if entry is None or entry[0] != version:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(id_contact)
+            self.hits += 1
+            return entry[1]
+
+    def put(self, id_contact: int, variant: Hashable, version: Any, body: str) -> None:
+        """Cache the `body` of the `variant` of the contact `id_contact` at `version`"""
+        if self.capacity <= 0:
+            return
+        with self._lock:
+            variants = self._entries.setdefault(id_contact, {})
+            # Only the last version of a contact is useful
+            for key in [key for key, entry in variants.items() if entry[0] != version]:
+                del variants[key]
+            variants[variant] = (version, body)
+            self._entries.move_to_end(id_contact)
+            while len(self._entries) > self.capacity:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, id_contact: int) -> None:
+        """Forget the bodies of the contact `id_contact`, to call when it is changed or deleted"""
+        with self._lock:
+            self._entries.pop(id_contact, None)
+
+    def clear(self) -> None:
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "capacity": self.capacity,
+                "size": len(self._entries),
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+            }
+
+
+_CONTACT_CACHE: Optional[ContactCache] = None
+_CONTACT_CACHE_LOCK = Lock()
+
+def get_contact_cache() -> ContactCache:
+    """Return the cache of the contacts of this process, holding up to CONTACT_CACHE_SIZE contacts
+    (0 disables it)
+    """
+    global _CONTACT_CACHE
+    with _CONTACT_CACHE_LOCK:
+        if _CONTACT_CACHE is None:
+            _CONTACT_CACHE = ContactCache(int(os.environ.get('CONTACT_CACHE_SIZE', DEFAULT_CONTACT_CACHE_SIZE)))
+        return _CONTACT_CACHE
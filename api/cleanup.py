@@ -0,0 +1,190 @@
+from datetime import datetime
+import os
+from threading import Event, Thread
+import time
+from typing import Any, Iterator, Optional, Tuple
+
+from flask import current_app, Flask
+from flask_sqlalchemy import SignallingSession
+from sqlalchemy import and_, bindparam, event, select
+
+from models import (
+    acquire_lease,
+    Contact,
+    db,
+    FILE_REMOVALS_QUEUED,
+    json_loads,
+    lease_holder,
+    PendingFileRemoval,
+    release_lease,
+    UploadRef,
+)
+from storage import content_digest, get_storage, is_valid_name, remove_file
+from thumbnails import remove_thumbnails, THUMBNAIL_SIZES, WEBP_SUFFIX
+
+# Number of queued files handled in a single transaction
+CLEANUP_BATCH_SIZE = 100
+# Seconds between two runs of the worker when it is not woken up by a commit
+DEFAULT_CLEANUP_INTERVAL = 60
+# Seconds between two garbage collections
+DEFAULT_GC_INTERVAL = 24 * 60 * 60
+# Files more recent than this, in seconds, are never collected, as the contact referencing them
+# may not be committed yet
+DEFAULT_GC_GRACE_PERIOD = 60 * 60
+
+# Names of the leases of the cleanup and of the garbage collection, and the seconds a worker holds
+# the one of the cleanup before another can take it over, if it died while cleaning
+CLEANUP_LEASE = 'file-cleanup'
+GC_LEASE = 'file-gc'
+LEASE_DURATION = 10 * 60
+
+_wakeup = Event()
+
+
+def wake_up_cleanup_worker() -> None:
+    """Make the worker remove the files queued without waiting for its next run, to call once the
+    transaction queuing them is committed
+    """
+    _wakeup.set()
+
+@event.listens_for(SignallingSession, 'after_commit')
+def wake_up_worker_after_commit(session: SignallingSession):
+    if session.info.pop(FILE_REMOVALS_QUEUED, False):
+        wake_up_cleanup_worker()
+
+@event.listens_for(SignallingSession, 'after_rollback')
+def forget_file_removals_after_rollback(session: SignallingSession):
+    session.info.pop(FILE_REMOVALS_QUEUED, None)
+
+
+def _uploaded_since(filename: str, queued_at: datetime) -> bool:
+    # A file uploaded again is touched, the removal is then outdated
+    info = get_storage().stat(filename) if is_valid_name(filename) else None
+    return info is not None and info.modified > queued_at.timestamp()
+
+def drain_file_removals(batch_size: int=CLEANUP_BATCH_SIZE) -> Tuple[int, int]:
+    """Remove the files queued by `models.queue_file_removal` that are still not referenced by any
+    contact, along with their thumbnails, and return the number of files removed and the number of
+    bytes reclaimed.
+    """
+    table, refs = PendingFileRemoval.__table__, UploadRef.__table__
+    files = reclaimed = 0
+    while True:
+        with db.engine.begin() as connection:
+            rows = connection.execute(table.select().order_by(table.c.queued_at).limit(batch_size)).fetchall()
+            if not rows:
+                break
+            referenced = {filename for (filename,) in connection.execute(
+                select([refs.c.filename]).where(and_(refs.c.filename.in_([row.filename for row in rows]), refs.c.count > 0))
+            )}
+            for row in rows:
+                if row.filename in referenced or _uploaded_since(row.filename, row.queued_at):
+                    continue
+                try:
+                    size = remove_file(row.filename)
+                    reclaimed += remove_thumbnails(row.filename)
+                except OSError as exp:
+                    # Not retried, the garbage collection will get it
+                    current_app.logger.warning(f'Cannot remove the file {row.filename}: {exp}')
+                    continue
+                if size is not None:
+                    files += 1
+                    reclaimed += size
+            # Only forget the removals handled, not the ones queued again in the meantime
+            connection.execute(
+                table.delete().where(and_(table.c.filename == bindparam('name'), table.c.queued_at == bindparam('at'))),
+                [{'name': row.filename, 'at': row.queued_at} for row in rows],
+            )
+    return files, reclaimed
+
+
+def _string_values(infos: Any) -> Iterator[str]:
+    values = infos.values() if isinstance(infos, dict) else []
+    for value in values:
+        if isinstance(value, str):
+            yield value
+        elif isinstance(value, list):
+            yield from (item for item in value if isinstance(item, str))
+
+def collect_garbage(grace_period: float=DEFAULT_GC_GRACE_PERIOD) -> Tuple[int, int]:
+    """Remove the uploaded files that no contact references, whatever the field, and the
+    thumbnails of the files that are gone. Files modified less than `grace_period` seconds ago are
+    kept, and so are the files not named after their content like the uploads are, which were not
+    uploaded through the API.
+
+    Return the number of files removed and the number of bytes reclaimed.
+    """
+    # Mark
+    referenced = set()
+    for (infos,) in db.session.query(Contact.infos).yield_per(1000):
+        referenced.update(_string_values(json_loads(infos)))
+
+    # Sweep
+    storage, before = get_storage(), time.time() - grace_period
+    files = reclaimed = 0
+    remaining = set()
+    for info in list(storage.list()):
+        if (
+            content_digest(info.name) is not None
+            and info.name not in referenced
+            and info.modified <= before
+            and storage.remove(info.name) is not None
+        ):
+            files += 1
+            reclaimed += info.size + remove_thumbnails(info.name)
+        else:
+            remaining.add(info.name)
+    for size in THUMBNAIL_SIZES:
+        for info in list(storage.list(f'thumbnails/{size}/')):
+            source = info.name.split('/')[-1]
+            source = source[:-len(WEBP_SUFFIX)] if source.endswith(WEBP_SUFFIX) else source
+            if source not in remaining and info.modified <= before and storage.remove(info.name) is not None:
+                files += 1
+                reclaimed += info.size
+    return files, reclaimed
+
+
+def start_cleanup_worker(app: Flask) -> Optional[Thread]:
+    """Start the thread removing the files queued for removal, woken up after each commit queuing
+    some, and running the garbage collection periodically.
+
+    The thread is started by every worker of the app, but a single one cleans at a time, and the
+    garbage collection only runs once per FILE_GC_INTERVAL whatever the number of workers, see
+    `models.acquire_lease`. Set FILE_CLEANUP_INTERVAL to 0 to not start it, and FILE_GC_INTERVAL to
+    0 to never run the garbage collection.
+    """
+    interval = float(os.environ.get('FILE_CLEANUP_INTERVAL', DEFAULT_CLEANUP_INTERVAL))
+    if interval <= 0:
+        return None
+    gc_interval = float(os.environ.get('FILE_GC_INTERVAL', DEFAULT_GC_INTERVAL))
+    thread = Thread(target=_run_worker, args=(app, interval, gc_interval), name='file-cleanup', daemon=True)
+    thread.start()
+    return thread
+
+def _run_worker(app: Flask, interval: float, gc_interval: float) -> None:
+    holder = lease_holder()
+    while True:
+        # Cleared before draining, so that a commit made while draining triggers another run
+        _wakeup.clear()
+        with app.app_context():
+            try:
+                if acquire_lease(CLEANUP_LEASE, holder, LEASE_DURATION):
+                    try:
+                        _clean(app, gc_interval)
+                    finally:
+                        release_lease(CLEANUP_LEASE, holder)
+            except Exception:
+                app.logger.exception('Cannot clean the upload folder')
+            finally:
+                db.session.remove()
+        _wakeup.wait(interval)
+
+def _clean(app: Flask, gc_interval: float) -> None:
+    # Also removes the files left queued by a previous run of the app
+    files, reclaimed = drain_file_removals()
+    if files:
+        app.logger.info(f'{files} files removed, {reclaimed} bytes reclaimed')
+    # Never released, so that it is only taken again by a worker once the interval is over
+    if gc_interval > 0 and acquire_lease(GC_LEASE, f'{lease_holder()}:{time.time()}', gc_interval):
+        files, reclaimed = collect_garbage()
+        app.logger.info(f'Garbage collection removed {files} files, {reclaimed} bytes reclaimed')
@@ -1,6 +1,8 @@
 import argparse
 from json import loads, JSONDecodeError
-from typing import Any, Dict, List, Tuple, Union
+from threading import Lock
+from types import MappingProxyType
+from typing import Any, Callable, Dict, List, Optional, Tuple, Union
 import os
 import sys
 
@@ -21,6 +23,26 @@ class WrongTypeException(Exception):
         super().__init__(*args)
 
 
+class InvalidValueException(Exception):
+
+    def __init__(self, field: str, *args: object) -> None:
+        self.code = 'INVALID_VALUE'
+        self.field = field
+        super().__init__(*args)
+
+
+# Errors of the values not matching their field
+ValueException = Union[InvalidValueException, MissingRequiredValueException, WrongTypeException]
+
+
+def value_error_body(error: ValueException) -> dict:
+    """Return the description of `error` sent to the clients"""
+    body = {"field": error.field, "code": error.code}
+    if isinstance(error, WrongTypeException):
+        body["expected_type"] = error.expect_type
+    return body
+
+
 class InvalidConfigException(Exception):
 
     def __init__(self, field: Union[str, list], param: Union[str, list], pattern: str, *args: object, **pattern_params: dict) -> None:
@@ -33,15 +55,81 @@ class InvalidConfigException(Exception):
 class Config:
     """ Main config class
 
-    Should be init using a JSON file
+    Should be init using a JSON file. Instances are read-only once loaded, so that the same instance
+    can be shared between requests (see `get_config`).
     """
     def __init__(self, filename: str) -> None:
         with open(filename, 'rb') as config_file:
             config = loads(config_file.read())
-        self.fields: List['Field'] = [Field.load_from_dict(field_name, params) for field_name, params in config.items()]
+        self._load(config)
+
+    @classmethod
+    def from_dict(cls, config: dict) -> 'Config':
+        instance = cls.__new__(cls)
+        instance._load(config)
+        return instance
+
+    def _load(self, config: dict) -> None:
+        # An empty config file is created as '[]' when starting the app, consider it as no fields
+        items = config.items() if isinstance(config, dict) else []
+        fields: Tuple['Field', ...] = tuple(Field.load_from_dict(field_name, params) for field_name, params in items)
+        # Precompute what is looked up on every request, instead of filtering the fields each time
+        object.__setattr__(self, 'raw', MappingProxyType(dict(config) if isinstance(config, dict) else {}))
+        object.__setattr__(self, 'fields', fields)
+        object.__setattr__(self, 'fields_by_name', MappingProxyType({field.name: field for field in fields}))
+        object.__setattr__(self, 'file_fields', tuple(field.name for field in fields if field.field_type in FILE_FIELDS))
+        # Names of the fields marked as 'sort_key' and 'main_attribute', ordered by their value
+        object.__setattr__(self, 'sort_keys', tuple(name for name, _ in sorted(
+            ((name, params['sort_key']) for name, params in items if params.get('sort_key') is not None),
+            key=lambda item: item[1]
+        )))
+        object.__setattr__(self, 'main_attributes', tuple(name for name, _ in sorted(
+            ((name, params['main_attribute']) for name, params in items if params.get('main_attribute') is not None),
+            key=lambda item: item[1]
+        )))
+        object.__setattr__(self, 'primary_key', next((name for name, params in items if params.get('primary_key')), None))
+        # Flat list of what `check` needs for each field, to avoid any lookup when checking values
+        object.__setattr__(self, 'validators', tuple((field.name, field.required, field.validator) for field in fields))
+        object.__setattr__(self, 'searchable_fields', tuple(name for name, params in items if params.get('type') in SEARCHABLE_TYPES))
+
+    def __setattr__(self, name: str, value: Any) -> None:
+        raise AttributeError(f'{self.__class__.__name__} instances are read-only')
+
+    def validate(self, value: dict, fields_to_skip: list=[]) -> List[ValueException]:
+        """Check the values of `value` against the fields of the config, and return the errors of
+        all the invalid ones, in the order of the fields. Empty if `value` is valid.
+        """
+        errors = []
+        for name, required, check in self.validators:
+            field_value = value.get(name)
+            if not field_value:
+                if required and name not in fields_to_skip:
+                    errors.append(MissingRequiredValueException(name, f'Missing value for required parameter {name}'))
+                continue
+            if name not in fields_to_skip:
+                try:
+                    check(field_value)
+                except (InvalidValueException, WrongTypeException) as exp:
+                    errors.append(exp)
+        return errors
 
     def check(self, value: dict, fields_to_skip: list=[]) -> bool:
-        return all(field.check(value.get(field.name)) for field in self.fields if field.name not in fields_to_skip)
+        """Check the values of `value` against the fields of the config, raising the error of the
+        first invalid one. The checks are compiled once per config, see `FieldType.compile`.
+        """
+        for name, required, check in self.validators:
+            field_value = value.get(name)
+            if not field_value:
+                if required and name not in fields_to_skip:
+                    raise MissingRequiredValueException(name, f'Missing value for required parameter {name}')
+                continue
+            if name not in fields_to_skip:
+                check(field_value)
+        return True
+
+
+# Function checking a value, raising an exception if it is invalid
+Validator = Callable[[Any], None]
 
 
 class Field:
@@ -60,6 +148,7 @@ class Field:
         self.field_type = field_type
         self.required = required
         self.additional_params = additional_params
+        self.validator = field_type.compile(name, additional_params)
 
     @staticmethod
     def load_from_dict(name: str, params: dict) -> 'Field':
@@ -68,64 +157,83 @@ class Field:
             FIELD_TYPE_MAPPING[params['type']],
             display_name=params.get('display_name', ''),
             required=params.get('required', False),
-            additional_params=params.get('additional_params', {}),
+            additional_params=params.get('additional_type_parameters', {}),
         )
 
     def check(self, value: Any) -> bool:
         """
         """
-        try:
+        if not value:
             if self.required:
-                if not value:
-                    raise MissingRequiredValueException(self.name, f'Missing value for required parameter {self.name}')
-                return self.field_type.check(value, additional_params=self.additional_params)
-            if value:
-                return self.field_type.check(value, additional_params=self.additional_params)
-        except WrongTypeException as exp:
-            # Set the real field name here, because we don't have it when checking the type
-            exp.field = self.name
-            raise exp
+                raise MissingRequiredValueException(self.name, f'Missing value for required parameter {self.name}')
+            return True
+        self.validator(value)
         return True
 
 
 class FieldType:
     """Class used to represent a field type. Shouldn't be used, but rather subclassed
     """
-    type_name: str
+    type_name: str = ''
     def check(self, value: Any, additional_params: dict={}) -> bool:
         """
         """
-        raise NotImplementedError
+        self.compile('', additional_params)(value)
+        return True
 
-    def _check_additional_params(self, value: Any, additional_params: dict={}) -> bool:
-        """
+    def compile(self, field_name: str, additional_params: dict) -> Validator:
+        """Return the function checking the values of the field `field_name`, with everything that
+        only depends on the config (the parameters, the name of the type...) computed beforehand.
         """
         raise NotImplementedError
 
-    def _raise_wrong_type_error(self, value):
-        raise WrongTypeException(
-            '', # Field name, set it to blank here because we don't have it, will be set to the right value later
-            self.type_name or TYPE_FIELD_MAPPING[self.__class__],
-            f"Wrong type for {self.__class__.__name__} with value {value} ({type(value).__name__})",
-        )
+    def _type_checker(self, field_name: str, expected: Union[type, Tuple[type, ...]]) -> Validator:
+        type_name = self.type_name or TYPE_FIELD_MAPPING[self.__class__]
+        class_name = self.__class__.__name__
+        def check(value: Any) -> None:
+            if not isinstance(value, expected):
+                raise WrongTypeException(
+                    field_name,
+                    type_name,
+                    f"Wrong type for {class_name} with value {value} ({type(value).__name__})",
+                )
+        return check
 
 
 class IntegerFieldType(FieldType):
     """Check the value is an integer
     """
-    def check(self, value: Any, additional_params: dict={}) -> bool:
-        if not isinstance(value, int):
-            self._raise_wrong_type_error(value)
-        return True
+    def compile(self, field_name: str, additional_params: dict) -> Validator:
+        return self._type_checker(field_name, int)
 
 
 class StrFieldType(FieldType):
     """Check the value is a str
     """
-    def check(self, value: Any, additional_params: dict={}) -> bool:
-        if not isinstance(value, str):
-            self._raise_wrong_type_error(value)
-        return True
+    # Shared by all the text types, which would otherwise be displayed as the last one of them
+    type_name = 'str'
+    def compile(self, field_name: str, additional_params: dict) -> Validator:
+        return self._type_checker(field_name, str)
+
+
+class SelectFieldType(StrFieldType):
+    """Check the value is one of the `allowed_values` of `additional_params`
+
+    >>> from config import FIELD_TYPE_MAPPING
+    >>> checker = FIELD_TYPE_MAPPING['select']
+    >>> checker.check('light', {'allowed_values': ['light', 'dark']})
+    True
+    """
+    def compile(self, field_name: str, additional_params: dict) -> Validator:
+        check_type = super().compile(field_name, additional_params)
+        allowed_values = frozenset(additional_params.get('allowed_values') or ())
+        if not allowed_values:
+            return check_type
+        def check(value: Any) -> None:
+            check_type(value)
+            if value not in allowed_values:
+                raise InvalidValueException(field_name, f'Value {value} is not one of the allowed values')
+        return check
 
 
 class ToggleFieldType(FieldType):
@@ -134,10 +242,8 @@ class ToggleFieldType(FieldType):
     # Change the type displayed, otherwise it'll say
     # 'Wrong type for <field name>, expected toggle'
     type_name = 'boolean'
-    def check(self, value: Any, additional_params: dict={}) -> bool:
-        if not isinstance(value, bool):
-            self._raise_wrong_type_error(value)
-        return True
+    def compile(self, field_name: str, additional_params: dict) -> Validator:
+        return self._type_checker(field_name, bool)
 
 
 class ListFieldType(FieldType):
@@ -153,17 +259,17 @@ class ListFieldType(FieldType):
     >>> checker.check([1, 2, 3], {'inner_type': 'integer'})
     True
     """
-    def check(self, value: Any, additional_params: dict={}) -> bool:
-        if not isinstance(value, list):
-            self._raise_wrong_type_error(value)
-        return self._check_additional_params(value, additional_params)
-
-    def _check_additional_params(self, value: Any, additional_params: dict) -> bool:
+    def compile(self, field_name: str, additional_params: dict) -> Validator:
+        check_type = self._type_checker(field_name, list)
         inner_type = additional_params.get('inner_type')
         if not inner_type:
-            return False
-        field_type = FIELD_TYPE_MAPPING[inner_type]
-        return all(field_type.check(val, additional_params) for val in value)
+            return check_type
+        check_item = FIELD_TYPE_MAPPING[inner_type].compile(field_name, additional_params)
+        def check(value: Any) -> None:
+            check_type(value)
+            for item in value:
+                check_item(item)
+        return check
 
 
 class ImageFieldType(FieldType):
@@ -179,17 +285,17 @@ class ImageFieldType(FieldType):
     >>> checker.check('path/to/file.png', {'accepted_types': ['png', 'jpg']})
     True
     """
-    def check(self, value: Any, additional_params: dict={}) -> bool:
-        if not isinstance(value, str):
-            self._raise_wrong_type_error(value)
-        return value.find('.') != -1 and self._check_additional_params(value, additional_params)
-
-    def _check_additional_params(self, value: Any, additional_params: dict) -> bool:
-        accepted_types = additional_params.get('accepted_types')
-        if not accepted_types:
-            return True
-        extension = value.split('.')[-1].lower()
-        return extension in [ext.lower() for ext in accepted_types]
+    def compile(self, field_name: str, additional_params: dict) -> Validator:
+        check_type = self._type_checker(field_name, str)
+        accepted_types = frozenset(ext.lower() for ext in additional_params.get('accepted_types') or ())
+        def check(value: Any) -> None:
+            check_type(value)
+            _, dot, extension = value.rpartition('.')
+            if not dot:
+                raise InvalidValueException(field_name, f'{value} is not the name of a file')
+            if accepted_types and extension.lower() not in accepted_types:
+                raise InvalidValueException(field_name, f'Extension of {value} is not one of the accepted types')
+        return check
 
 
 # Mapping of the accepted values and their type checker
@@ -205,12 +311,54 @@ FIELD_TYPE_MAPPING: Dict[str, 'FieldType'] = {
     'long_str': StrFieldType(),
     'url': StrFieldType(),
     'email': StrFieldType(),
-    'select': StrFieldType(),
+    'select': SelectFieldType(),
 }
 TYPE_FIELD_MAPPING = {field.__class__: type_name for type_name, field in FIELD_TYPE_MAPPING.items()}
 FILE_FIELDS = [
     FIELD_TYPE_MAPPING['image'],
 ]
+# Values of a toggle given as a string, eg. in a CSV
+TOGGLE_STRINGS = {'true': True, '1': True, 'yes': True, 'false': False, '0': False, 'no': False}
+# Name of the types whose values are indexed for the full-text search
+SEARCHABLE_TYPES = ('str', 'long_str', 'email', 'url', 'list')
+
+
+# Per-process registry of the loaded configs, with the stat signature of the file they were loaded
+# from, so a config file is only read and parsed again when it changed on disk.
+_CONFIG_REGISTRY: Dict[str, Tuple[tuple, Config]] = {}
+_CONFIG_REGISTRY_LOCK = Lock()
+
+def config_file_signature(filename: str) -> tuple:
+    stat = os.stat(filename)
+    return (stat.st_mtime_ns, stat.st_ino, stat.st_dev, stat.st_size)
+
+def get_config(filename: Optional[str]=None) -> Config:
+    """Return the Config for `filename` (defaults to the CONFIG_FILE env variable).
+
+    The file is parsed only the first time and when its mtime, inode or size changed since it was
+    last loaded, otherwise the same Config instance is returned.
+    """
+    filename = filename or os.environ.get('CONFIG_FILE', 'config.json')
+    signature = config_file_signature(filename)
+    cached = _CONFIG_REGISTRY.get(filename)
+    if cached and cached[0] == signature:
+        return cached[1]
+    with _CONFIG_REGISTRY_LOCK:
+        cached = _CONFIG_REGISTRY.get(filename)
+        if cached and cached[0] == signature:
+            return cached[1]
+        config = Config(filename)
+        _CONFIG_REGISTRY[filename] = (signature, config)
+        return config
+
+def invalidate_config(filename: Optional[str]=None) -> None:
+    """Drop the cached Config of `filename` (defaults to the CONFIG_FILE env variable), to make sure
+    the next call to `get_config` reloads it, even if the file was rewritten within the resolution
+    of its mtime.
+    """
+    filename = filename or os.environ.get('CONFIG_FILE', 'config.json')
+    with _CONFIG_REGISTRY_LOCK:
+        _CONFIG_REGISTRY.pop(filename, None)
 
 
 def validate_config_file(filename: str) -> Tuple[bool, str]:
@@ -374,12 +522,22 @@ def validate_config(config: dict):
                 )
             # If 'additional_type_parameters" is provided, make sure it's not empty
             accepted_types = additional_params.get('accepted_types')
-            if accepted_types is None:
+            max_size = additional_params.get('max_size')
+            if accepted_types is None and max_size is None:
                 raise InvalidConfigException(
                     parameter_name,
                     'accepted_types',
                     MISSING_PARAMETER_FROM_FIELD_TEMPLATE+' of "type": "list"'
                 )
+            if max_size is not None and (not isinstance(max_size, int) or isinstance(max_size, bool) or max_size <= 0):
+                raise InvalidConfigException(
+                    parameter_name,
+                    'max_size',
+                    INVALID_VALUE_OF_PARAMETER,
+                    value=max_size
+                )
+            if accepted_types is None:
+                continue
             if not isinstance(accepted_types, list):
                 raise InvalidConfigException(
                     parameter_name,
@@ -440,6 +598,17 @@ def validate_config(config: dict):
                     value=value_true if value_true == '' else value_false
                 )
 
+    for parameter_name, params in config.items():
+        # The default value, filled in the contacts saved before the field was added or changed,
+        # must be a valid value of the field
+        default = params.get('default')
+        if default is None:
+            continue
+        try:
+            FIELD_TYPE_MAPPING[params['type']].check(default, params.get('additional_type_parameters') or {})
+        except (InvalidValueException, WrongTypeException):
+            raise InvalidConfigException(parameter_name, 'default', INVALID_VALUE_OF_PARAMETER, value=default)
+
     params_with_display_name = {k: v.get('display_name') for k, v in config.items() if v.get('display_name')}
     for parameter_name, display_name_value in params_with_display_name.items():
         if not isinstance(display_name_value, str):
@@ -494,14 +663,49 @@ def validate_config(config: dict):
                 f'Found {len(params_with_same_main_attribute)} parameters with "main_attribute": "{main_attribute_value}"'
             )
 
+def dry_run_config_file(filename: str, processes: Optional[int]=None) -> Tuple[bool, str]:
+    """Report what replacing the current config (CONFIG_FILE) by the one of `filename` would do to
+    the saved contacts. The result is False if some of them would not be valid anymore.
+    """
+    # Imported here, the app is only needed for this mode
+    from main import create_app
+    from migrations import dry_run_migration
+
+    # Nothing to run in the background for a single command
+    os.environ['FILE_CLEANUP_INTERVAL'] = os.environ['CONFIG_MIGRATION_INTERVAL'] = '0'
+    with open(filename) as f:
+        new_config = loads(f.read())
+    with create_app().app_context():
+        processes = processes or int(os.environ.get('CONFIG_DRY_RUN_PROCESSES', 0)) or os.cpu_count() or 1
+        report = dry_run_migration(dict(get_config().raw), new_config, processes)
+    lines = [f'{report["total"]} contacts, {report["migrated"]} would be changed, {report["failed"]} would not be valid']
+    for name, field in report['fields'].items():
+        codes = ', '.join(f'{code}: {count}' for code, count in field['codes'].items())
+        ids = ', '.join(str(id_contact) for id_contact in field['sample_ids'])
+        lines.append(f'- {name}: {field["failed"]} ({codes}), eg. contacts {ids}')
+    return (report['failed'] == 0, '\n'.join(lines))
+
 if __name__ == '__main__':
     parser = argparse.ArgumentParser()
     parser.add_argument(
         "filename",
         help="Absolute or relative path to the .json config file to check",
     )
+    parser.add_argument(
+        "--dry-run",
+        action='store_true',
+        help="Also check the contacts saved with the current config (CONFIG_FILE) against this one",
+    )
+    parser.add_argument(
+        "--processes",
+        type=int,
+        help="Number of processes validating the contacts with --dry-run, defaults to the number of CPUs",
+    )
     args = parser.parse_args()
     check, message = validate_config_file(args.filename)
     print(message)
+    if check and args.dry_run:
+        check, message = dry_run_config_file(args.filename, args.processes)
+        print(message)
     # 'not check' so that True means we exit with 0 and False means we exit with code 1
     sys.exit(int(not check))
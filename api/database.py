@@ -0,0 +1,93 @@
+import os
+import re
+import sqlite3
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.pool import NullPool, QueuePool
+
+try:
+    # Driver of PostgreSQL, only needed when the app is configured to use it
+    import psycopg2
+    from psycopg2.extras import register_default_jsonb
+except ImportError:
+    psycopg2 = None
+
+# Pragmas set on every new connection to SQLite, with the env variables overriding their value.
+# busy_timeout comes first, so that the others wait for the lock instead of failing.
+SQLITE_PRAGMAS = (
+    # Milliseconds a connection waits for a lock before failing with "database is locked"
+    ('busy_timeout', 'SQLITE_BUSY_TIMEOUT', '5000'),
+    # Readers don't block the writer and are not blocked by it
+    ('journal_mode', 'SQLITE_JOURNAL_MODE', 'wal'),
+    # Safe with WAL, a commit may only be lost on a power failure, not corrupted
+    ('synchronous', 'SQLITE_SYNCHRONOUS', 'normal'),
+    # Pages cached per connection, negative for a size in KiB: 64 MiB
+    ('cache_size', 'SQLITE_CACHE_SIZE', '-65536'),
+    # Bytes of the DB file read through memory mapping: 256 MiB
+    ('mmap_size', 'SQLITE_MMAP_SIZE', str(256 * 1024 * 1024)),
+    ('temp_store', 'SQLITE_TEMP_STORE', 'memory'),
+)
+_PRAGMA_VALUE = re.compile(r'-?\w+')
+
+# Threads of the app that use the DB besides the ones serving the requests: the cleanup of the
+# uploaded files and the migration of the contacts
+BACKGROUND_THREADS = 2
+
+
+def sqlite_pragmas() -> dict:
+    """Return the pragmas to set on the connections to SQLite, as configured by the env"""
+    pragmas = {}
+    for name, variable, default in SQLITE_PRAGMAS:
+        value = os.environ.get(variable, default)
+        if not _PRAGMA_VALUE.fullmatch(value):
+            raise ValueError(f'Invalid value of {variable}: {value}')
+        pragmas[name] = value
+    return pragmas
+
+def engine_options(database_uri: str) -> dict:
+    """Return the options of the engine connecting to `database_uri`, to set as
+    SQLALCHEMY_ENGINE_OPTIONS.
+
+    Connections are kept in a pool of DB_POOL_SIZE connections (defaults to the number of threads
+    of a gunicorn worker, GUNICORN_THREADS, plus the background threads), with up to
+    DB_MAX_OVERFLOW more when they are all used (defaults to 10), waiting at most DB_POOL_TIMEOUT
+    seconds for one (defaults to 30). Set DB_POOL_SIZE to 0 to open a new connection every time.
+    """
+    pool_size = int(os.environ.get('DB_POOL_SIZE', int(os.environ.get('GUNICORN_THREADS', 1)) + BACKGROUND_THREADS))
+    url = make_url(database_uri)
+    if url.drivername.startswith('sqlite') and url.database in (None, '', ':memory:'):
+        # An in-memory DB only exists within its connection, keep the default pool
+        return {}
+    if pool_size <= 0:
+        return {'poolclass': NullPool}
+    options = {
+        'poolclass': QueuePool,
+        'pool_size': pool_size,
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 10)),
+        'pool_timeout': float(os.environ.get('DB_POOL_TIMEOUT', 30)),
+    }
+    if url.drivername.startswith('sqlite'):
+        # A pooled connection is used by a thread at a time, but not always the one that opened it
+        options['connect_args'] = {'check_same_thread': False}
+    return options
+
+
+@event.listens_for(Engine, 'connect')
+def set_sqlite_pragmas(dbapi_connection, _connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    try:
+        for name, value in sqlite_pragmas().items():
+            cursor.execute(f'PRAGMA {name} = {value}')
+    finally:
+        cursor.close()
+
+@event.listens_for(Engine, 'connect')
+def read_jsonb_as_text(dbapi_connection, _connection_record):
+    # The JSON documents are kept as strings, like the ones read from SQLite, instead of being parsed
+    # by the driver (see `models.JSONText`)
+    if psycopg2 is not None and isinstance(dbapi_connection, psycopg2.extensions.connection):
+        register_default_jsonb(dbapi_connection, loads=lambda value: value)
@@ -1,5 +1,6 @@
 import os
 
+import click
 from dotenv import load_dotenv
 from flask import Flask
 from flask_cors import CORS
@@ -7,18 +8,38 @@ from flask_cors import CORS
 from views import api
 
 def create_app() -> Flask:
-    from models import db
+    from bulk import format_from_filename, import_contacts, InvalidRecordException, read_records
+    from cleanup import collect_garbage, DEFAULT_GC_GRACE_PERIOD, start_cleanup_worker
+    from config import get_config
+    from database import engine_options
+    from migrations import start_migration_worker
+    from storage import get_storage
+    from models import (
+        db,
+        ensure_key_indexes,
+        ensure_search_index,
+        ensure_upload_refs,
+        rebuild_search_index,
+        upgrade_schema,
+    )
 
     basedir = os.path.abspath(os.path.dirname(__file__))
     app = Flask(__name__)
-    app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///' + os.path.join(basedir, 'app.db')
+    # SQLite by default, PostgreSQL is supported too (see README)
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get(
+        'SQLALCHEMY_DATABASE_URI', 'sqlite:///' + os.path.join(basedir, 'app.db')
+    )
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+    # Pool and pragmas tuned for several workers, see database.py
+    app.config['SQLALCHEMY_ENGINE_OPTIONS'] = engine_options(app.config['SQLALCHEMY_DATABASE_URI'])
 
-    CORS(app)
+    # Expose the pagination, query plan and upload headers, so the front can read them
+    CORS(app, expose_headers=['X-Next-Cursor', 'X-Query-Plan', 'X-Upload-Stats'])
 
     db.init_app(app)
     with app.app_context():
         db.create_all()
+        upgrade_schema()
 
     load_dotenv()
     # Make sure the config file exists when starting the app. If not create a new file as a valid empy JSON.
@@ -26,9 +47,48 @@ def create_app() -> Flask:
         with open(os.environ.get('CONFIG_FILE', 'config.json'), 'w') as f:
             f.write('[]')
 
-    # Make sure upload folder exists
-    if not os.path.exists(os.environ.get('UPLOAD_FOLDER', 'uploads')):
-        os.mkdir(os.environ.get('UPLOAD_FOLDER', 'uploads'))
+    # Make sure the storage of the uploaded files is usable, ie. the upload folder exists
+    get_storage()
+
+    with app.app_context():
+        ensure_key_indexes(get_config())
+        ensure_search_index(get_config())
+        ensure_upload_refs(get_config())
+    start_cleanup_worker(app)
+    start_migration_worker(app)
+
+    @app.cli.command('rebuild-search-index')
+    def rebuild_search_index_command():
+        """Index again all the contacts for the full-text search, to run after changing the types
+        of the fields in the config file by hand.
+        """
+        print(f'{rebuild_search_index(get_config())} contacts indexed')
+
+    @app.cli.command('import-contacts')
+    @click.argument('filename', type=click.Path(exists=True, dir_okay=False))
+    @click.option('--format', 'format_', type=click.Choice(['json', 'ndjson', 'csv']), help='Defaults to the file extension')
+    def import_contacts_command(filename: str, format_: str):
+        """Import the contacts of a JSON array, NDJSON or CSV file"""
+        format_ = format_ or format_from_filename(filename)
+        if not format_:
+            raise click.UsageError('Cannot guess the format from the file extension, use --format')
+        config = get_config()
+        with open(filename, 'rb') as file:
+            try:
+                report = import_contacts(read_records(file, format_, config), config)
+            except InvalidRecordException as exp:
+                raise click.ClickException(exp.message)
+        for error in report['errors']:
+            print(f'Record {error["row"]}: {", ".join(f"{key}={value}" for key, value in error.items() if key != "row")}')
+        print(f'{report["inserted"]} contacts imported, {len(report["errors"])} errors')
+
+    @app.cli.command('collect-garbage')
+    @click.option('--grace-period', type=float, default=DEFAULT_GC_GRACE_PERIOD, show_default=True,
+                  help='Keep the files modified less than this many seconds ago')
+    def collect_garbage_command(grace_period: float):
+        """Remove the uploaded files that no contact references anymore"""
+        files, reclaimed = collect_garbage(grace_period)
+        print(f'{files} files removed, {reclaimed} bytes reclaimed')
 
     app.register_blueprint(api)
 
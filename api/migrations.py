@@ -0,0 +1,477 @@
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from datetime import datetime
+from itertools import islice
+from json import dumps, loads
+import os
+from threading import Event, Thread
+from typing import Any, Callable, Dict, Iterable, Iterator, List, Optional, Set, Tuple
+
+from flask import Flask
+from sqlalchemy import and_, func, select
+from sqlalchemy.engine import Connection
+
+from cleanup import wake_up_cleanup_worker
+from config import (
+    Config,
+    FIELD_TYPE_MAPPING,
+    IntegerFieldType,
+    ListFieldType,
+    StrFieldType,
+    TOGGLE_STRINGS,
+    ToggleFieldType,
+    value_error_body,
+)
+from models import (
+    acquire_lease,
+    add_upload_refs,
+    bump_data_version,
+    ConfigMigration,
+    Contact,
+    db,
+    index_contact,
+    json_loads,
+    lease_holder,
+    MigrationFailure,
+    release_lease,
+    remove_upload_refs,
+)
+
+# Number of contacts migrated in a single transaction, so the write lock is never held for long
+DEFAULT_MIGRATION_BATCH_SIZE = 500
+# Seconds between two runs of the worker when it is not woken up by a change of the config
+DEFAULT_MIGRATION_INTERVAL = 60
+# Name of the lease of the worker running the migrations, and the seconds it holds it between two
+# batches before another worker can take over, if it died while migrating
+MIGRATION_LEASE = 'config-migration'
+LEASE_DURATION = 10 * 60
+
+# Number of contacts handled at once by a process during a dry run
+DRY_RUN_CHUNK_SIZE = 1000
+# Below this number of contacts, a dry run is faster without starting processes
+DRY_RUN_POOL_THRESHOLD = 20000
+# Number of ids of the contacts that would fail returned for each field
+DRY_RUN_SAMPLE_SIZE = 10
+
+RUNNING = 'running'
+DONE = 'done'
+
+# Attributes of the fields that change what their values must be
+VALUE_ATTRIBUTES = ('type', 'required', 'additional_type_parameters', 'default')
+
+_wakeup = Event()
+
+
+class MigrationRunningException(Exception):
+
+    def __init__(self, migration_id: int, *args: object) -> None:
+        self.code = 'MIGRATION_RUNNING'
+        self.migration_id = migration_id
+        super().__init__(*args)
+
+
+def diff_configs(old_config: dict, new_config: dict) -> dict:
+    """Return the fields removed from `old_config`, the ones added, and the attributes of the others
+    changing what their values must be
+    """
+    changed = {}
+    for name, params in new_config.items():
+        if name in old_config:
+            attributes = [
+                attribute for attribute in VALUE_ATTRIBUTES if old_config[name].get(attribute) != params.get(attribute)
+            ]
+            if attributes:
+                changed[name] = attributes
+    return {
+        "removed": [name for name in old_config if name not in new_config],
+        "added": [name for name in new_config if name not in old_config],
+        "changed": changed,
+    }
+
+
+def _to_integer(value: Any) -> Any:
+    if isinstance(value, float) and value.is_integer():
+        return int(value)
+    if isinstance(value, str):
+        try:
+            return int(value.strip())
+        except ValueError:
+            pass
+    return value
+
+def _to_str(value: Any) -> Any:
+    if isinstance(value, bool):
+        return 'true' if value else 'false'
+    if isinstance(value, (int, float)):
+        return str(value)
+    if isinstance(value, list):
+        # Same representation as the one of the form
+        return ', '.join(str(_to_str(item)) for item in value)
+    return value
+
+def _to_toggle(value: Any) -> Any:
+    if isinstance(value, str):
+        return TOGGLE_STRINGS.get(value.strip().lower(), value)
+    if isinstance(value, int) and value in (0, 1):
+        return bool(value)
+    return value
+
+def _list_converter(convert_item: Callable[[Any], Any]) -> Callable[[Any], Any]:
+    def convert(value: Any) -> Any:
+        if isinstance(value, str):
+            value = [item.strip() for item in value.split(',') if item.strip()]
+        elif not isinstance(value, list):
+            value = [value]
+        return [convert_item(item) for item in value]
+    return convert
+
+def _converter(field_type: Any, additional_params: dict) -> Callable[[Any], Any]:
+    """Return the function converting a value to `field_type` when it can be done without loss. The
+    values it can't convert are returned as is, and then reported by the validation.
+    """
+    if isinstance(field_type, IntegerFieldType):
+        return _to_integer
+    if isinstance(field_type, ToggleFieldType):
+        return _to_toggle
+    if isinstance(field_type, ListFieldType):
+        return _list_converter(_converter(FIELD_TYPE_MAPPING[additional_params['inner_type']], {}))
+    if isinstance(field_type, StrFieldType):
+        return _to_str
+    return lambda value: value
+
+
+class MigrationPlan:
+    """What to do to migrate the informations of a contact from `old_config` to `new_config`, with
+    everything that only depends on the configs computed beforehand
+    """
+    def __init__(self, old_config: dict, new_config: dict) -> None:
+        self.changes = diff_configs(old_config, new_config)
+        self.old_config, self.config = Config.from_dict(old_config), Config.from_dict(new_config)
+        self.touched = touched = self.changes['added'] + list(self.changes['changed'])
+        self.removed = frozenset(self.changes['removed'])
+        self.converters = tuple(
+            (name, _converter(field.field_type, field.additional_params))
+            for name, field in ((name, self.config.fields_by_name[name]) for name in self.changes['changed'])
+            if {'type', 'additional_type_parameters'} & set(self.changes['changed'][name])
+        )
+        self.defaults = tuple(
+            (name, new_config[name]['default']) for name in touched if new_config[name].get('default') is not None
+        )
+        # Only the values of the fields that changed are checked, the others are as valid as before
+        self.fields_to_skip = [field.name for field in self.config.fields if field.name not in touched]
+        self.check_primary_key = self.config.primary_key in touched
+        # The contacts are indexed again when the searchable fields change, even if left as they were
+        self.reindex = self.old_config.searchable_fields != self.config.searchable_fields
+
+    def is_empty(self) -> bool:
+        return not self.removed and not self.touched and not self.reindex
+
+    def apply(self, infos: dict) -> Tuple[dict, List[dict]]:
+        """Return the informations `infos` migrated to the new config, and their errors as returned
+        by the API
+        """
+        migrated = {name: value for name, value in infos.items() if name not in self.removed}
+        for name, convert in self.converters:
+            if migrated.get(name) is not None:
+                migrated[name] = convert(migrated[name])
+        for name, default in self.defaults:
+            if migrated.get(name) in (None, '', []):
+                migrated[name] = default
+        return migrated, [value_error_body(error) for error in self.config.validate(migrated, fields_to_skip=self.fields_to_skip)]
+
+
+# Plan of the last configs dry run by this process, to not compile it again for each chunk
+_dry_run_plan: Optional[Tuple[str, str, MigrationPlan]] = None
+
+def _add_dry_run_failure(report: dict, id_contact: int, error: dict) -> None:
+    field = report["fields"].setdefault(error["field"], {"failed": 0, "codes": {}, "sample_ids": []})
+    field["failed"] += 1
+    field["codes"][error["code"]] = field["codes"].get(error["code"], 0) + 1
+    if len(field["sample_ids"]) < DRY_RUN_SAMPLE_SIZE:
+        field["sample_ids"].append(id_contact)
+
+def _dry_run_chunk(old_config: str, new_config: str, rows: List[Tuple[int, str]]) -> dict:
+    global _dry_run_plan
+    if _dry_run_plan is None or _dry_run_plan[:2] != (old_config, new_config):
+        _dry_run_plan = (old_config, new_config, MigrationPlan(loads(old_config), loads(new_config)))
+    plan = _dry_run_plan[2]
+    report = {"total": len(rows), "migrated": 0, "failed": 0, "fields": {}, "keys": []}
+    for id_contact, infos in rows:
+        infos = json_loads(infos)
+        new_infos, errors = plan.apply(infos)
+        if not errors:
+            key = new_infos.get(plan.config.primary_key)
+            if plan.check_primary_key and key != infos.get(plan.config.primary_key):
+                # Checked against the saved contacts by `_check_dry_run_keys`, which needs the DB
+                report["keys"].append((id_contact, key))
+            elif new_infos != infos:
+                report["migrated"] += 1
+            continue
+        report["failed"] += 1
+        for error in errors:
+            _add_dry_run_failure(report, id_contact, error)
+    return report
+
+def _check_dry_run_keys(report: dict, config: Config, moved: Dict[str, int], left: Set[int]) -> dict:
+    """Count the contacts of the `report` of a chunk whose primary key would change as failing if
+    another contact would have their new key when migrated, as `run_migration_batch` does, and as
+    changed otherwise. `moved` has the new keys given by the previous chunks, with the ids of their
+    contacts, and `left` the ids of the contacts that don't have their saved key anymore.
+    """
+    keys = report.pop("keys")
+    if not keys:
+        return report
+    key_field = Contact.info_field(config.primary_key)
+    saved: Dict[str, Set[int]] = {}
+    for id_contact, key in db.session.query(Contact.id, key_field).filter(key_field.in_([key for _, key in keys])):
+        saved.setdefault(dumps(key), set()).add(id_contact)
+    for id_contact, key in keys:
+        key = dumps(key)
+        if key in moved or saved.get(key, set()) - left - {id_contact}:
+            report["failed"] += 1
+            _add_dry_run_failure(report, id_contact, {"field": config.primary_key, "code": 'DUPLICATE_VALUE'})
+        else:
+            report["migrated"] += 1
+            moved[key] = id_contact
+            left.add(id_contact)
+    field = report["fields"].get(config.primary_key)
+    if field is not None:
+        # The first ids whatever the error, the ones of the other errors were sampled first
+        field["sample_ids"] = sorted(field["sample_ids"])[:DRY_RUN_SAMPLE_SIZE]
+    return report
+
+def _merge_dry_run_reports(report: dict, other: dict) -> None:
+    for key in ("total", "migrated", "failed"):
+        report[key] += other[key]
+    for name, other_field in other["fields"].items():
+        field = report["fields"].setdefault(name, {"failed": 0, "codes": {}, "sample_ids": []})
+        field["failed"] += other_field["failed"]
+        for code, count in other_field["codes"].items():
+            field["codes"][code] = field["codes"].get(code, 0) + count
+        # The chunks are merged in order, the sample is the first ids
+        field["sample_ids"] = (field["sample_ids"] + other_field["sample_ids"])[:DRY_RUN_SAMPLE_SIZE]
+
+def _chunks(rows: Iterable[Tuple[int, str]], size: int) -> Iterator[List[Tuple[int, str]]]:
+    rows = iter(rows)
+    while True:
+        chunk = [tuple(row) for row in islice(rows, size)]
+        if not chunk:
+            return
+        yield chunk
+
+def dry_run_migration(
+        old_config: dict,
+        new_config: dict,
+        processes: int=1,
+        pool_threshold: int=DRY_RUN_POOL_THRESHOLD) -> dict:
+    """Return what migrating the saved contacts from `old_config` to `new_config` would do, without
+    changing anything: the number of contacts that would be changed, the number that would fail,
+    and for each field the number of failures by error code, with the ids of the first ones.
+
+    The contacts are streamed from the DB by chunks. With more than one process and more than
+    `pool_threshold` contacts, the chunks are validated by a pool of `processes` processes, which is
+    only meant for the command line (see `config.dry_run_config_file`), not to be forked from the
+    workers of the app.
+    """
+    old_json, new_json = dumps(old_config), dumps(new_config)
+    report = {"changes": diff_configs(old_config, new_config), "total": 0, "migrated": 0, "failed": 0, "fields": {}}
+    config, moved, left = Config.from_dict(new_config), {}, set()
+
+    def merge(chunk_report: dict) -> None:
+        _merge_dry_run_reports(report, _check_dry_run_keys(chunk_report, config, moved, left))
+
+    rows = db.session.query(Contact.id, Contact.infos).order_by(Contact.id).yield_per(DRY_RUN_CHUNK_SIZE)
+    chunks = _chunks(rows, DRY_RUN_CHUNK_SIZE)
+    if processes <= 1 or db.session.query(func.count(Contact.id)).scalar() <= pool_threshold:
+        for chunk in chunks:
+            merge(_dry_run_chunk(old_json, new_json, chunk))
+        return report
+
+    with ProcessPoolExecutor(max_workers=processes) as executor:
+        # Only a few chunks are submitted ahead, so the whole table is never loaded in memory
+        pending: deque = deque()
+        for chunk in chunks:
+            pending.append(executor.submit(_dry_run_chunk, old_json, new_json, chunk))
+            if len(pending) >= 2 * processes:
+                merge(pending.popleft().result())
+        while pending:
+            merge(pending.popleft().result())
+    return report
+
+
+def get_running_migration() -> Optional[ConfigMigration]:
+    return ConfigMigration.query.filter(ConfigMigration.status == RUNNING).order_by(ConfigMigration.id).first()
+
+def start_migration(connection: Connection, old_config: dict, new_config: dict) -> Optional[int]:
+    """Save the migration of the contacts from `old_config` to `new_config` in the transaction of
+    `connection`, to be run by `run_migrations`, and return its id. Return None if the contacts
+    don't need to be migrated.
+
+    Raise a MigrationRunningException if a previous migration is not done yet. The transaction must
+    hold the write lock (see `models.bump_data_version`), so that two migrations are never started
+    at once.
+    """
+    table, contacts = ConfigMigration.__table__, Contact.__table__
+    running = connection.execute(
+        select([table.c.id]).where(table.c.status == RUNNING).order_by(table.c.id).limit(1)
+    ).scalar()
+    if running is not None:
+        raise MigrationRunningException(running)
+    if MigrationPlan(old_config, new_config).is_empty():
+        return None
+    max_id, total = connection.execute(select([func.max(contacts.c.id), func.count(contacts.c.id)])).first()
+    if not total:
+        return None
+    return connection.execute(table.insert().values(
+        old_config=dumps(old_config),
+        new_config=dumps(new_config),
+        status=RUNNING,
+        max_id=max_id,
+        last_id=0,
+        total=total,
+        processed=0,
+        migrated=0,
+        failed=0,
+        started_at=datetime.utcnow(),
+    )).inserted_primary_key[0]
+
+def migration_status(migration: ConfigMigration, failures_limit: int) -> dict:
+    """Return the progress of `migration`, with the first `failures_limit` contacts that could not
+    be migrated
+    """
+    failures = MigrationFailure.query.filter(MigrationFailure.migration_id == migration.id) \
+        .order_by(MigrationFailure.contact_id).limit(failures_limit)
+    return {
+        "id": migration.id,
+        "status": migration.status,
+        "changes": diff_configs(loads(migration.old_config), loads(migration.new_config)),
+        "total": migration.total,
+        "processed": migration.processed,
+        "migrated": migration.migrated,
+        "failed": migration.failed,
+        "started_at": migration.started_at.isoformat() + 'Z',
+        "finished_at": migration.finished_at.isoformat() + 'Z' if migration.finished_at else None,
+        "failures": [{"id": failure.contact_id, "errors": loads(failure.errors)} for failure in failures],
+    }
+
+
+def _file_values(infos: dict, config: Config) -> List[str]:
+    return [infos[field] for field in config.file_fields if isinstance(infos.get(field), str) and infos[field]]
+
+def run_migration_batch(batch_size: int=DEFAULT_MIGRATION_BATCH_SIZE) -> bool:
+    """Migrate the next `batch_size` contacts of the running migration, in a single transaction.
+    Contacts that cannot be migrated are left as they were, and recorded as failures.
+
+    Return whether there are contacts left to migrate.
+    """
+    if get_running_migration() is None:
+        return False
+    table, contacts = ConfigMigration.__table__, Contact.__table__
+    files_released = False
+    with db.engine.begin() as connection:
+        # Written first, to hold the write lock while reading the progress and the contacts, so that
+        # they can't change before the commit. The row of the migration is locked too, so that two
+        # batches never run at once even if started out of the worker.
+        version = bump_data_version(connection)
+        migration = connection.execute(
+            table.select().where(table.c.status == RUNNING).order_by(table.c.id).limit(1).with_for_update()
+        ).first()
+        if migration is None:
+            return False
+        plan = MigrationPlan(loads(migration.old_config), loads(migration.new_config))
+        rows = connection.execute(
+            select([contacts.c.id, contacts.c.infos])
+            .where(and_(contacts.c.id > migration.last_id, contacts.c.id <= migration.max_id))
+            .order_by(contacts.c.id)
+            .limit(batch_size)
+        ).fetchall()
+
+        migrated, failures = 0, []
+        key_field = Contact.info_field(plan.config.primary_key) if plan.check_primary_key else None
+        for id_contact, infos in rows:
+            infos = json_loads(infos)
+            new_infos, errors = plan.apply(infos)
+            key = new_infos.get(plan.config.primary_key)
+            if not errors and key_field is not None and key != infos.get(plan.config.primary_key) and connection.execute(
+                select([contacts.c.id]).where(and_(key_field == key, contacts.c.id != id_contact)).limit(1)
+            ).first():
+                errors = [{"field": plan.config.primary_key, "code": 'DUPLICATE_VALUE', "value": key}]
+            if errors:
+                failures.append({
+                    'migration_id': migration.id,
+                    'contact_id': id_contact,
+                    'errors': dumps(errors),
+                })
+                new_infos = infos
+            if new_infos == infos:
+                if plan.reindex:
+                    index_contact(connection, id_contact, infos, plan.config)
+                continue
+            connection.execute(
+                contacts.update().where(contacts.c.id == id_contact)
+                .values(infos=dumps(new_infos), updated_version=version, updated_at=datetime.utcnow())
+            )
+            index_contact(connection, id_contact, new_infos, plan.config)
+            old_files, new_files = _file_values(infos, plan.old_config), _file_values(new_infos, plan.config)
+            add_upload_refs(connection, [value for value in new_files if value not in old_files])
+            files_released |= remove_upload_refs(connection, [value for value in old_files if value not in new_files])
+            migrated += 1
+        if failures:
+            connection.execute(MigrationFailure.__table__.insert(), failures)
+
+        done = len(rows) < batch_size
+        connection.execute(table.update().where(table.c.id == migration.id).values(
+            last_id=rows[-1].id if rows else migration.last_id,
+            processed=table.c.processed + len(rows),
+            migrated=table.c.migrated + migrated,
+            failed=table.c.failed + len(failures),
+            status=DONE if done else RUNNING,
+            finished_at=datetime.utcnow() if done else None,
+        ))
+    if files_released:
+        wake_up_cleanup_worker()
+    return not done
+
+def run_migrations(batch_size: Optional[int]=None, holder: Optional[str]=None) -> None:
+    """Run the pending migrations until they are done, batch by batch. With a `holder`, its lease
+    of the migrations is extended before each batch, and the run stops if it lost it.
+    """
+    batch_size = batch_size or int(os.environ.get('CONFIG_MIGRATION_BATCH_SIZE', DEFAULT_MIGRATION_BATCH_SIZE))
+    while (holder is None or acquire_lease(MIGRATION_LEASE, holder, LEASE_DURATION)) and run_migration_batch(batch_size):
+        pass
+
+
+def wake_up_migration_worker() -> None:
+    _wakeup.set()
+
+def start_migration_worker(app: Flask) -> Optional[Thread]:
+    """Start the thread running the migrations, woken up when one is started. The migrations left
+    running by a previous run of the app are resumed.
+
+    The thread is started by every worker of the app, but a single one migrates at a time, see
+    `models.acquire_lease`. Set CONFIG_MIGRATION_INTERVAL to 0 to not start it.
+    """
+    interval = float(os.environ.get('CONFIG_MIGRATION_INTERVAL', DEFAULT_MIGRATION_INTERVAL))
+    if interval <= 0:
+        return None
+    thread = Thread(target=_run_worker, args=(app, interval), name='config-migration', daemon=True)
+    thread.start()
+    return thread
+
+def _run_worker(app: Flask, interval: float) -> None:
+    holder = lease_holder()
+    while True:
+        _wakeup.clear()
+        with app.app_context():
+            try:
+                if acquire_lease(MIGRATION_LEASE, holder, LEASE_DURATION):
+                    try:
+                        run_migrations(holder=holder)
+                    finally:
+                        release_lease(MIGRATION_LEASE, holder)
+            except Exception:
+                # Resumed from the last batch committed on the next run
+                app.logger.exception('Cannot migrate the contacts to the new config')
+            finally:
+                db.session.remove()
+        _wakeup.wait(interval)
@@ -1,37 +1,724 @@
-from json import loads
+from datetime import datetime, timedelta
+from hashlib import sha1
+from json import dumps, loads
+from json.decoder import scanstring
 import os
+import re
+import socket
+import unicodedata
+from typing import Any, Callable, Dict, Iterable, List, Optional, Tuple
 
 from dotenv import load_dotenv
+from flask import current_app
 from flask_sqlalchemy import SQLAlchemy
-from sqlalchemy import event
+from sqlalchemy import and_, Boolean, event, func, inspect, literal, or_, String, text
+from sqlalchemy.dialects import postgresql
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.ext.compiler import compiles
 from sqlalchemy.orm import Mapper
 from sqlalchemy.engine import Connection
+from sqlalchemy.sql.expression import ColumnElement, FunctionElement
+from sqlalchemy.types import TypeDecorator, UserDefinedType
 
-from config import (
-    Config,
-    FILE_FIELDS,
-)
+from config import Config, get_config
+
+try:
+    # Optional faster JSON backend, used when a stored JSON has to be parsed
+    import orjson
+    json_loads: Callable[[str], Any] = orjson.loads
+    def json_dumps(value: Any) -> str:
+        return orjson.dumps(value).decode()
+except ImportError:
+    json_loads = loads
+    json_dumps = dumps
 
 # Load .env file in the env variables
 load_dotenv()
 
 db = SQLAlchemy()
 
+
+class _JSONB(UserDefinedType):
+    # Without the processing of `postgresql.JSONB`, the documents are exchanged as strings
+    def get_col_spec(self, **_kwargs) -> str:
+        return 'JSONB'
+
+class JSONText(TypeDecorator):
+    """JSON document handled as a string: stored as is in SQLite, and as JSONB in PostgreSQL, whose
+    documents are then read as strings too (see `database.py`)
+    """
+    impl = String
+
+    def load_dialect_impl(self, dialect):
+        return dialect.type_descriptor(_JSONB() if dialect.name == 'postgresql' else String())
+
+class JSONValue(TypeDecorator):
+    """Value of a field extracted from `Contact.infos`, compared with Python values. SQLite returns
+    the SQL values of the JSON ones, PostgreSQL returns JSONB values, which are compared with JSONB.
+    """
+    impl = String
+
+    def bind_expression(self, bindvalue):
+        return _JSONBind(bindvalue)
+
+    def process_bind_param(self, value: Any, dialect) -> Any:
+        return dumps(value) if dialect.name == 'postgresql' else value
+
+    def process_result_value(self, value: Any, dialect) -> Any:
+        return json_loads(value) if dialect.name == 'postgresql' and value is not None else value
+
+class _JSONBind(ColumnElement):
+
+    def __init__(self, bindvalue) -> None:
+        self.bindvalue = bindvalue
+        self.type = bindvalue.type
+
+@compiles(_JSONBind)
+def _compile_json_bind(element, compiler, **kwargs):
+    return compiler.process(element.bindvalue, **kwargs)
+
+@compiles(_JSONBind, 'postgresql')
+def _compile_json_bind_postgresql(element, compiler, **kwargs):
+    return f'CAST({compiler.process(element.bindvalue, **kwargs)} AS JSONB)'
+
+
+class _InfoField(FunctionElement):
+    """Value of the field `field_name` in `infos`, as a JSON value or as text. The name is rendered
+    as a literal and not as a bound parameter, otherwise the databases cannot match the expression
+    against the key indexes (see `sync_key_indexes`).
+    """
+    name = 'info_field'
+
+    def __init__(self, infos, field_name: str, as_text: bool=False) -> None:
+        self.field_name = field_name
+        self.as_text = as_text
+        self.type = String() if as_text else JSONValue()
+        super().__init__(infos)
+
+@compiles(_InfoField)
+def _compile_info_field(element, compiler, **kwargs):
+    return f'json_extract({compiler.process(element.clauses, **kwargs)}, {_json_path_literal(element.field_name)})'
+
+@compiles(_InfoField, 'postgresql')
+def _compile_info_field_postgresql(element, compiler, **kwargs):
+    operator = '->>' if element.as_text else '->'
+    return f'({compiler.process(element.clauses, **kwargs)} {operator} {_string_literal(element.field_name)})'
+
+class _InfoContains(ColumnElement):
+    """Whether the field `field_name` of `infos` is `value`, or contains the item `value` if
+    `in_list`. PostgreSQL checks it with the containment operator, usable by the GIN index of
+    `infos` (see `create_infos_index`).
+    """
+    type = Boolean()
+    # Otherwise compared with 1 where booleans are integers, which hides the expression from SQLite
+    _is_implicitly_boolean = True
+
+    def __init__(self, infos, field_name: str, value: Any, in_list: bool=False) -> None:
+        self.infos = infos
+        self.field_name = field_name
+        self.value = value
+        self.in_list = in_list
+
+    @property
+    def _from_objects(self) -> list:
+        return self.infos._from_objects
+
+@compiles(_InfoContains)
+def _compile_info_contains(element, compiler, **kwargs):
+    value = compiler.process(literal(element.value), **kwargs)
+    if element.in_list:
+        infos = compiler.process(element.infos, **kwargs)
+        return (
+            f'EXISTS (SELECT 1 FROM json_each({infos}, {_json_path_literal(element.field_name)}) '
+            f'WHERE json_each.value = {value})'
+        )
+    return f'{compiler.process(_InfoField(element.infos, element.field_name), **kwargs)} = {value}'
+
+@compiles(_InfoContains, 'postgresql')
+def _compile_info_contains_postgresql(element, compiler, **kwargs):
+    document = {element.field_name: [element.value] if element.in_list else element.value}
+    return f'{compiler.process(element.infos, **kwargs)} @> {compiler.process(literal(document, JSONValue()), **kwargs)}'
+
+
 class Contact(db.Model):
     id = db.Column(db.Integer(), primary_key=True)
-    infos = db.Column(db.String())
+    infos = db.Column(JSONText())
     inserted_timestamp = db.Column(db.DateTime())
+    # Version of the data when the contact was last inserted or updated, and when it was (in UTC)
+    updated_version = db.Column(db.Integer(), nullable=False, default=0, server_default='0', index=True)
+    updated_at = db.Column(db.DateTime())
+
+    @staticmethod
+    def info_field(name: str):
+        """SQL expression extracting the value of the field `name` from the JSON stored in `infos`,
+        comparable with Python values
+        """
+        return _InfoField(Contact.infos, name)
+
+    @staticmethod
+    def info_text(name: str):
+        """Same as `info_field`, but the value as text, for the string functions"""
+        return _InfoField(Contact.infos, name, as_text=True)
+
+    @staticmethod
+    def info_equals(name: str, value: Any):
+        """SQL condition matching the contacts whose value of the field `name` is `value`"""
+        return _InfoContains(Contact.infos, name, value)
+
+    @staticmethod
+    def info_contains(name: str, item: Any):
+        """SQL condition matching the contacts whose list of the field `name` contains `item`"""
+        return _InfoContains(Contact.infos, name, item, in_list=True)
 
     def format_infos(self):
-        infos = loads(self.infos)
+        infos = json_loads(self.infos)
         infos['id'] = self.id
         return infos
 
+    def format_infos_json(
+            self,
+            file_fields: Iterable[str]=(),
+            file_url: Optional[Callable[[str], str]]=None,
+            variant_urls: Optional[Callable[[str], Optional[dict]]]=None,
+            variants_key: str='') -> str:
+        """Same as `format_infos`, but directly as JSON. See `infos_to_json`"""
+        return infos_to_json(self.id, self.infos, file_fields, file_url, variant_urls, variants_key)
+
+
+class DataVersion(db.Model):
+    """Single row table holding the version of the data, increased on every change of a contact"""
+    id = db.Column(db.Integer(), primary_key=True)
+    version = db.Column(db.Integer(), nullable=False)
+    updated_at = db.Column(db.DateTime(), nullable=False)
+
+@event.listens_for(DataVersion.__table__, 'after_create')
+def init_data_version(target, connection: Connection, **_kwargs):
+    connection.execute(target.insert(), id=1, version=0, updated_at=datetime.utcnow())
+
+def get_data_version() -> Tuple[int, datetime]:
+    """Return the current version of the data, and when (in UTC) it was last increased"""
+    row = db.session.query(DataVersion.version, DataVersion.updated_at).filter(DataVersion.id == 1).one()
+    return row.version, row.updated_at
+
+def bump_data_version(connection: Connection) -> int:
+    """Increase the version of the data, in the transaction of `connection`, and return it"""
+    table = DataVersion.__table__
+    connection.execute(
+        table.update().where(table.c.id == 1).values(version=table.c.version + 1, updated_at=datetime.utcnow())
+    )
+    return connection.execute(table.select().with_only_columns([table.c.version]).where(table.c.id == 1)).scalar()
+
+
+class DeletedContact(db.Model):
+    """Tombstone of a deleted contact, with the version of the data it was deleted at"""
+    id = db.Column(db.Integer(), primary_key=True)
+    deleted_version = db.Column(db.Integer(), nullable=False, index=True)
+
+def record_inserted(connection: Connection, ids: List[int]) -> None:
+    # SQLite can give the id of a deleted contact to a new one, it's not deleted anymore
+    table = DeletedContact.__table__
+    connection.execute(table.delete().where(table.c.id.in_(ids)))
+
+def upgrade_schema() -> None:
+    """Add the columns missing from a DB created by an older version"""
+    columns = {column['name'] for column in inspect(db.engine).get_columns(Contact.__tablename__)}
+    if 'updated_version' not in columns:
+        with db.engine.begin() as connection:
+            connection.execute(
+                f'ALTER TABLE {Contact.__tablename__} ADD COLUMN updated_version INTEGER NOT NULL DEFAULT 0'
+            )
+            for index in Contact.__table__.indexes:
+                if 'updated_version' in index.columns:
+                    index.create(connection)
+    if 'updated_at' not in columns:
+        with db.engine.begin() as connection:
+            connection.execute(f'ALTER TABLE {Contact.__tablename__} ADD COLUMN updated_at TIMESTAMP')
+            # Not known, as if they were all changed now
+            connection.execute(Contact.__table__.update().values(updated_at=datetime.utcnow()))
+
+
+def infos_to_json(
+        id_contact: int,
+        infos: str,
+        file_fields: Iterable[str]=(),
+        file_url: Optional[Callable[[str], str]]=None,
+        variant_urls: Optional[Callable[[str], Optional[dict]]]=None,
+        variants_key: str='') -> str:
+    """Return the JSON of the stored `infos` with the `id` added, and the value of each one of the
+    `file_fields` replaced by `file_url(value)`. When `variant_urls` is given, the URLs it returns
+    for the values of the file fields are added under `variants_key`, by field.
+
+    The stored JSON is an object written by `json.dumps`, so the id can be spliced in the text right
+    after the opening brace, and the values of the file fields replaced in place, without parsing
+    it. This is only done when there is no nested object, so every '"key": ' found out of a string
+    is one of the top level, and when there is no 'id' already, otherwise the JSON is parsed.
+    """
+    if not infos.startswith('{') or infos.count('{') != 1 or '"id": ' in infos:
+        parsed = json_loads(infos)
+        variants = {}
+        if file_url:
+            for field in file_fields:
+                if parsed.get(field):
+                    if variant_urls and isinstance(parsed[field], str):
+                        variants[field] = variant_urls(parsed[field])
+                    parsed[field] = file_url(parsed[field])
+        parsed['id'] = id_contact
+        variants = {field: urls for field, urls in variants.items() if urls}
+        if variants:
+            parsed[variants_key] = variants
+        return json_dumps(parsed)
+
+    variants = {}
+    if file_url:
+        for field in file_fields:
+            key = dumps(field) + ': "'
+            position = infos.find(key)
+            if position != -1:
+                start = position + len(key)
+                value, end = scanstring(infos, start)
+                if value:
+                    urls = variant_urls(value) if variant_urls else None
+                    if urls:
+                        variants[field] = urls
+                    infos = infos[:start - 1] + dumps(file_url(value)) + infos[end:]
+    if variants:
+        infos = f'{infos[:-1]}, {dumps(variants_key)}: {dumps(variants)}}}'
+    return f'{{"id": {id_contact}, {infos[1:]}' if infos != '{}' else f'{{"id": {id_contact}}}'
+
+def _string_literal(value: str) -> str:
+    return "'{}'".format(value.replace("'", "''"))
+
+def _json_path_literal(name: str) -> str:
+    return _string_literal('$."{}"'.format(name.replace('"', '\\"')))
+
+@event.listens_for(Contact.__table__, 'after_create')
+def create_infos_index(target, connection: Connection, **_kwargs):
+    if connection.dialect.name == 'postgresql':
+        # Index of the containment operator @>, used by the filters on the values of the fields
+        connection.execute(
+            f'CREATE INDEX IF NOT EXISTS ix_{target.name}_infos ON {target.name} USING GIN (infos jsonb_path_ops)'
+        )
+
+
+KEY_INDEX_PREFIX = 'ix_contact_key_'
+
+
+class DuplicateValueException(Exception):
+
+    def __init__(self, field: str, value: Any, *args: object) -> None:
+        self.code = 'DUPLICATE_VALUE'
+        self.field = field
+        self.value = value
+        super().__init__(*args)
+
+
+def key_indexes(config: Config, dialect: str) -> Dict[str, Tuple[bool, str]]:
+    """Return the indexes to create on the fields marked as 'sort_key', 'main_attribute' or
+    'primary_key' in `config`, as a mapping of the name of the index to whether it is unique and
+    its definition for the database `dialect`.
+
+    The indexes are built over the values extracted from `infos`, so they are kept up to date by the
+    database on every write, the same way a generated column would be.
+    """
+    table = Contact.__tablename__
+    if dialect == 'postgresql':
+        # In the order of the listing, that puts the missing values first like SQLite does
+        def expression(name: str, ordered: bool=True) -> str:
+            return f'(infos -> {_string_literal(name)}){" NULLS FIRST" if ordered else ""}'
+    else:
+        def expression(name: str, ordered: bool=True) -> str:
+            return f'json_extract(infos, {_json_path_literal(name)})'
+    definitions = []
+    if config.sort_keys:
+        # Single index over all the sort keys, with the id last to match the ORDER BY of the listing
+        columns = [expression(name) for name in config.sort_keys]
+        definitions.append((False, f'ON {table} ({", ".join(columns)}, id)'))
+    for name in config.main_attributes:
+        if name != config.primary_key:
+            definitions.append((False, f'ON {table} ({expression(name)})'))
+    if config.primary_key:
+        # Enforce the uniqueness of the primary key
+        definitions.append((True, f'ON {table} ({expression(config.primary_key, ordered=False)})'))
+    # Name the indexes after their definition, so a changed definition means a new index
+    return {
+        KEY_INDEX_PREFIX + sha1((('UNIQUE ' if unique else '') + definition).encode()).hexdigest()[:16]: (unique, definition)
+        for unique, definition in definitions
+    }
+
+def is_duplicate_key_error(error: IntegrityError) -> bool:
+    """Whether the write that failed with `error` was rejected by the index of the primary key, the
+    only unique one of the key indexes, and not by another constraint
+    """
+    return KEY_INDEX_PREFIX in str(error.orig)
+
+# Config for which the key indexes were last synced by this process
+_KEY_INDEXES_SYNCED_FOR = None  # type: Optional[Config]
+
+def sync_key_indexes(config: Config) -> None:
+    """Create the missing key indexes of `config`, and drop the ones not needed anymore.
+
+    Raises `DuplicateValueException` if the primary key index cannot be created because some
+    contacts share the same value. In this case the other indexes of `config` are still created, and
+    the indexes not needed anymore are kept.
+    """
+    expected = key_indexes(config, db.engine.dialect.name)
+    # The indexes that cannot fail are created in their own transaction, so they are not rolled back
+    # with the primary key index
+    with db.engine.begin() as connection:
+        existing = {row[0] for row in connection.execute(
+            text(
+                "SELECT indexname FROM pg_indexes WHERE tablename = :table AND indexname LIKE :prefix"
+                if connection.dialect.name == 'postgresql' else
+                "SELECT name FROM sqlite_master WHERE type = 'index' AND tbl_name = :table AND name LIKE :prefix"
+            ),
+            table=Contact.__tablename__,
+            prefix=KEY_INDEX_PREFIX + '%',
+        )}
+        for name in expected.keys() - existing:
+            unique, definition = expected[name]
+            if not unique:
+                connection.execute(f'CREATE INDEX IF NOT EXISTS "{name}" {definition}')
+    # Create the primary key index before dropping anything, so nothing is dropped if it cannot be
+    # created
+    with db.engine.begin() as connection:
+        for name in expected.keys() - existing:
+            unique, definition = expected[name]
+            if not unique:
+                continue
+            try:
+                connection.execute(f'CREATE UNIQUE INDEX IF NOT EXISTS "{name}" {definition}')
+            except IntegrityError:
+                field = Contact.info_field(config.primary_key)
+                value = db.session.query(field).group_by(field).having(func.count() > 1).limit(1).scalar()
+                raise DuplicateValueException(config.primary_key, value)
+        for name in existing - expected.keys():
+            connection.execute(f'DROP INDEX IF EXISTS "{name}"')
+    global _KEY_INDEXES_SYNCED_FOR
+    _KEY_INDEXES_SYNCED_FOR = config
+
+def ensure_key_indexes(config: Config) -> None:
+    """Sync the key indexes if `config` is not the one they were last synced with.
+
+    Contacts saved before the primary key was enforced can have duplicated values, in which case the
+    primary key index is left out, and the error is only logged to keep serving the contacts.
+    """
+    global _KEY_INDEXES_SYNCED_FOR
+    if _KEY_INDEXES_SYNCED_FOR is not config:
+        try:
+            sync_key_indexes(config)
+        except DuplicateValueException as exp:
+            current_app.logger.warning(
+                f'Cannot enforce the uniqueness of "{exp.field}", duplicated value: {exp.value}'
+            )
+            _KEY_INDEXES_SYNCED_FOR = config
+
+@event.listens_for(Contact.__table__, 'after_create')
+def reset_key_indexes_on_create(*_args, **_kwargs):
+    # The table was (re)created without any key index
+    global _KEY_INDEXES_SYNCED_FOR
+    _KEY_INDEXES_SYNCED_FOR = None
+
+
+SEARCH_TABLE = 'contact_search'
+# Text search configuration of PostgreSQL, without stemming to match prefixes of the words as typed
+SEARCH_CONFIGURATION = 'simple'
+
+def _create_search_table(connection: Connection) -> None:
+    if connection.dialect.name == 'postgresql':
+        connection.execute(f'CREATE TABLE IF NOT EXISTS {SEARCH_TABLE} (rowid INTEGER PRIMARY KEY, content TEXT NOT NULL)')
+        connection.execute(
+            f'CREATE INDEX IF NOT EXISTS ix_{SEARCH_TABLE}_content ON {SEARCH_TABLE} '
+            f"USING GIN (to_tsvector('{SEARCH_CONFIGURATION}', content))"
+        )
+        return
+    # Prefix indexes on 2 and 3 characters make the type-ahead queries cheap
+    connection.execute(
+        f"CREATE VIRTUAL TABLE IF NOT EXISTS {SEARCH_TABLE} USING fts5("
+        "content, tokenize='unicode61 remove_diacritics 2', prefix='2 3')"
+    )
+
+def _fold_diacritics(value: str) -> str:
+    # Done by the tokenizer of SQLite, PostgreSQL needs the unaccent extension for it
+    return ''.join(char for char in unicodedata.normalize('NFKD', value) if not unicodedata.combining(char))
+
+def search_content(infos: dict, config: Config) -> str:
+    """Text indexed for the contact with the informations `infos`, built from the values of the
+    searchable fields of `config`
+    """
+    values = []
+    for field in config.searchable_fields:
+        value = infos.get(field)
+        for item in (value if isinstance(value, list) else [value]):
+            if isinstance(item, str) and item:
+                values.append(item)
+    return '\n'.join(values)
+
+def insert_search_rows(connection: Connection, rows: List[dict]) -> None:
+    """Index the contacts of `rows`, dicts with their `id` and their `content`"""
+    if connection.dialect.name == 'postgresql':
+        rows = [dict(row, content=_fold_diacritics(row['content'])) for row in rows]
+    connection.execute(text(f'INSERT INTO {SEARCH_TABLE} (rowid, content) VALUES (:id, :content)'), rows)
+
+def index_contact(connection: Connection, id_contact: int, infos: dict, config: Config) -> None:
+    """Index again the contact `id_contact`, with its new informations `infos`"""
+    connection.execute(text(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = :id'), id=id_contact)
+    content = search_content(infos, config)
+    if content:
+        insert_search_rows(connection, [{'id': id_contact, 'content': content}])
+
+def rebuild_search_index(config: Config) -> int:
+    """Index again all the contacts with the searchable fields of `config`, to use when these
+    fields changed. Returns the number of contacts indexed.
+    """
+    count = 0
+    with db.engine.begin() as connection:
+        _create_search_table(connection)
+        connection.execute(f'DELETE FROM {SEARCH_TABLE}')
+        rows = connection.execute(Contact.__table__.select().with_only_columns([Contact.id, Contact.infos]))
+        for id_contact, infos in rows:
+            content = search_content(loads(infos), config)
+            if content:
+                insert_search_rows(connection, [{'id': id_contact, 'content': content}])
+            count += 1
+    return count
+
+def ensure_search_index(config: Config) -> None:
+    """Create and fill the search index if it doesn't exist yet, ie. on a DB created before it"""
+    if not db.engine.has_table(SEARCH_TABLE):
+        rebuild_search_index(config)
+
+def search_contacts(query: str, limit: int) -> List[Contact]:
+    """Return the contacts matching all the words of `query`, each one used as a prefix, ordered
+    by relevance
+    """
+    # Quote every word, so characters of the query syntax in the input are not interpreted
+    words = re.findall(r'\w+', query)
+    if not words:
+        return []
+    if db.engine.dialect.name == 'postgresql':
+        match = ' & '.join("'{}':*".format(word) for word in _fold_diacritics(' '.join(words)).split())
+        document = f"to_tsvector('{SEARCH_CONFIGURATION}', content)"
+        query_ = f"to_tsquery('{SEARCH_CONFIGURATION}', :match)"
+        statement = (
+            f'SELECT rowid FROM {SEARCH_TABLE} WHERE {document} @@ {query_} '
+            f'ORDER BY ts_rank({document}, {query_}) DESC, rowid LIMIT :limit'
+        )
+    else:
+        match = ' '.join('"{}"*'.format(word) for word in words)
+        statement = f'SELECT rowid FROM {SEARCH_TABLE} WHERE {SEARCH_TABLE} MATCH :match ORDER BY rank LIMIT :limit'
+    ids = [row[0] for row in db.session.execute(text(statement), {'match': match, 'limit': limit})]
+    contacts = {contact.id: contact for contact in Contact.query.filter(Contact.id.in_(ids))}
+    return [contacts[id_contact] for id_contact in ids if id_contact in contacts]
+
+@event.listens_for(Contact.__table__, 'after_create')
+def create_search_table(_target, connection: Connection, **_kwargs):
+    _create_search_table(connection)
+
+@event.listens_for(Contact.__table__, 'after_drop')
+def drop_search_table(_target, connection: Connection, **_kwargs):
+    connection.execute(f'DROP TABLE IF EXISTS {SEARCH_TABLE}')
+
+@event.listens_for(Contact, 'after_insert')
+@event.listens_for(Contact, 'after_update')
+def index_contact_on_save(_mapper: Mapper, connection: Connection, target: Contact):
+    index_contact(connection, target.id, loads(target.infos), get_config())
+
+@event.listens_for(Contact, 'after_delete')
+def unindex_contact_on_delete(_mapper: Mapper, connection: Connection, target: Contact):
+    connection.execute(text(f'DELETE FROM {SEARCH_TABLE} WHERE rowid = :id'), id=target.id)
+
+@event.listens_for(Contact, 'before_insert')
+@event.listens_for(Contact, 'before_update')
+def bump_data_version_on_save(_mapper: Mapper, connection: Connection, target: Contact):
+    target.updated_version = bump_data_version(connection)
+    target.updated_at = datetime.utcnow()
+
+@event.listens_for(Contact, 'after_insert')
+def forget_deleted_on_insert(_mapper: Mapper, connection: Connection, target: Contact):
+    record_inserted(connection, [target.id])
+
+@event.listens_for(Contact, 'after_delete')
+def record_deleted_on_delete(_mapper: Mapper, connection: Connection, target: Contact):
+    table = DeletedContact.__table__
+    connection.execute(table.delete().where(table.c.id == target.id))
+    connection.execute(table.insert(), id=target.id, deleted_version=bump_data_version(connection))
+
+
+class ConfigMigration(db.Model):
+    """Migration of the contacts saved before a change of the config to the new one, run in the
+    background by batches (see `migrations.py`)
+    """
+    id = db.Column(db.Integer(), primary_key=True)
+    old_config = db.Column(db.String(), nullable=False)
+    new_config = db.Column(db.String(), nullable=False)
+    status = db.Column(db.String(), nullable=False)
+    # Contacts with a greater id were saved with the new config
+    max_id = db.Column(db.Integer(), nullable=False)
+    # Id of the last contact migrated, to resume from there
+    last_id = db.Column(db.Integer(), nullable=False, default=0)
+    total = db.Column(db.Integer(), nullable=False)
+    processed = db.Column(db.Integer(), nullable=False, default=0)
+    migrated = db.Column(db.Integer(), nullable=False, default=0)
+    failed = db.Column(db.Integer(), nullable=False, default=0)
+    started_at = db.Column(db.DateTime(), nullable=False)
+    finished_at = db.Column(db.DateTime())
+
+class MigrationFailure(db.Model):
+    """Contact that could not be migrated to the new config, left as it was"""
+    migration_id = db.Column(db.Integer(), db.ForeignKey(ConfigMigration.id), primary_key=True)
+    contact_id = db.Column(db.Integer(), primary_key=True)
+    # JSON list of the errors, as returned by the API
+    errors = db.Column(db.String(), nullable=False)
+
+
+class WorkerLease(db.Model):
+    """Lease of a background task, so that a single process of the app runs it at a time even when
+    it is started by every worker, possibly on several machines
+    """
+    name = db.Column(db.String(), primary_key=True)
+    holder = db.Column(db.String(), nullable=False)
+    expires_at = db.Column(db.DateTime(), nullable=False)
+
+def lease_holder() -> str:
+    """Name of this process among the ones holding the leases, computed on every call as the workers
+    are forked after the import
+    """
+    return f'{socket.gethostname()}:{os.getpid()}'
+
+def acquire_lease(name: str, holder: str, duration: float) -> bool:
+    """Take the lease `name` for `duration` seconds if it is free or expired, or extend it if
+    `holder` has it already. Return whether `holder` has it.
+    """
+    table = WorkerLease.__table__
+    now = datetime.utcnow()
+    expires_at = now + timedelta(seconds=duration)
+    with db.engine.begin() as connection:
+        result = connection.execute(
+            table.update()
+            .where(and_(table.c.name == name, or_(table.c.holder == holder, table.c.expires_at < now)))
+            .values(holder=holder, expires_at=expires_at)
+        )
+        if result.rowcount:
+            return True
+        if connection.execute(table.select().where(table.c.name == name)).first() is not None:
+            return False
+    try:
+        with db.engine.begin() as connection:
+            connection.execute(table.insert(), name=name, holder=holder, expires_at=expires_at)
+        return True
+    except IntegrityError:
+        # Taken by another process in the meantime
+        return False
+
+def release_lease(name: str, holder: str) -> None:
+    table = WorkerLease.__table__
+    with db.engine.begin() as connection:
+        connection.execute(table.delete().where(and_(table.c.name == name, table.c.holder == holder)))
+
+
+class UploadRef(db.Model):
+    """Number of references from the contacts to an uploaded file"""
+    filename = db.Column(db.String(), primary_key=True)
+    count = db.Column(db.Integer(), nullable=False)
+
+def _file_values(infos: Optional[str], config: Config) -> List[str]:
+    if not infos:
+        return []
+    infos = json_loads(infos)
+    return [infos[field] for field in config.file_fields if isinstance(infos.get(field), str) and infos[field]]
+
+def add_upload_refs(connection: Connection, filenames: Iterable[str]) -> None:
+    table = UploadRef.__table__
+    for filename in filenames:
+        if connection.dialect.name == 'postgresql':
+            # Two transactions adding the first reference to the same file can't both insert it
+            connection.execute(
+                postgresql.insert(table).values(filename=filename, count=1)
+                .on_conflict_do_update(index_elements=[table.c.filename], set_={'count': table.c.count + 1})
+            )
+            continue
+        # SQLite holds the write lock from the UPDATE on, nothing can be inserted in between
+        result = connection.execute(
+            table.update().where(table.c.filename == filename).values(count=table.c.count + 1)
+        )
+        if result.rowcount == 0:
+            connection.execute(table.insert(), filename=filename, count=1)
+
+def remove_upload_refs(connection: Connection, filenames: Iterable[str]) -> bool:
+    """Remove a reference to each one of `filenames`, and queue the removal of the files not
+    referenced anymore. Return whether any was queued.
+    """
+    table = UploadRef.__table__
+    queued = False
+    for filename in filenames:
+        connection.execute(table.update().where(table.c.filename == filename).values(count=table.c.count - 1))
+        count = connection.execute(
+            table.select().with_only_columns([table.c.count]).where(table.c.filename == filename)
+        ).scalar()
+        # No row means a file uploaded before the references were counted, only used by this contact
+        if count is None or count <= 0:
+            connection.execute(table.delete().where(table.c.filename == filename))
+            queue_file_removal(connection, filename)
+            queued = True
+    return queued
+
+class PendingFileRemoval(db.Model):
+    """Uploaded file not referenced anymore, removed from the disk by the cleanup worker once the
+    transaction releasing it is committed (see `cleanup.py`)
+    """
+    filename = db.Column(db.String(), primary_key=True)
+    queued_at = db.Column(db.DateTime(), nullable=False)
+
+# Set in `Session.info` when a flush queued files to remove, to wake up the cleanup worker on commit
+FILE_REMOVALS_QUEUED = 'file_removals_queued'
+
+def queue_file_removal(connection: Connection, filename: str) -> None:
+    table = PendingFileRemoval.__table__
+    connection.execute(table.delete().where(table.c.filename == filename))
+    connection.execute(table.insert(), filename=filename, queued_at=datetime.now())
+
+def _flag_file_removals(target: Contact) -> None:
+    session = inspect(target).session
+    if session is not None:
+        session.info[FILE_REMOVALS_QUEUED] = True
+
+def rebuild_upload_refs(config: Config) -> None:
+    """Count again the references to the uploaded files from all the contacts"""
+    counts: Dict[str, int] = {}
+    for (infos,) in db.session.query(Contact.infos).yield_per(1000):
+        for filename in _file_values(infos, config):
+            counts[filename] = counts.get(filename, 0) + 1
+    with db.engine.begin() as connection:
+        connection.execute(UploadRef.__table__.delete())
+        if counts:
+            connection.execute(UploadRef.__table__.insert(), [
+                {'filename': filename, 'count': count} for filename, count in counts.items()
+            ])
+
+def ensure_upload_refs(config: Config) -> None:
+    """Count the references if not done yet, ie. on a DB created before they were counted"""
+    if config.file_fields and not db.session.query(UploadRef.query.exists()).scalar():
+        rebuild_upload_refs(config)
+
+@event.listens_for(Contact, 'after_insert')
+def add_upload_refs_on_insert(_mapper: Mapper, connection: Connection, target: Contact):
+    add_upload_refs(connection, _file_values(target.infos, get_config()))
+
+@event.listens_for(Contact, 'after_update')
+def update_upload_refs_on_update(_mapper: Mapper, connection: Connection, target: Contact):
+    history = inspect(target).attrs.infos.history
+    if not history.deleted:
+        return
+    config = get_config()
+    old_values = _file_values(history.deleted[0], config)
+    new_values = _file_values(target.infos, config)
+    # Files replaced are removed once not referenced by any contact anymore
+    add_upload_refs(connection, [value for value in new_values if value not in old_values])
+    if remove_upload_refs(connection, [value for value in old_values if value not in new_values]):
+        _flag_file_removals(target)
+
 @event.listens_for(Contact, 'after_delete')
-def clean_files_on_delete(_mapper: Mapper, _connection: Connection, target: Contact):
-    config = Config(os.environ.get('CONFIG_FILE', 'config.json'))
-    file_fields = [field.name for field in config.fields if field.field_type in FILE_FIELDS]
-    infos = loads(target.infos)
-    for field in file_fields:
-        if infos.get(field) and os.path.exists(os.path.join(os.environ.get('UPLOAD_FOLDER', 'uploads'), infos[field])):
-            os.remove(os.path.join(os.environ.get('UPLOAD_FOLDER', 'uploads'), infos[field]))
+def clean_files_on_delete(_mapper: Mapper, connection: Connection, target: Contact):
+    # The files are only queued here, they are removed after the commit by the cleanup worker
+    if remove_upload_refs(connection, _file_values(target.infos, get_config())):
+        _flag_file_removals(target)
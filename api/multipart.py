@@ -0,0 +1,170 @@
+import os
+import re
+from time import perf_counter
+from typing import Any, Dict, IO, Iterator, Optional, Tuple
+
+try:
+    # Public streaming parser since Werkzeug 2.0
+    from werkzeug.sansio.multipart import Data, Epilogue, Field, File, MultipartDecoder, NeedData
+except ImportError:
+    # Werkzeug 1.0.1, pinned by requirements.txt, only streams the parts with the private method
+    # `MultiPartParser.parse_lines`, which is gone since 2.0
+    from werkzeug.formparser import MultiPartParser
+    MultipartDecoder = None
+
+from config import Config
+from storage import CHUNK_SIZE, get_storage
+
+# Default limits of the size of the uploads, in bytes
+DEFAULT_MAX_FIELD_SIZE = 10 * 1024 * 1024
+DEFAULT_MAX_REQUEST_SIZE = 32 * 1024 * 1024
+
+# Same check as `werkzeug.formparser.is_valid_multipart_boundary`, gone since Werkzeug 2.0
+MULTIPART_BOUNDARY = re.compile('^[ -~]{0,200}[!-~]$')
+
+
+class InvalidMultipartException(Exception):
+
+    def __init__(self, message: str, *args: object) -> None:
+        self.code = 'INVALID_MULTIPART'
+        self.message = message
+        super().__init__(*args)
+
+class UploadTooLargeException(Exception):
+
+    def __init__(self, field: Optional[str], limit: int, *args: object) -> None:
+        self.code = 'UPLOAD_TOO_LARGE'
+        # None when it is the whole request that is too large
+        self.field = field
+        self.limit = limit
+        super().__init__(*args)
+
+
+class Upload:
+    """File part of a multipart body, written to the storage as it is received"""
+
+    def __init__(self, field: str, filename: str) -> None:
+        self.field = field
+        self.filename = filename
+        self.writer = get_storage().writer(filename)
+        # Final name in the storage, set by `commit_uploads`
+        self.name: Optional[str] = None
+        self.seconds = 0.0
+
+    @property
+    def size(self) -> int:
+        return self.writer.size
+
+    def stats(self) -> dict:
+        return {"bytes": self.size, "ms": round(self.seconds * 1000, 3)}
+
+
+def max_request_size() -> int:
+    return int(os.environ.get('MAX_UPLOAD_REQUEST_SIZE', DEFAULT_MAX_REQUEST_SIZE))
+
+def max_field_size(config: Config, field_name: str) -> int:
+    """Limit set by the 'max_size' of the 'additional_type_parameters' of the field, or by
+    MAX_UPLOAD_FIELD_SIZE
+    """
+    max_size = config.fields_by_name[field_name].additional_params.get('max_size')
+    return max_size or int(os.environ.get('MAX_UPLOAD_FIELD_SIZE', DEFAULT_MAX_FIELD_SIZE))
+
+
+def _multipart_events(stream: IO[bytes], boundary: bytes, content_length: Optional[int]) -> Iterator[Tuple[str, Any]]:
+    """Parse the multipart body read from `stream` into the events of `MultiPartParser.parse_lines`
+    of Werkzeug 1.0: ('begin_file', (headers, name, filename)) or ('begin_form', (headers, name))
+    at the start of a part, ('cont', data) for each chunk of its content, and ('end', None) at its
+    end. Raise a ValueError if the body is not valid.
+    """
+    if MultipartDecoder is None:
+        yield from MultiPartParser(buffer_size=CHUNK_SIZE).parse_lines(stream, boundary, content_length)
+        return
+    decoder = MultipartDecoder(boundary)
+    remaining = content_length
+    while True:
+        size = CHUNK_SIZE if remaining is None else min(CHUNK_SIZE, remaining)
+        chunk = stream.read(size) if size else b''
+        if remaining is not None:
+            remaining -= len(chunk)
+        # None tells the decoder that the body is over
+        decoder.receive_data(chunk or None)
+        event = decoder.next_event()
+        while not isinstance(event, NeedData):
+            if isinstance(event, File):
+                yield 'begin_file', (event.headers, event.name, event.filename)
+            elif isinstance(event, Field):
+                yield 'begin_form', (event.headers, event.name)
+            elif isinstance(event, Data):
+                yield 'cont', event.data
+                if not event.more_data:
+                    yield 'end', None
+            elif isinstance(event, Epilogue):
+                return
+            event = decoder.next_event()
+
+def stream_uploads(stream: IO[bytes], mimetype_params: dict, content_length: Optional[int], config: Config) -> Dict[str, Upload]:
+    """Parse the multipart body read from `stream`, and write the parts of the file fields of
+    `config` straight to the storage as they arrive, instead of buffering the whole body first.
+    The other parts are skipped.
+
+    Return the uploads by field, still to be moved under their final name with `commit_uploads`
+    once their values are checked, or thrown away with `discard_uploads`, so nothing is left behind
+    when the upload fails. They are thrown away here if the body is invalid or too large.
+    """
+    boundary = mimetype_params.get('boundary', '')
+    if not boundary or not MULTIPART_BOUNDARY.match(boundary):
+        raise InvalidMultipartException('Invalid multipart boundary')
+    request_limit = max_request_size()
+    if content_length is not None and content_length > request_limit:
+        raise UploadTooLargeException(None, request_limit)
+
+    uploads: Dict[str, Upload] = {}
+    current: Optional[Upload] = None
+    field_limit = received = 0
+    try:
+        for event, value in _multipart_events(stream, boundary.encode('latin1'), content_length):
+            if event == 'begin_file':
+                _, field, filename = value
+                # An empty file input is sent without filename
+                if field not in config.file_fields or not filename:
+                    continue
+                if field in uploads:
+                    # Only the last part of a field is kept
+                    uploads.pop(field).writer.discard()
+                current, field_limit = Upload(field, filename), max_field_size(config, field)
+                uploads[field] = current
+                started = perf_counter()
+            elif event == 'cont':
+                received += len(value)
+                if received > request_limit:
+                    raise UploadTooLargeException(None, request_limit)
+                if current is not None:
+                    if current.size + len(value) > field_limit:
+                        raise UploadTooLargeException(current.field, field_limit)
+                    current.writer.write(value)
+            elif event == 'end':
+                if current is not None:
+                    current.seconds = perf_counter() - started
+                current = None
+    except ValueError as exp:
+        discard_uploads(uploads)
+        raise InvalidMultipartException(str(exp))
+    except BaseException:
+        discard_uploads(uploads)
+        raise
+    return uploads
+
+def commit_uploads(uploads: Dict[str, Upload]) -> None:
+    """Move the `uploads` returned by `stream_uploads` under their final name"""
+    try:
+        for upload in uploads.values():
+            upload.name = upload.writer.commit()
+    except BaseException:
+        discard_uploads(uploads)
+        raise
+
+def discard_uploads(uploads: Dict[str, Upload]) -> None:
+    """Throw away the `uploads` returned by `stream_uploads` not moved under their final name"""
+    for upload in uploads.values():
+        if upload.name is None:
+            upload.writer.discard()
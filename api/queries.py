@@ -0,0 +1,359 @@
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+import binascii
+from json import dumps, loads, JSONDecodeError
+from operator import ge, gt, le, lt
+import sys
+from typing import Any, Iterable, List, Optional, Tuple
+
+from sqlalchemy import and_, false, func, or_
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.orm import Query
+from sqlalchemy.sql.expression import ClauseElement, Executable
+
+from config import Config, ListFieldType, ToggleFieldType
+from models import (
+    Contact,
+    db,
+)
+
+
+class InvalidQueryException(Exception):
+
+    def __init__(self, param: str, message: str, *args: object) -> None:
+        self.code = 'INVALID_QUERY_PARAMETER'
+        self.param = param
+        self.message = message
+        super().__init__(*args)
+
+
+# A sort is a list of (field name, descending) tuples
+Sort = List[Tuple[str, bool]]
+
+
+def parse_sort(sort_param: Optional[str], config: Config) -> Sort:
+    """Parse the `sort` query parameter, a comma separated list of field names, each one optionally
+    prefixed by '-' to sort in descending order.
+
+    When not provided, use the fields marked as 'sort_key' in the config, in ascending order.
+    """
+    if not sort_param:
+        return [(field_name, False) for field_name in config.sort_keys]
+
+    sort = []
+    for field_name in sort_param.split(','):
+        descending = field_name.startswith('-')
+        field_name = field_name[1:] if descending else field_name
+        if field_name not in config.fields_by_name:
+            raise InvalidQueryException('sort', f'Unknown field "{field_name}"')
+        sort.append((field_name, descending))
+    return sort
+
+def format_sort(sort: Sort) -> str:
+    return ','.join(('-' if descending else '') + field_name for field_name, descending in sort)
+
+
+# A filter is a (field name, operator, value) tuple
+Filter = Tuple[str, str, Any]
+
+FILTER_PREFIX = 'filter.'
+# Operators of the filters accepted by each type of field, 'eq' being the one used without operator
+FILTER_OPERATORS = {
+    'str': ('eq', 'prefix'),
+    'email': ('eq', 'prefix'),
+    'url': ('eq', 'prefix'),
+    'integer': ('eq', 'gt', 'gte', 'lt', 'lte'),
+    'select': ('eq', 'in'),
+    'list': ('contains',),
+    'toggle': ('eq',),
+}
+FILTER_BOOLEANS = {'true': True, 'false': False}
+RANGE_OPERATORS = {'gt': gt, 'gte': ge, 'lt': lt, 'lte': le}
+
+
+def parse_filters(args: Iterable[Tuple[str, str]], config: Config) -> List[Filter]:
+    """Parse the filter query parameters of `args`, all the (name, value) pairs of the query string.
+
+    A filter is named 'filter.<field name>' for an equality, or 'filter.<field name>.<operator>'
+    with one of the operators of `FILTER_OPERATORS` for the type of the field. The 'in' operator
+    takes a comma separated list of values. All the filters must match.
+    """
+    filters = []
+    for param, value in args:
+        if not param.startswith(FILTER_PREFIX):
+            continue
+        field_name, operator = param[len(FILTER_PREFIX):], 'eq'
+        if field_name not in config.fields_by_name and '.' in field_name:
+            field_name, operator = field_name.rsplit('.', 1)
+        if field_name not in config.fields_by_name:
+            raise InvalidQueryException(param, f'Unknown field "{field_name}"')
+        field = config.fields_by_name[field_name]
+        type_name = config.raw[field_name]['type']
+        if operator not in FILTER_OPERATORS.get(type_name, ()):
+            raise InvalidQueryException(param, f'Invalid operator "{operator}" for a field of type {type_name}')
+        if not value:
+            raise InvalidQueryException(param, 'Missing value')
+        if type_name == 'list':
+            type_name = field.additional_params.get('inner_type', 'str')
+        if operator == 'in':
+            value = [item for item in value.split(',') if item]
+        else:
+            value = _parse_filter_value(param, value, type_name)
+        filters.append((field_name, operator, value))
+    return filters
+
+def _parse_filter_value(param: str, value: str, type_name: str) -> Any:
+    if type_name == 'integer':
+        try:
+            return int(value)
+        except ValueError:
+            raise InvalidQueryException(param, f'Invalid integer "{value}"')
+    if type_name == 'toggle':
+        if value.lower() not in FILTER_BOOLEANS:
+            raise InvalidQueryException(param, f'Invalid boolean "{value}", expected true or false')
+        return FILTER_BOOLEANS[value.lower()]
+    return value
+
+def filter_conditions(filters: List[Filter]) -> list:
+    """SQL conditions of `filters`. The equalities use the GIN index of PostgreSQL, and the ranges
+    the key indexes of the field when it is the first one of an index (see `models.key_indexes`).
+    """
+    conditions = []
+    for field_name, operator, value in filters:
+        if operator == 'eq':
+            conditions.append(Contact.info_equals(field_name, value))
+        elif operator == 'in':
+            conditions.append(or_(*[Contact.info_equals(field_name, item) for item in value]))
+        elif operator == 'contains':
+            conditions.append(Contact.info_contains(field_name, value))
+        elif operator == 'prefix':
+            conditions.append(_prefix_condition(field_name, value))
+        else:
+            conditions.append(RANGE_OPERATORS[operator](Contact.info_field(field_name), value))
+    return conditions
+
+def _prefix_condition(field_name: str, prefix: str) -> Any:
+    # A range instead of a LIKE, which SQLite only runs over an index with a case sensitive LIKE
+    expr = Contact.info_field(field_name)
+    condition = expr >= prefix
+    if ord(prefix[-1]) < sys.maxunicode:
+        condition = and_(condition, expr < prefix[:-1] + chr(ord(prefix[-1]) + 1))
+    if db.engine.dialect.name == 'postgresql':
+        # The strings are ordered by the collation of the DB, check the prefix itself too
+        condition = and_(condition, Contact.info_text(field_name).startswith(prefix, autoescape=True))
+    return condition
+
+
+def encode_cursor(sort: Sort, values: list, id_contact: int, inclusive: bool=False) -> str:
+    """Build an opaque cursor pointing right after (or at, if `inclusive`) the contact with the id
+    `id_contact` and the sort values `values`
+    """
+    payload = {'s': format_sort(sort), 'v': values, 'id': id_contact}
+    if inclusive:
+        payload['i'] = True
+    return urlsafe_b64encode(dumps(payload, separators=(',', ':')).encode()).decode()
+
+def decode_cursor(cursor: str, sort: Sort) -> dict:
+    try:
+        payload = loads(urlsafe_b64decode(cursor.encode()))
+    except (binascii.Error, JSONDecodeError, UnicodeDecodeError, ValueError):
+        raise InvalidQueryException('cursor', 'Invalid cursor')
+    if (not isinstance(payload, dict) or
+            not isinstance(payload.get('id'), int) or
+            not isinstance(payload.get('v'), list) or
+            len(payload['v']) != len(sort)):
+        raise InvalidQueryException('cursor', 'Invalid cursor')
+    if payload.get('s') != format_sort(sort):
+        raise InvalidQueryException('cursor', 'Cursor was built for another sort')
+    return payload
+
+
+def sort_expressions(sort: Sort) -> list:
+    return [Contact.info_field(field_name) for field_name, _ in sort]
+
+def order_by_clauses(sort: Sort, expressions: Optional[list]=None, id_column: Any=None) -> list:
+    expressions = expressions if expressions is not None else sort_expressions(sort)
+    id_column = id_column if id_column is not None else Contact.id
+    clauses = [expr.desc() if descending else expr.asc() for expr, (_, descending) in zip(expressions, sort)]
+    if db.engine.dialect.name == 'postgresql':
+        # Same order of the NULL values as SQLite, which is also the one of the key indexes (see
+        # `models.key_indexes`). Not set on SQLite, which only accepts it since 3.30.
+        clauses = [
+            clause.nullslast() if descending else clause.nullsfirst()
+            for clause, (_, descending) in zip(clauses, sort)
+        ]
+    # Always end with the id, to get a total order and stable pages
+    return clauses + [id_column.asc()]
+
+
+def _equal(expr: Any, value: Any) -> Any:
+    return expr.is_(None) if value is None else expr == value
+
+def _after(expr: Any, value: Any, descending: bool) -> Any:
+    # NULL values are first when sorting in ascending order, and last in descending order (see
+    # `order_by_clauses`)
+    if descending:
+        return false() if value is None else or_(expr < value, expr.is_(None))
+    return expr.isnot(None) if value is None else expr > value
+
+def keyset_condition(sort: Sort, values: list, id_contact: int, inclusive: bool=False) -> Any:
+    """Condition matching the contacts located after the position (`values`, `id_contact`) in the
+    order defined by `sort`, usable by an index on the sort expressions instead of an OFFSET scan.
+    """
+    expressions = sort_expressions(sort)
+    conditions = []
+    for position, (expr, value, (_, descending)) in enumerate(zip(expressions, values, sort)):
+        previous_equal = [_equal(expressions[i], values[i]) for i in range(position)]
+        conditions.append(and_(*previous_equal, _after(expr, value, descending)))
+    all_equal = [_equal(expr, value) for expr, value in zip(expressions, values)]
+    last = Contact.id >= id_contact if inclusive else Contact.id > id_contact
+    conditions.append(and_(*all_equal, last))
+    condition = or_(*conditions)
+    if sort and values[0] is not None and not sort[0][1]:
+        # Redundant range on the first key, so the index is scanned from the cursor in the
+        # order of the listing, instead of collecting the rows of each branch of the OR and then
+        # sorting them
+        condition = and_(expressions[0] >= values[0], condition)
+    return condition
+
+
+SUMMARY_PROJECTION = 'summary'
+
+
+def parse_fields(fields_param: Optional[str], config: Config) -> Optional[Tuple[str, ...]]:
+    """Parse the `fields` query parameter, a comma separated list of the names of the fields to
+    return, or 'summary' for the fields marked as 'main_attribute' in the config. The id is always
+    returned.
+
+    Returns None when not provided, to return all the fields.
+    """
+    if fields_param is None:
+        return None
+    if fields_param == SUMMARY_PROJECTION:
+        return config.main_attributes
+    fields = []
+    for field_name in fields_param.split(','):
+        if not field_name or field_name == 'id' or field_name in fields:
+            continue
+        if field_name not in config.fields_by_name:
+            raise InvalidQueryException('fields', f'Unknown field "{field_name}"')
+        fields.append(field_name)
+    return tuple(fields)
+
+def projection_columns(fields: Iterable[str]) -> list:
+    """Columns selecting the id of the contacts and the values of `fields`, extracted by the DB
+    instead of loading the whole `infos`
+    """
+    return [Contact.id] + [Contact.info_field(field_name) for field_name in fields]
+
+def projected_infos(row: tuple, fields: Iterable[str], config: Config) -> dict:
+    """Values of `fields` in a `row` selected with `projection_columns`, without the missing ones"""
+    infos = {}
+    for field_name, value in zip(fields, row[1:]):
+        if value is None:
+            continue
+        field_type = config.fields_by_name[field_name].field_type
+        # SQLite gives the SQL value of the JSON ones: an integer for a boolean, a text for a list
+        if isinstance(field_type, ToggleFieldType) and not isinstance(value, bool):
+            value = bool(value)
+        elif isinstance(field_type, ListFieldType) and isinstance(value, str):
+            value = loads(value)
+        infos[field_name] = value
+    return infos
+
+
+def page_query(query: Query, sort: Sort, limit: Optional[int], cursor: Optional[str]) -> Query:
+    """Apply the sort and the keyset pagination to `query`, selecting the sort values along with
+    the contacts, and one more contact than `limit` to know if there is a next page.
+    """
+    if cursor:
+        payload = decode_cursor(cursor, sort)
+        query = query.filter(keyset_condition(sort, payload['v'], payload['id'], payload.get('i', False)))
+    expressions = sort_expressions(sort)
+    query = query.add_columns(*expressions).order_by(*order_by_clauses(sort, expressions))
+    return query if limit is None else query.limit(limit + 1)
+
+def paginate(page: Query, sort: Sort, limit: Optional[int]) -> Tuple[list, Optional[str]]:
+    """Run `page`, built by `page_query` with `sort` and `limit`, and return the page of contacts
+    (or of the rows of `projection_columns`) along with the cursor of the next page (None if this is
+    the last page).
+    """
+    # Either the contacts, or their id followed by some of their values (see `projection_columns`),
+    # then the sort values
+    width = len(page.column_descriptions) - len(sort)
+    projected = page.column_descriptions[0]['type'] is not Contact
+    rows = page.all()
+    next_cursor = None
+    if limit is not None and len(rows) > limit:
+        rows = rows[:limit]
+        last = rows[-1]
+        next_cursor = encode_cursor(sort, list(last[width:]), last[0] if projected else last[0].id)
+    if projected:
+        return [tuple(row[:width]) for row in rows], next_cursor
+    return [row[0] for row in rows], next_cursor
+
+
+def group_index(sort: Sort) -> List[dict]:
+    """Group the contacts by the first character of the first field of `sort`, like the front does,
+    and return for each group the number of contacts in it and the cursor pointing to its first
+    contact.
+
+    A group is a run of consecutive contacts in the listing, so that its cursor and its count give
+    all its contacts. With a collation of the DB not sorting the strings by their characters, the
+    contacts with the same first character can be split in several groups.
+    """
+    if not sort:
+        count = db.session.query(func.count(Contact.id)).scalar()
+        return [{'group': '', 'count': count, 'cursor': None}] if count else []
+
+    expressions = sort_expressions(sort)
+    order = order_by_clauses(sort, expressions)
+    group = func.coalesce(func.substr(Contact.info_text(sort[0][0]), 1, 1), '')
+    labels = [f'k{i}' for i in range(len(expressions))]
+    ordered = db.session.query(
+        group.label('group_name'),
+        func.lag(group).over(order_by=order).label('previous_group'),
+        func.row_number().over(order_by=order).label('position'),
+        func.count().over().label('total'),
+        Contact.id.label('id'),
+        *[expr.label(label) for expr, label in zip(expressions, labels)]
+    ).subquery()
+    # The first contact of each group, and the position of the first contact of the next one
+    firsts = db.session.query(
+        ordered,
+        func.lead(ordered.c.position).over(order_by=ordered.c.position).label('next_position'),
+    ).filter(or_(ordered.c.previous_group.is_(None), ordered.c.previous_group != ordered.c.group_name)).subquery()
+    rows = db.session.query(firsts).order_by(firsts.c.position).all()
+    return [
+        {
+            'group': row.group_name,
+            'count': (row.next_position or row.total + 1) - row.position,
+            'cursor': encode_cursor(sort, [getattr(row, label) for label in labels], row.id, inclusive=True),
+        }
+        for row in rows
+    ]
+
+
+class _Explain(Executable, ClauseElement):
+
+    def __init__(self, statement) -> None:
+        self.statement = statement
+
+@compiles(_Explain)
+def _compile_explain(element, compiler, **kwargs):
+    return 'EXPLAIN QUERY PLAN ' + compiler.process(element.statement, **kwargs)
+
+@compiles(_Explain, 'postgresql')
+def _compile_explain_postgresql(element, compiler, **kwargs):
+    return 'EXPLAIN (COSTS OFF) ' + compiler.process(element.statement, **kwargs)
+
+def explain(query: Query) -> str:
+    """Return the plan of `query` chosen by the DB, without running it, as a single line listing the
+    steps and the indexes they use
+    """
+    rows = db.session.execute(_Explain(query.statement))
+    if db.engine.dialect.name == 'postgresql':
+        steps = [row[0].strip().lstrip('-> ') for row in rows]
+    else:
+        # The last column is the description of the step
+        steps = [row[-1] for row in rows]
+    return '; '.join(steps)
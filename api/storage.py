@@ -0,0 +1,419 @@
+from hashlib import sha256
+from io import BytesIO
+import mimetypes
+import os
+import re
+from threading import Lock
+from typing import Dict, IO, Iterator, NamedTuple, Optional, Tuple
+from uuid import uuid4
+
+from werkzeug.utils import secure_filename
+
+try:
+    # Optional, only needed by the S3 backend
+    import boto3
+    from botocore.config import Config as BotoConfig
+    from botocore.exceptions import ClientError
+except ImportError:
+    boto3 = None
+
+# Size of the chunks read from the uploaded files
+CHUNK_SIZE = 64 * 1024
+
+# Name of the files saved under the hash of their content by `UploadWriter`
+CONTENT_ADDRESSED_FILENAME = re.compile(r'^(?P<digest>[0-9a-f]{64})(\.[a-z0-9_]+)?$')
+
+
+def upload_folder() -> str:
+    return os.environ.get('UPLOAD_FOLDER', 'uploads')
+
+def file_extension(filename: str) -> str:
+    filename = secure_filename(filename)
+    return filename.rsplit('.', 1)[-1].lower() if '.' in filename else ''
+
+def is_valid_name(name: str) -> bool:
+    """Whether `name` can be the name of a stored file, ie. a path relative to the root of the
+    storage made of safe parts. Values of the file fields can be set through the API, they must
+    never be followed out of it.
+    """
+    return bool(name) and all(part and secure_filename(part) == part for part in name.split('/'))
+
+def content_digest(name: str) -> Optional[str]:
+    """Return the hash of the content of the file `name` if it was saved under it, None otherwise"""
+    match = CONTENT_ADDRESSED_FILENAME.match(name)
+    return match.group('digest') if match else None
+
+
+class FileInfo(NamedTuple):
+    name: str
+    size: int
+    # Timestamp of the last modification
+    modified: float
+
+
+class UploadWriter:
+    """Write an uploaded file chunk by chunk while hashing it, to store it under the hash of its
+    content with `commit`.
+    """
+    def __init__(self, filename: str) -> None:
+        self.filename = filename
+        self.size = 0
+        self._digest = sha256()
+
+    def write(self, chunk: bytes) -> None:
+        self._digest.update(chunk)
+        self._write(chunk)
+        self.size += len(chunk)
+
+    def _write(self, chunk: bytes) -> None:
+        raise NotImplementedError()
+
+    def name(self) -> str:
+        extension = file_extension(self.filename)
+        return self._digest.hexdigest() + (f'.{extension}' if extension else '')
+
+    def commit(self) -> str:
+        """Store the file under its final name, and return it. If a file with the same content was
+        already uploaded, the existing file is kept, and touched to tell a pending removal of it
+        that it was uploaded again since.
+        """
+        raise NotImplementedError()
+
+    def discard(self) -> None:
+        raise NotImplementedError()
+
+
+class Storage:
+    """Where the uploaded files are kept. Files are named by their path relative to the root of the
+    storage, with '/' as separator.
+    """
+    # Seconds during which the URLs returned by `presigned_url` are valid
+    url_expiration = 0
+
+    def writer(self, filename: str) -> UploadWriter:
+        raise NotImplementedError()
+
+    def stat(self, name: str) -> Optional[FileInfo]:
+        raise NotImplementedError()
+
+    def open(self, name: str) -> IO[bytes]:
+        """Open the file `name` for reading, raise FileNotFoundError if there is none"""
+        raise NotImplementedError()
+
+    def save(self, name: str, content: bytes) -> None:
+        """Write `content` to the file `name`, replacing it if any. Readers never see it partly
+        written.
+        """
+        raise NotImplementedError()
+
+    def touch(self, name: str) -> None:
+        raise NotImplementedError()
+
+    def remove(self, name: str) -> Optional[int]:
+        """Remove the file `name`, and return its size (None if there was none)"""
+        raise NotImplementedError()
+
+    def list(self, prefix: str='') -> Iterator[FileInfo]:
+        """List the files directly under `prefix`, which is empty or ends with a '/'"""
+        raise NotImplementedError()
+
+    def local_path(self, name: str) -> Optional[str]:
+        """Path of the file `name` on the local filesystem, if stored there"""
+        return None
+
+    def presigned_url(self, name: str) -> Optional[str]:
+        """URL from which the file `name` can be downloaded directly, if the storage has one"""
+        return None
+
+
+class LocalUploadWriter(UploadWriter):
+    """Written to a temporary file of the upload folder, moved to its final name on commit"""
+
+    def __init__(self, storage: 'LocalStorage', filename: str) -> None:
+        super().__init__(filename)
+        self._storage = storage
+        self._temp_path = os.path.join(storage.folder, f'.upload-{uuid4().hex}')
+        self._file = open(self._temp_path, 'wb')
+
+    def _write(self, chunk: bytes) -> None:
+        self._file.write(chunk)
+
+    def commit(self) -> str:
+        self._file.close()
+        name = self.name()
+        path = self._storage.local_path(name)
+        if os.path.exists(path):
+            os.remove(self._temp_path)
+            os.utime(path)
+        else:
+            os.replace(self._temp_path, path)
+        return name
+
+    def discard(self) -> None:
+        self._file.close()
+        if os.path.exists(self._temp_path):
+            os.remove(self._temp_path)
+
+
+class LocalStorage(Storage):
+    """Files kept in a folder of the local filesystem"""
+
+    def __init__(self, folder: str) -> None:
+        self.folder = folder
+        os.makedirs(folder, exist_ok=True)
+
+    def writer(self, filename: str) -> UploadWriter:
+        return LocalUploadWriter(self, filename)
+
+    def local_path(self, name: str) -> str:
+        return os.path.join(self.folder, *name.split('/'))
+
+    def stat(self, name: str) -> Optional[FileInfo]:
+        try:
+            stat = os.stat(self.local_path(name))
+        except FileNotFoundError:
+            return None
+        return FileInfo(name, stat.st_size, stat.st_mtime)
+
+    def open(self, name: str) -> IO[bytes]:
+        return open(self.local_path(name), 'rb')
+
+    def save(self, name: str, content: bytes) -> None:
+        path = self.local_path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        temp_path = os.path.join(os.path.dirname(path), f'.save-{uuid4().hex}')
+        try:
+            with open(temp_path, 'wb') as file:
+                file.write(content)
+            os.replace(temp_path, path)
+        finally:
+            if os.path.exists(temp_path):
+                os.remove(temp_path)
+
+    def touch(self, name: str) -> None:
+        os.utime(self.local_path(name))
+
+    def remove(self, name: str) -> Optional[int]:
+        path = self.local_path(name)
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return None
+        return size
+
+    def list(self, prefix: str='') -> Iterator[FileInfo]:
+        folder = self.local_path(prefix) if prefix else self.folder
+        if not os.path.isdir(folder):
+            return
+        for entry in os.scandir(folder):
+            if entry.is_file():
+                stat = entry.stat()
+                yield FileInfo(prefix + entry.name, stat.st_size, stat.st_mtime)
+
+
+class S3UploadWriter(UploadWriter):
+    """Kept in memory up to the size of a part, and stored with a single request. Larger files are
+    sent part by part to a temporary key with a multipart upload, and copied to their final key on
+    the S3 side.
+    """
+    def __init__(self, storage: 'S3Storage', filename: str) -> None:
+        super().__init__(filename)
+        self._storage = storage
+        self._buffer = bytearray()
+        self._temp_key: Optional[str] = None
+        self._upload_id: Optional[str] = None
+        self._parts: list = []
+
+    def _write(self, chunk: bytes) -> None:
+        self._buffer += chunk
+        if len(self._buffer) >= self._storage.part_size:
+            self._upload_part()
+
+    def _upload_part(self) -> None:
+        client, bucket = self._storage.client, self._storage.bucket
+        if self._upload_id is None:
+            self._temp_key = self._storage.key(f'.upload-{uuid4().hex}')
+            self._upload_id = client.create_multipart_upload(Bucket=bucket, Key=self._temp_key)['UploadId']
+        number = len(self._parts) + 1
+        response = client.upload_part(
+            Bucket=bucket, Key=self._temp_key, UploadId=self._upload_id, PartNumber=number, Body=bytes(self._buffer)
+        )
+        self._parts.append({'ETag': response['ETag'], 'PartNumber': number})
+        self._buffer = bytearray()
+
+    def commit(self) -> str:
+        storage, name = self._storage, self.name()
+        if storage.stat(name) is not None:
+            self.discard()
+            storage.touch(name)
+            return name
+        if self._upload_id is None:
+            storage.save(name, bytes(self._buffer))
+            return name
+
+        if self._buffer:
+            self._upload_part()
+        storage.client.complete_multipart_upload(
+            Bucket=storage.bucket, Key=self._temp_key, UploadId=self._upload_id, MultipartUpload={'Parts': self._parts}
+        )
+        self._upload_id = None
+        storage.client.copy_object(
+            Bucket=storage.bucket,
+            Key=storage.key(name),
+            CopySource={'Bucket': storage.bucket, 'Key': self._temp_key},
+            ContentType=storage.content_type(name),
+            MetadataDirective='REPLACE',
+        )
+        storage.client.delete_object(Bucket=storage.bucket, Key=self._temp_key)
+        return name
+
+    def discard(self) -> None:
+        self._buffer = bytearray()
+        if self._upload_id is not None:
+            self._storage.client.abort_multipart_upload(
+                Bucket=self._storage.bucket, Key=self._temp_key, UploadId=self._upload_id
+            )
+            self._upload_id = None
+
+
+class S3Storage(Storage):
+    """Files kept in a bucket of S3, or of any S3-compatible file store (eg. MinIO), so that
+    several instances of the API can share them. The files are downloaded by the clients directly
+    from the store, through presigned URLs.
+    """
+    def __init__(
+            self,
+            bucket: str,
+            prefix: str='',
+            endpoint_url: Optional[str]=None,
+            max_pool_connections: int=10,
+            part_size: int=8 * 1024 * 1024,
+            url_expiration: int=60 * 60) -> None:
+        if boto3 is None:
+            raise RuntimeError('boto3 must be installed to store the files on S3')
+        self.bucket = bucket
+        self.prefix = prefix
+        self.part_size = part_size
+        self.url_expiration = url_expiration
+        # Clients are thread-safe, a single one is shared to reuse its pool of connections
+        self.client = boto3.client(
+            's3', endpoint_url=endpoint_url, config=BotoConfig(max_pool_connections=max_pool_connections)
+        )
+
+    def key(self, name: str) -> str:
+        return self.prefix + name
+
+    @staticmethod
+    def content_type(name: str) -> str:
+        return mimetypes.guess_type(name)[0] or 'application/octet-stream'
+
+    def writer(self, filename: str) -> UploadWriter:
+        return S3UploadWriter(self, filename)
+
+    def stat(self, name: str) -> Optional[FileInfo]:
+        try:
+            response = self.client.head_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as exp:
+            if exp.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                return None
+            raise
+        return FileInfo(name, response['ContentLength'], response['LastModified'].timestamp())
+
+    def open(self, name: str) -> IO[bytes]:
+        try:
+            response = self.client.get_object(Bucket=self.bucket, Key=self.key(name))
+        except ClientError as exp:
+            if exp.response['Error']['Code'] in ('404', 'NoSuchKey'):
+                raise FileNotFoundError(name)
+            raise
+        return BytesIO(response['Body'].read())
+
+    def save(self, name: str, content: bytes) -> None:
+        self.client.put_object(Bucket=self.bucket, Key=self.key(name), Body=content, ContentType=self.content_type(name))
+
+    def touch(self, name: str) -> None:
+        # Copying an object onto itself updates its last modification
+        self.client.copy_object(
+            Bucket=self.bucket,
+            Key=self.key(name),
+            CopySource={'Bucket': self.bucket, 'Key': self.key(name)},
+            ContentType=self.content_type(name),
+            MetadataDirective='REPLACE',
+        )
+
+    def remove(self, name: str) -> Optional[int]:
+        info = self.stat(name)
+        if info is None:
+            return None
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(name))
+        return info.size
+
+    def list(self, prefix: str='') -> Iterator[FileInfo]:
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=self.key(prefix), Delimiter='/'):
+            for item in page.get('Contents', []):
+                yield FileInfo(item['Key'][len(self.prefix):], item['Size'], item['LastModified'].timestamp())
+
+    def presigned_url(self, name: str) -> Optional[str]:
+        return self.client.generate_presigned_url(
+            'get_object', Params={'Bucket': self.bucket, 'Key': self.key(name)}, ExpiresIn=self.url_expiration
+        )
+
+
+_STORAGES: Dict[Tuple[Optional[str], ...], Storage] = {}
+_STORAGES_LOCK = Lock()
+
+def get_storage() -> Storage:
+    """Return the storage set by the env variables, STORAGE_BACKEND being either 'local' (the
+    default, in UPLOAD_FOLDER) or 's3' (in S3_BUCKET, see `S3Storage`). Instances are shared.
+    """
+    backend = os.environ.get('STORAGE_BACKEND', 'local')
+    if backend == 's3':
+        settings: Tuple[Optional[str], ...] = tuple(os.environ.get(name) for name in (
+            'S3_BUCKET', 'S3_PREFIX', 'S3_ENDPOINT_URL', 'S3_MAX_POOL_CONNECTIONS', 'S3_PART_SIZE', 'S3_URL_EXPIRATION'
+        ))
+    elif backend == 'local':
+        settings = (upload_folder(),)
+    else:
+        raise ValueError(f'Unknown storage backend "{backend}"')
+
+    key = (backend,) + settings
+    with _STORAGES_LOCK:
+        if key not in _STORAGES:
+            if backend == 's3':
+                bucket, prefix, endpoint_url, pool, part_size, expiration = settings
+                if not bucket:
+                    raise ValueError('S3_BUCKET must be set to store the files on S3')
+                _STORAGES[key] = S3Storage(
+                    bucket,
+                    prefix=prefix or '',
+                    endpoint_url=endpoint_url or None,
+                    max_pool_connections=int(pool or 10),
+                    # S3 refuses parts smaller than 5 MiB, but for the last one
+                    part_size=max(int(part_size or 8 * 1024 * 1024), 5 * 1024 * 1024),
+                    url_expiration=int(expiration or 60 * 60),
+                )
+            else:
+                _STORAGES[key] = LocalStorage(upload_folder())
+        return _STORAGES[key]
+
+
+def save_file(stream: IO[bytes], filename: str) -> str:
+    """Save the content of `stream` in the storage, under the hash of its content and with the
+    extension of `filename`, and return the name it was saved under. See `UploadWriter`.
+    """
+    writer = get_storage().writer(filename)
+    try:
+        for chunk in iter(lambda: stream.read(CHUNK_SIZE), b''):
+            writer.write(chunk)
+        return writer.commit()
+    except BaseException:
+        writer.discard()
+        raise
+
+def remove_file(name: str) -> Optional[int]:
+    """Remove the file `name` from the storage, and return its size (None if there was none)"""
+    if not is_valid_name(name):
+        return None
+    return get_storage().remove(name)
@@ -1,3 +1,5 @@
+from hashlib import sha256
+from io import BytesIO
 import json
 import os
 from tempfile import NamedTemporaryFile
@@ -6,15 +8,54 @@ from uuid import uuid4
 import warnings
 
 from flask_testing import TestCase
-from sqlalchemy.exc import SAWarning
+try:
+    import boto3
+    try:
+        from moto import mock_aws
+    except ImportError:
+        # Before moto 5, the one installed by requirements.test.txt to support Python 3.6
+        from moto import mock_s3 as mock_aws
+except ImportError:
+    mock_aws = None
+from sqlalchemy.exc import IntegrityError, SAWarning
 
 from config import (
+    Config,
+    get_config,
+    invalidate_config,
     InvalidConfigException,
+    InvalidValueException,
+    MissingRequiredValueException,
     validate_config,
-    validate_config_file
+    validate_config_file,
+    WrongTypeException,
 )
+from cache import get_contact_cache
+from cleanup import collect_garbage, drain_file_removals
 from main import create_app
-from models import db
+from migrations import (
+    dry_run_migration,
+    MIGRATION_LEASE,
+    MigrationRunningException,
+    run_migration_batch,
+    run_migrations,
+    start_migration,
+)
+from models import (
+    acquire_lease,
+    add_upload_refs,
+    Contact,
+    db,
+    infos_to_json,
+    is_duplicate_key_error,
+    KEY_INDEX_PREFIX,
+    release_lease,
+    remove_upload_refs,
+    UploadRef,
+)
+from queries import order_by_clauses
+from storage import get_storage, S3Storage
+from thumbnails import Image, thumbnails_enabled, THUMBNAILS_KEY
 from views import create_or_update_contact_instance_or_abort
 
 
@@ -82,6 +123,13 @@ class BaseTestCase(TestCase):
         super().__init__(*args, **kwargs)
 
     def create_app(self):
+        # Files are removed by calling `drain_file_removals`, not by the background worker
+        os.environ['FILE_CLEANUP_INTERVAL'] = '0'
+        # Same for the migrations of the contacts, run by calling `run_migrations`
+        os.environ['CONFIG_MIGRATION_INTERVAL'] = '0'
+        if os.environ.get('TEST_DATABASE_URI'):
+            # Run the tests against another DB than the SQLite one, eg. PostgreSQL
+            os.environ['SQLALCHEMY_DATABASE_URI'] = os.environ['TEST_DATABASE_URI']
         app = create_app()
         app.config['TESTING'] = True
         return app
@@ -95,7 +143,10 @@ class BaseTestCase(TestCase):
 
     def tearDown(self):
         db.session.remove()
+        drain_file_removals()
         db.drop_all()
+        # The ids and the versions start over with the next DB
+        get_contact_cache().clear()
         if self.old_config_path:
             # Restore the old value only if needed
             os.environ['CONFIG_FILE'] = self.old_config_path
@@ -116,8 +167,161 @@ class ModelTest(BaseTestCase):
 
             db.session.delete(model_instance)
             db.session.commit()
+            # Only removed once the queue of files to remove is drained
+            self.assertTrue(os.path.isfile(imagepath))
+            self.assertEqual(drain_file_removals(), (1, 0))
             self.assertFalse(os.path.isfile(imagepath))
 
+    def test_upload_refs(self):
+        # Counted by the DB, even for the first reference
+        with db.engine.begin() as connection:
+            add_upload_refs(connection, ['shared.png'])
+            add_upload_refs(connection, ['shared.png'])
+            self.assertFalse(remove_upload_refs(connection, ['shared.png']))
+            self.assertTrue(remove_upload_refs(connection, ['shared.png']))
+        # Not a duplicate primary key of a contact
+        with self.assertRaises(IntegrityError) as context:
+            with db.engine.begin() as connection:
+                connection.execute(UploadRef.__table__.insert(), filename='shared.png', count=1)
+                connection.execute(UploadRef.__table__.insert(), filename='shared.png', count=1)
+        self.assertFalse(is_duplicate_key_error(context.exception))
+
+    def test_worker_lease(self):
+        # A single process runs a background task at a time, until it releases it or dies
+        self.assertTrue(acquire_lease('task', 'worker-1', 60))
+        self.assertFalse(acquire_lease('task', 'worker-2', 60))
+        self.assertTrue(acquire_lease('task', 'worker-1', 60))
+        release_lease('task', 'worker-1')
+        self.assertTrue(acquire_lease('task', 'worker-2', -1))
+        # Expired
+        self.assertTrue(acquire_lease('task', 'worker-1', 60))
+
+    @with_config({"firstname": {"type": "str"}, "photo": {"type": "image"}})
+    def test_collect_garbage(self):
+        folder = os.environ.get('UPLOAD_FOLDER', 'uploads')
+        names = {kind: f'{sha256(uuid4().bytes).hexdigest()}.png' for kind in ('orphan', 'recent', 'used', 'renamed')}
+        # Not uploaded through the API
+        names['other'] = f'other-{uuid4().hex}.png'
+        for name in names.values():
+            with open(os.path.join(folder, name), 'wb') as file:
+                file.write(b'12345')
+            if name != names['recent']:
+                os.utime(os.path.join(folder, name), (0, 0))
+        # Referenced by any field, even one that is not a file field anymore
+        contacts = [
+            create_or_update_contact_instance_or_abort(None, {"photo": names['used']}),
+            create_or_update_contact_instance_or_abort(None, {"firstname": names['renamed']}),
+        ]
+
+        self.assertEqual(collect_garbage(grace_period=60), (1, 5))
+        self.assertFalse(os.path.isfile(os.path.join(folder, names['orphan'])))
+        for kind in ('recent', 'used', 'renamed', 'other'):
+            self.assertTrue(os.path.isfile(os.path.join(folder, names[kind])))
+            os.remove(os.path.join(folder, names[kind]))
+        for contact in contacts:
+            db.session.delete(contact)
+        db.session.commit()
+
+    def test_infos_to_json(self):
+        def file_url(filename):
+            return 'http://localhost/' + filename
+
+        for infos in [
+            {},
+            {"firstname": "Luke", "age": 19, "jedi": True, "tags": ["pilot", "photo"]},
+            {"photo": "luke.png", "firstname": "Luke"},
+            {"photo": "", "other": "luke.png"},
+            {"photo": 'with "quotes".png', "firstname": "\u00e9{"},
+            {"id": 4, "photo": "luke.png"},
+            {"nested": {"photo": "luke.png"}},
+        ]:
+            with self.subTest(infos=infos):
+                expected = dict(infos, id=1)
+                if infos.get("photo"):
+                    expected["photo"] = file_url(infos["photo"])
+                got = infos_to_json(1, json.dumps(infos), ["photo"], file_url)
+                self.assertEqual(json.loads(got), expected)
+
+                if infos.get("photo"):
+                    expected["_thumbnails"] = {"photo": {"64": file_url("64/" + infos["photo"])}}
+                got = infos_to_json(1, json.dumps(infos), ["photo"], file_url, lambda name: {"64": file_url("64/" + name)}, "_thumbnails")
+                self.assertEqual(json.loads(got), expected)
+
+    @with_config({
+        "id": {"type": "str", "primary_key": True, "required": True},
+        "lastname": {"type": "str", "sort_key": 1},
+    }, working_dir=".")
+    def test_key_indexes(self):
+        postgresql = db.engine.dialect.name == 'postgresql'
+
+        def get_key_indexes():
+            return sorted(row[0] for row in db.session.execute(
+                "SELECT indexdef FROM pg_indexes WHERE indexname LIKE :prefix" if postgresql else
+                "SELECT sql FROM sqlite_master WHERE type = 'index' AND name LIKE :prefix",
+                {'prefix': KEY_INDEX_PREFIX + '%'}
+            ))
+
+        def field(name):
+            return f"((infos -> '{name}'::text)) NULLS FIRST" if postgresql else f'json_extract(infos, \'$."{name}"\')'
+
+        self.assert200(self.client.get('/contact?limit=1'))
+        indexes = get_key_indexes()
+        self.assertEqual(len(indexes), 2)
+        self.assertIn(f'({field("lastname")}, id)', indexes[0] + indexes[1])
+
+        # Changing the keys in the config rebuilds the indexes. The requests of a test share its
+        # session, end its transaction so that PostgreSQL can drop the indexes.
+        db.session.remove()
+        resp = self.client.put('/config', json={
+            "id": {"type": "str", "primary_key": True, "required": True},
+            "firstname": {"type": "str", "sort_key": 1, "main_attribute": 1},
+            "lastname": {"type": "str", "sort_key": 2},
+        })
+        self.assert200(resp)
+        indexes = get_key_indexes()
+        self.assertEqual(len(indexes), 3)
+        self.assertIn(f'({field("firstname")}, {field("lastname")}, id)', ''.join(indexes))
+
+        # And the sorted listing walks the index instead of sorting the table
+        sort = [("firstname", False), ("lastname", False)]
+        query = Contact.query.order_by(*order_by_clauses(sort))
+        statement = str(query.statement.compile(db.engine))
+        if postgresql:
+            # The table is too small for the planner to prefer the index otherwise
+            db.session.execute('SET LOCAL enable_seqscan = off')
+            plan = ' '.join(row[0] for row in db.session.execute('EXPLAIN ' + statement))
+            self.assertIn(f'Index Scan using {KEY_INDEX_PREFIX}', plan)
+            self.assertNotIn('Sort', plan)
+        else:
+            plan = ' '.join(row[-1] for row in db.session.execute('EXPLAIN QUERY PLAN ' + statement))
+            self.assertIn(KEY_INDEX_PREFIX, plan)
+            self.assertNotIn('TEMP B-TREE', plan)
+
+    @with_config({
+        "id": {"type": "str", "primary_key": True, "required": True},
+        "firstname": {"type": "str", "main_attribute": 1},
+        "lastname": {"type": "str", "sort_key": 1},
+    })
+    def test_key_indexes_duplicated_keys(self):
+        # Contacts saved before the primary key was enforced
+        for firstname in ("Luke", "Leia"):
+            db.session.add(Contact(infos=json.dumps({"id": "skywalker", "firstname": firstname, "lastname": "Skywalker"})))
+        db.session.commit()
+
+        with self.assertLogs(self.app.logger, 'WARNING') as logs:
+            self.assert200(self.client.get('/contact', query_string={'filter.firstname': 'Luke'}))
+        self.assertIn('Cannot enforce the uniqueness of "id"', logs.output[0])
+        # Only the index of the primary key is left out
+        indexes = [row[0] for row in db.session.execute(
+            "SELECT indexdef FROM pg_indexes WHERE indexname LIKE :prefix" if db.engine.dialect.name == 'postgresql' else
+            "SELECT sql FROM sqlite_master WHERE type = 'index' AND name LIKE :prefix",
+            {'prefix': KEY_INDEX_PREFIX + '%'}
+        )]
+        self.assertEqual(len(indexes), 2)
+        self.assertTrue(any('lastname' in index for index in indexes))
+        self.assertTrue(any('firstname' in index for index in indexes))
+        self.assertFalse(any('UNIQUE' in index for index in indexes))
+
 
 class ApiTest(BaseTestCase):
 
@@ -136,7 +340,352 @@ class ApiTest(BaseTestCase):
         ]
         self.assertEqual(resp.json, expected)
 
-    @with_config({"firstname": {"type": "str"}, "lastname": {"type": "str"}})
+    @with_config({"firstname": {"type": "str", "sort_key": 2}, "lastname": {"type": "str", "sort_key": 1}})
+    @with_instances(
+        {"firstname": "Luke", "lastname": "Skywalker"},
+        {"firstname": "Padme", "lastname": "Amidala"},
+        {"firstname": "Anakin", "lastname": "Skywalker"},
+        {"firstname": "Han", "lastname": "Solo"},
+        {"firstname": "Leia"},
+    )
+    def test_contact_get_paginated(self, _):
+        names = []
+        resp = self.client.get('/contact?limit=2')
+        while True:
+            self.assert200(resp)
+            self.assertLessEqual(len(resp.json), 2)
+            names.extend(contact['firstname'] for contact in resp.json)
+            cursor = resp.headers.get('X-Next-Cursor')
+            if not cursor:
+                break
+            resp = self.client.get('/contact', query_string={'limit': 2, 'cursor': cursor})
+        # Sorted by lastname then firstname, contacts without lastname first
+        self.assertEqual(names, ['Leia', 'Padme', 'Anakin', 'Luke', 'Han'])
+
+        resp = self.client.get('/contact?sort=-firstname&limit=3')
+        self.assertEqual([contact['firstname'] for contact in resp.json], ['Padme', 'Luke', 'Leia'])
+        cursor = resp.headers['X-Next-Cursor']
+        resp = self.client.get('/contact', query_string={'sort': '-firstname', 'cursor': cursor})
+        self.assertEqual([contact['firstname'] for contact in resp.json], ['Han', 'Anakin'])
+
+        # Cursors are bound to the sort they were built with
+        resp = self.client.get('/contact', query_string={'cursor': cursor})
+        self.assert400(resp)
+        self.assertEqual(resp.json['param'], 'cursor')
+        resp = self.client.get('/contact', query_string={'cursor': 'abc'})
+        self.assert400(resp)
+        self.assertEqual(resp.json['param'], 'cursor')
+        resp = self.client.get('/contact?sort=unknown')
+        self.assert400(resp)
+        self.assertEqual(resp.json['param'], 'sort')
+        resp = self.client.get('/contact?limit=0')
+        self.assert400(resp)
+
+        resp = self.client.get('/contact/groups')
+        self.assert200(resp)
+        self.assertEqual([(group['group'], group['count']) for group in resp.json], [('', 1), ('A', 1), ('S', 3)])
+        resp = self.client.get('/contact', query_string={'limit': 1, 'cursor': resp.json[2]['cursor']})
+        self.assertEqual([contact['firstname'] for contact in resp.json], ['Anakin'])
+        self.assert200(self.client.post('/contact', json={"firstname": "Ben", "lastname": "solo"}))
+        resp = self.client.get('/contact/groups')
+        self.assertEqual([(group['group'], group['count']) for group in resp.json], [('', 1), ('A', 1), ('S', 3), ('s', 1)])
+        # Each group is the slice of the listing starting at its cursor
+        for group in resp.json:
+            page = self.client.get('/contact', query_string={'limit': group['count'], 'cursor': group['cursor'] or ''})
+            self.assertEqual({contact.get('lastname', '')[:1] for contact in page.json}, {group['group']})
+
+    @with_config({
+        "firstname": {"type": "str", "sort_key": 1},
+        "lastname": {"type": "str", "main_attribute": 1},
+        "age": {"type": "integer"},
+        "side": {"type": "select", "additional_type_parameters": {"allowed_values": ["light", "dark"]}},
+        "skills": {"type": "list", "additional_type_parameters": {"inner_type": "str"}},
+        "jedi": {"type": "toggle"},
+    })
+    @with_instances(
+        {"firstname": "Luke", "lastname": "Skywalker", "age": 19, "side": "light", "skills": ["pilot", "force"], "jedi": True},
+        {"firstname": "Leia", "lastname": "Organa", "age": 19, "side": "light", "skills": ["politics"], "jedi": False},
+        {"firstname": "Anakin", "lastname": "Skywalker", "age": 41, "side": "dark", "skills": ["pilot", "force"], "jedi": True},
+        {"firstname": "Lando", "lastname": "Calrissian", "age": 44, "skills": ["pilot"]},
+    )
+    def test_contact_get_filtered(self, _):
+        def firstnames(**filters):
+            resp = self.client.get('/contact', query_string={f'filter.{name}': value for name, value in filters.items()})
+            self.assert200(resp)
+            self.assertNotIn('X-Query-Plan', resp.headers)
+            return sorted(contact['firstname'] for contact in resp.json)
+
+        self.assertEqual(firstnames(lastname='Skywalker'), ['Anakin', 'Luke'])
+        self.assertEqual(firstnames(**{'firstname.prefix': 'La'}), ['Lando'])
+        self.assertEqual(firstnames(**{'firstname.prefix': 'L'}), ['Lando', 'Leia', 'Luke'])
+        self.assertEqual(firstnames(age=19), ['Leia', 'Luke'])
+        self.assertEqual(firstnames(**{'age.gt': 19, 'age.lte': 41}), ['Anakin'])
+        self.assertEqual(firstnames(**{'side.in': 'dark,light'}), ['Anakin', 'Leia', 'Luke'])
+        self.assertEqual(firstnames(**{'skills.contains': 'force'}), ['Anakin', 'Luke'])
+        self.assertEqual(firstnames(jedi='false'), ['Leia'])
+        self.assertEqual(firstnames(jedi='true', side='dark'), ['Anakin'])
+
+        # The filters are run by the DB, over the key indexes with SQLite, and with the containment
+        # operator of the GIN index with PostgreSQL (not used on so few contacts)
+        resp = self.client.get('/contact', query_string={'filter.lastname': 'Organa', 'explain': 'true'})
+        self.assertIn('@>' if db.engine.dialect.name == 'postgresql' else KEY_INDEX_PREFIX, resp.headers['X-Query-Plan'])
+
+        # And the filters are paginated like the whole list
+        resp = self.client.get('/contact', query_string={'filter.skills.contains': 'pilot', 'limit': 2})
+        self.assertEqual([contact['firstname'] for contact in resp.json], ['Anakin', 'Lando'])
+        resp = self.client.get('/contact', query_string={
+            'filter.skills.contains': 'pilot', 'limit': 2, 'cursor': resp.headers['X-Next-Cursor']
+        })
+        self.assertEqual([contact['firstname'] for contact in resp.json], ['Luke'])
+        self.assertNotIn('X-Next-Cursor', resp.headers)
+
+        for param, value in [
+            ('filter.unknown', 'a'),
+            ('filter.age.prefix', '1'),
+            ('filter.age.gte', 'old'),
+            ('filter.jedi', 'yes'),
+            ('filter.lastname', ''),
+        ]:
+            resp = self.client.get('/contact', query_string={param: value})
+            self.assert400(resp)
+            self.assertEqual(resp.json['param'], param)
+
+    @with_config({
+        "number": {"type": "integer", "primary_key": True, "main_attribute": 2},
+        "name": {"type": "str", "main_attribute": 1, "sort_key": 1},
+        "jedi": {"type": "toggle"},
+        "skills": {"type": "list"},
+        "photo": {"type": "image"},
+        "notes": {"type": "long_str"},
+    })
+    @with_instances(
+        {"number": 1, "name": "Luke", "jedi": True, "skills": ["pilot"], "photo": "luke.png", "notes": "Farm boy"},
+        {"number": 2, "name": "Han", "jedi": False},
+    )
+    def test_contact_get_fields(self, instances):
+        luke, han = instances
+        resp = self.client.get('/contact?fields=summary')
+        self.assert200(resp)
+        self.assertEqual(resp.json, [
+            {"id": luke.id, "number": 1, "name": "Luke"},
+            {"id": han.id, "number": 2, "name": "Han"},
+        ])
+
+        # The values keep their type, and the URLs are only built for the file fields asked for
+        full = self.client.get('/contact?sort=-name').json
+        resp = self.client.get('/contact?fields=jedi,skills,photo&limit=1&sort=-name')
+        self.assertEqual(resp.json, [{
+            key: value for key, value in full[0].items() if key in ("id", "jedi", "skills", "photo", THUMBNAILS_KEY)
+        }])
+        self.assertEqual(resp.json[0]["photo"], "http://localhost/luke.png")
+        resp = self.client.get('/contact', query_string={'fields': 'jedi', 'limit': 1, 'sort': '-name', 'cursor': resp.headers['X-Next-Cursor']})
+        self.assertEqual(resp.json, [{"id": han.id, "jedi": False}])
+
+        resp = self.client.get('/contact/by-key/2?fields=name')
+        self.assertEqual(resp.json, {"id": han.id, "name": "Han"})
+        self.assert404(self.client.get('/contact/by-key/3?fields=name'))
+
+        resp = self.client.get('/contact?fields=unknown')
+        self.assert400(resp)
+        self.assertEqual(resp.json['param'], 'fields')
+
+    @with_config({
+        "id": {"type": "integer", "primary_key": True, "required": True},
+        "firstname": {"type": "str"},
+    }, working_dir=".")
+    @with_instances({"id": 1, "firstname": "Luke"}, {"id": 2, "firstname": "Leia"})
+    def test_contact_primary_key(self, instances):
+        resp = self.client.post('/contact', json={"id": 1, "firstname": "Anakin"})
+        self.assertStatus(resp, 409)
+        self.assertEqual(resp.json, {"field": "id", "code": "DUPLICATE_VALUE", "value": 1})
+        resp = self.client.put(f'/contact/{instances[1].id}', json={"id": 1})
+        self.assertStatus(resp, 409)
+
+        resp = self.client.get('/contact/by-key/2')
+        self.assert200(resp)
+        self.assertEqual(resp.json["firstname"], "Leia")
+        self.assert404(self.client.get('/contact/by-key/3'))
+        self.assert404(self.client.get('/contact/by-key/abc'))
+
+        # Cannot switch the primary key to a field with duplicated values
+        self.assert200(self.client.post('/contact', json={"id": 3, "firstname": "Luke"}))
+        resp = self.client.put('/config', json={
+            "id": {"type": "integer", "required": True},
+            "firstname": {"type": "str", "primary_key": True, "required": True},
+        })
+        self.assertStatus(resp, 409)
+        self.assertEqual(resp.json, {"field": "firstname", "code": "DUPLICATE_VALUE", "value": "Luke"})
+        self.assertEqual(self.client.get('/config').json["id"].get("primary_key"), True)
+
+    @with_config({
+        "firstname": {"type": "str"},
+        "lastname": {"type": "str"},
+        "age": {"type": "integer"},
+        "tags": {"type": "list", "additional_type_parameters": {"inner_type": "str"}},
+    })
+    @with_instances(
+        {"firstname": "Luke", "lastname": "Skywalker", "tags": ["jedi"]},
+        {"firstname": "Anakin", "lastname": "Skywalker", "tags": ["jedi", "sith"]},
+        {"firstname": "Han", "lastname": "Solo", "age": 32},
+        ignore_deleted_on_delete=True,
+    )
+    def test_contact_search(self, instances):
+        def search(query):
+            resp = self.client.get('/contact/search', query_string={'q': query})
+            self.assert200(resp)
+            return [contact['firstname'] for contact in resp.json]
+
+        self.assertCountEqual(search('sky'), ['Luke', 'Anakin'])
+        self.assertEqual(search('sky jedi sith'), ['Anakin'])
+        # Most relevant first
+        self.assertEqual(search('jedi sith')[0], 'Anakin')
+        self.assertEqual(search('32'), [])
+        self.assertEqual(search('"*'), [])
+
+        # The index follows the updates and deletions
+        self.client.put(f'/contact/{instances[2].id}', json={"lastname": "Skywalker"})
+        self.assertCountEqual(search('skywalker'), ['Luke', 'Anakin', 'Han'])
+        self.client.delete(f'/contact/{instances[0].id}')
+        self.assertCountEqual(search('skywalker'), ['Anakin', 'Han'])
+
+        # Indexed again in the background when the searchable fields change
+        config = dict(
+            get_config().raw,
+            firstname={"type": "str", "primary_key": True, "required": True},
+            lastname={"type": "select", "additional_type_parameters": {"allowed_values": ["Skywalker", "Solo"]}},
+        )
+        self.assertStatus(self.client.put('/config', json=config), 202)
+        self.assertCountEqual(search('skywalker'), ['Anakin', 'Han'])
+        run_migrations()
+        self.assertEqual(search('skywalker'), [])
+        self.assertEqual(search('anakin'), ['Anakin'])
+
+    @with_config({
+        "number": {"type": "integer", "primary_key": True, "required": True},
+        "firstname": {"type": "str"},
+        "jedi": {"type": "toggle"},
+    })
+    @with_instances({"number": 1, "firstname": "Luke"})
+    def test_contact_bulk_post(self, _):
+        resp = self.client.post('/contact/bulk', json=[
+            {"number": 2, "firstname": "Leia"},
+            {"number": 1, "firstname": "Anakin"},
+            {"firstname": "Han"},
+            {"number": 3, "firstname": 3},
+            "Obi-Wan",
+        ])
+        self.assert200(resp)
+        self.assertEqual(resp.json, {"inserted": 1, "errors": [
+            {"row": 1, "code": "DUPLICATE_VALUE", "field": "number", "value": 1},
+            {"row": 2, "code": "MISSING_VALUE_REQUIRED", "field": "number"},
+            {"row": 3, "code": "WRONG_TYPE", "field": "firstname", "expected_type": "str"},
+            {"row": 4, "code": "INVALID_RECORD", "message": "Record must be a JSON object"},
+        ]})
+
+        ndjson = '{"number": 4, "firstname": "Rey"}\n\n{"number": 4, "firstname": "Finn"}\n{"number": 5,\n'
+        resp = self.client.post('/contact/bulk', data=ndjson, content_type='application/x-ndjson')
+        self.assertEqual(resp.json, {"inserted": 1, "errors": [
+            {"row": 1, "code": "DUPLICATE_VALUE", "field": "number", "value": 4},
+            {"row": 2, "code": "INVALID_RECORD", "message": "Line is not a valid JSON"},
+        ]})
+
+        csv = 'number,firstname,jedi\n6,Yoda,yes\n7,Jabba,false\nabc,Greedo,\n'
+        resp = self.client.post('/contact/bulk', data=csv, content_type='text/csv')
+        self.assertEqual(resp.json, {"inserted": 2, "errors": [
+            {"row": 2, "code": "WRONG_TYPE", "field": "number", "expected_type": "integer"},
+        ]})
+
+        # Not UTF-8, reported for the line or the row only
+        resp = self.client.post('/contact/bulk', data=b'{"number": 10, "firstname": "Z\xe9b"}\n', content_type='application/x-ndjson')
+        self.assertEqual(resp.json, {"inserted": 0, "errors": [
+            {"row": 0, "code": "INVALID_RECORD", "message": "Line is not valid UTF-8"},
+        ]})
+        data = b'number,firstname\n10,Z\xe9b\n11,' + b'x' * 200000 + b'\n12,Wat\n'
+        resp = self.client.post('/contact/bulk', data=data, content_type='text/csv')
+        self.assertEqual(resp.json['inserted'], 1)
+        self.assertEqual([(error['row'], error['message']) for error in resp.json['errors']], [
+            (0, 'Row is not valid UTF-8'),
+            (1, 'Row is not a valid CSV: field larger than field limit (131072)'),
+        ])
+        self.assert400(self.client.post('/contact/bulk', data=b'number,\xe9\n', content_type='text/csv'))
+
+        # Only validated, with every error of each record
+        resp = self.client.post('/contact/bulk?validate_only=true', json=[
+            {"number": 8, "firstname": "Maul"},
+            {"number": 7, "firstname": 8, "jedi": "no"},
+        ])
+        self.assertEqual(resp.json, {"valid": 1, "errors": [
+            {"row": 1, "code": "WRONG_TYPE", "field": "firstname", "expected_type": "str"},
+            {"row": 1, "code": "WRONG_TYPE", "field": "jedi", "expected_type": "boolean"},
+        ]})
+        resp = self.client.post('/contact/bulk?validate_only=true', json=[{"number": 7, "firstname": "Jabba"}])
+        self.assertEqual(resp.json, {"valid": 0, "errors": [
+            {"row": 0, "code": "DUPLICATE_VALUE", "field": "number", "value": 7},
+        ]})
+
+        self.assert400(self.client.post('/contact/bulk', data='{}', content_type='application/json'))
+        self.assertStatus(self.client.post('/contact/bulk', data='a', content_type='text/plain'), 415)
+
+        resp = self.client.get('/contact?sort=number')
+        self.assertEqual(
+            [(contact['number'], contact['firstname'], contact.get('jedi')) for contact in resp.json],
+            [(1, 'Luke', None), (2, 'Leia', None), (4, 'Rey', None), (6, 'Yoda', True), (7, 'Jabba', False), (12, 'Wat', None)]
+        )
+        # Imported contacts are searchable
+        resp = self.client.get('/contact/search?q=yod')
+        self.assertEqual([contact['firstname'] for contact in resp.json], ['Yoda'])
+
+    @with_config({"names": {"type": "list", "primary_key": True, "required": True}})
+    @with_instances({"names": ["Luke", "Skywalker"]})
+    def test_contact_bulk_post_list_key(self, _):
+        resp = self.client.post('/contact/bulk', json=[
+            {"names": ["Leia", "Organa"]},
+            {"names": ["Leia", "Organa"]},
+            {"names": ["Luke", "Skywalker"]},
+        ])
+        self.assertEqual(resp.json, {"inserted": 1, "errors": [
+            {"row": 1, "code": "DUPLICATE_VALUE", "field": "names", "value": ["Leia", "Organa"]},
+            {"row": 2, "code": "DUPLICATE_VALUE", "field": "names", "value": ["Luke", "Skywalker"]},
+        ]})
+
+    @with_config({
+        "firstname": {"type": "str"},
+        "tags": {"type": "list", "additional_type_parameters": {"inner_type": "str"}},
+        "jedi": {"type": "toggle"},
+    })
+    @with_instances(
+        {"firstname": "Luke", "tags": ["pilot"], "jedi": True},
+        {"firstname": "Han, Solo", "jedi": False},
+    )
+    def test_contact_export_get(self, _):
+        resp = self.client.get('/contact/export')
+        self.assert200(resp)
+        self.assertTrue(resp.is_streamed)
+        self.assertEqual(resp.content_type, 'application/x-ndjson')
+        self.assertEqual([json.loads(line) for line in resp.data.decode().splitlines()], [
+            {"id": 1, "firstname": "Luke", "tags": ["pilot"], "jedi": True},
+            {"id": 2, "firstname": "Han, Solo", "jedi": False},
+        ])
+
+        resp = self.client.get('/contact/export?format=json')
+        self.assertEqual(resp.content_type, 'application/json')
+        self.assertEqual([contact['firstname'] for contact in resp.json], ['Luke', 'Han, Solo'])
+
+        resp = self.client.get('/contact/export?format=csv')
+        self.assertEqual(resp.content_type, 'text/csv')
+        self.assertEqual(resp.data.decode().splitlines(), [
+            'id,firstname,tags,jedi',
+            '1,Luke,"[""pilot""]",true',
+            '2,"Han, Solo",,false',
+        ])
+
+        self.assert400(self.client.get('/contact/export?format=xml'))
+
+    @with_config({
+        "firstname": {"type": "str", "required": True},
+        "lastname": {"type": "str"},
+        "age": {"type": "integer"},
+    })
     def test_contact_post(self):
         resp = self.client.post('/contact', json={"firstname": "Luke", "lastname": "Skywalker"})
         self.assert200(resp)
@@ -144,6 +693,19 @@ class ApiTest(BaseTestCase):
         expected = {"id": 1, "firstname": "Luke", "lastname": "Skywalker"}
         self.assertEqual(resp.json, expected)
 
+        # All the invalid values are reported at once, the first one also at the top level
+        resp = self.client.post('/contact', json={"lastname": 1, "age": "19"})
+        self.assert400(resp)
+        self.assertEqual(resp.json, {
+            "field": "firstname",
+            "code": "MISSING_VALUE_REQUIRED",
+            "errors": [
+                {"field": "firstname", "code": "MISSING_VALUE_REQUIRED"},
+                {"field": "lastname", "code": "WRONG_TYPE", "expected_type": "str"},
+                {"field": "age", "code": "WRONG_TYPE", "expected_type": "integer"},
+            ],
+        })
+
     @with_config({"firstname": {"type": "str"}, "lastname": {"type": "str"}})
     @with_instances({"firstname": "Ben", "lastname": "Solo"})
     def test_contact_id_put(self, _):
@@ -153,6 +715,45 @@ class ApiTest(BaseTestCase):
         expected = {"id": 1, "firstname": "Kylo", "lastname": "Ren"}
         self.assertEqual(resp.json, expected)
 
+    @with_config({"firstname": {"type": "str", "main_attribute": 1}, "lastname": {"type": "str"}})
+    @with_instances({"firstname": "Ben", "lastname": "Solo"}, {"firstname": "Rey"})
+    def test_contact_id_get(self, instances):
+        ben, rey = instances
+
+        def stats():
+            return self.client.get('/contact/cache').json
+
+        before = stats()
+        resp = self.client.get(f'/contact/{ben.id}')
+        self.assert200(resp)
+        self.assertEqual(resp.json, {"id": ben.id, "firstname": "Ben", "lastname": "Solo"})
+        etag = resp.headers['ETag']
+        self.assertEqual(stats()["misses"], before["misses"] + 1)
+
+        # Served from the cache, and not sent again to a client that already has it, without even
+        # looking for it
+        resp = self.client.get(f'/contact/{ben.id}')
+        self.assertEqual(resp.json["firstname"], "Ben")
+        self.assertEqual(resp.headers['ETag'], etag)
+        self.assertTrue(etag.startswith(f'"{Contact.query.get(ben.id).updated_version}-'))
+        last_modified = resp.headers['Last-Modified']
+        resp = self.client.get(f'/contact/{ben.id}', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, 304)
+        resp = self.client.get(f'/contact/{ben.id}', headers={'If-Modified-Since': last_modified})
+        self.assertEqual(resp.status_code, 304)
+        self.assertEqual(stats()["hits"], before["hits"] + 1)
+
+        # A change of the contact is never served from the cache
+        self.assert200(self.client.put(f'/contact/{ben.id}', json={"firstname": "Kylo", "lastname": "Ren"}))
+        resp = self.client.get(f'/contact/{ben.id}', headers={'If-None-Match': etag})
+        self.assert200(resp)
+        self.assertEqual(resp.json, {"id": ben.id, "firstname": "Kylo", "lastname": "Ren"})
+        self.assertNotEqual(resp.headers['ETag'], etag)
+
+        resp = self.client.get(f'/contact/{rey.id}?fields=summary')
+        self.assertEqual(resp.json, {"id": rey.id, "firstname": "Rey"})
+        self.assert404(self.client.get(f'/contact/{rey.id + 1}'))
+
     @with_config({"firstname": {"type": "str"}, "lastname": {"type": "str"}})
     @with_instances({"firstname": "Ben", "lastname": "Solo"}, ignore_deleted_on_delete=True)
     def test_contact_id_delete(self, _):
@@ -160,6 +761,437 @@ class ApiTest(BaseTestCase):
         self.assert200(resp)
         self.assertEqual(resp.data, b'')
 
+    @with_config({
+        "firstname": {"type": "str"},
+        "photo": {"type": "image", "additional_type_parameters": {"accepted_types": ["png"]}},
+    })
+    @with_instances({"firstname": "Luke"}, {"firstname": "Leia"}, ignore_deleted_on_delete=True)
+    def test_contact_file_post_put(self, instances):
+        content = str(uuid4()).encode()
+
+        def upload(contact, content, filename='photo.png'):
+            resp = self.client.post(
+                f'/contact/{contact.id}/files',
+                data={'photo': (BytesIO(content), filename)},
+                content_type='multipart/form-data',
+            )
+            self.assert200(resp)
+            return resp.json['photo'].split('/')[-1]
+
+        # Same content uploaded twice is stored once, under its hash
+        luke_photo = upload(instances[0], content)
+        self.assertEqual(luke_photo, sha256(content).hexdigest() + '.png')
+        self.assertEqual(upload(instances[1], content, 'other.PNG'), luke_photo)
+        path = os.path.join(os.environ.get('UPLOAD_FOLDER', 'uploads'), luke_photo)
+        self.assertTrue(os.path.isfile(path))
+
+        # Removed only when the last contact using it is gone
+        self.assert200(self.client.delete(f'/contact/{instances[0].id}'))
+        self.assertTrue(os.path.isfile(path))
+        new_photo = upload(instances[1], content + b'new')
+        drain_file_removals()
+        self.assertFalse(os.path.isfile(path))
+        self.assertTrue(os.path.isfile(os.path.join(os.environ.get('UPLOAD_FOLDER', 'uploads'), new_photo)))
+
+        # Nothing is stored for a rejected file
+        files = set(os.listdir(os.environ.get('UPLOAD_FOLDER', 'uploads')))
+        for filename in ('photo.gif', 'noext'):
+            resp = self.client.post(
+                f'/contact/{instances[1].id}/files',
+                data={'photo': (BytesIO(b'rejected'), filename)},
+                content_type='multipart/form-data',
+            )
+            self.assert400(resp)
+            self.assertEqual(resp.json['field'], 'photo')
+        self.assertEqual(set(os.listdir(os.environ.get('UPLOAD_FOLDER', 'uploads'))), files)
+
+    @unittest.skipUnless(mock_aws, 'boto3 and moto are not installed')
+    @with_config({"firstname": {"type": "str"}, "photo": {"type": "image"}})
+    @with_instances({"firstname": "Lando"}, ignore_deleted_on_delete=True)
+    def test_contact_file_post_put_s3(self, instances):
+        env = {
+            'STORAGE_BACKEND': 's3',
+            'S3_BUCKET': 'contacts',
+            'S3_PREFIX': 'uploads/',
+            'S3_PART_SIZE': str(5 * 1024 * 1024),
+            'AWS_ACCESS_KEY_ID': 'key',
+            'AWS_SECRET_ACCESS_KEY': 'secret',
+            'AWS_DEFAULT_REGION': 'us-east-1',
+        }
+        old_env = {name: os.environ.get(name) for name in env}
+        os.environ.update(env)
+        try:
+            with mock_aws():
+                boto3.client('s3').create_bucket(Bucket='contacts')
+                storage = get_storage()
+                self.assertIsInstance(storage, S3Storage)
+
+                # Large files are sent with a multipart upload
+                content = str(uuid4()).encode() * 200000
+                writer = storage.writer('big.bin')
+                for position in range(0, len(content), 1024 * 1024):
+                    writer.write(content[position:position + 1024 * 1024])
+                self.assertEqual(writer.commit(), sha256(content).hexdigest() + '.bin')
+                with storage.open(sha256(content).hexdigest() + '.bin') as file:
+                    self.assertEqual(file.read(), content)
+                self.assertEqual([info.name for info in storage.list()], [sha256(content).hexdigest() + '.bin'])
+
+                content = str(uuid4()).encode()
+                resp = self.client.post(
+                    f'/contact/{instances[0].id}/files',
+                    data={'photo': (BytesIO(content), 'photo.png')},
+                    content_type='multipart/form-data',
+                )
+                self.assert200(resp)
+                filename = sha256(content).hexdigest() + '.png'
+                key = boto3.client('s3').get_object(Bucket='contacts', Key=f'uploads/{filename}')
+                self.assertEqual(key['Body'].read(), content)
+                self.assertEqual(key['ContentType'], 'image/png')
+
+                # Downloaded from the store directly
+                resp = self.client.get(f'/{filename}')
+                self.assertStatus(resp, 302)
+                self.assertRegex(resp.headers['Location'], f'contacts.*/uploads/{filename}\\?.*Signature=')
+
+                self.assert200(self.client.delete(f'/contact/{instances[0].id}'))
+                drain_file_removals()
+                self.assertIsNone(storage.stat(filename))
+        finally:
+            for name, value in old_env.items():
+                if value is None:
+                    del os.environ[name]
+                else:
+                    os.environ[name] = value
+
+    @with_config({
+        "firstname": {"type": "str"},
+        "photo": {"type": "image"},
+        "logo": {"type": "image", "additional_type_parameters": {"max_size": 8}},
+    })
+    @with_instances({"firstname": "Poe"})
+    def test_contact_file_post_put_streamed(self, instances):
+        folder = os.environ.get('UPLOAD_FOLDER', 'uploads')
+        def upload(**files):
+            return self.client.post(
+                f'/contact/{instances[0].id}/files',
+                data=dict({'firstname': 'ignored'}, **{field: (BytesIO(content), f'{field}.png') for field, content in files.items()}),
+                content_type='multipart/form-data',
+            )
+
+        # Several fields in one request
+        photo, logo = str(uuid4()).encode() * 100, b'1234'
+        resp = upload(photo=photo, logo=logo)
+        self.assert200(resp)
+        self.assertEqual(resp.json['firstname'], 'Poe')
+        self.assertEqual(resp.json['photo'], f'http://localhost/{sha256(photo).hexdigest()}.png')
+        self.assertEqual(resp.json['logo'], f'http://localhost/{sha256(logo).hexdigest()}.png')
+        stats = json.loads(resp.headers['X-Upload-Stats'])
+        self.assertEqual({field: stat['bytes'] for field, stat in stats.items()}, {'photo': len(photo), 'logo': len(logo)})
+
+        # Limit of the field, then of the request, and nothing left behind
+        files = set(os.listdir(folder))
+        resp = upload(photo=b'other', logo=b'123456789')
+        self.assertStatus(resp, 413)
+        self.assertEqual(resp.json, {"field": "logo", "code": "UPLOAD_TOO_LARGE", "limit": 8})
+        os.environ['MAX_UPLOAD_REQUEST_SIZE'] = '1000'
+        try:
+            resp = upload(photo=photo)
+        finally:
+            del os.environ['MAX_UPLOAD_REQUEST_SIZE']
+        self.assertStatus(resp, 413)
+        self.assertEqual(resp.json, {"field": None, "code": "UPLOAD_TOO_LARGE", "limit": 1000})
+        self.assertEqual(set(os.listdir(folder)), files)
+
+    @with_config({"firstname": {"type": "str"}, "photo": {"type": "image"}})
+    @with_instances({"firstname": "Rey"})
+    def test_filename_get(self, instances):
+        content = b'0123456789' + str(uuid4()).encode()
+        resp = self.client.post(
+            f'/contact/{instances[0].id}/files',
+            data={'photo': (BytesIO(content), 'photo.png')},
+            content_type='multipart/form-data',
+        )
+        filename = resp.json['photo'].split('/')[-1]
+
+        resp = self.client.get(f'/{filename}')
+        self.assert200(resp)
+        self.assertEqual(resp.data, content)
+        self.assertEqual(resp.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        self.assertEqual(resp.get_etag(), (sha256(content).hexdigest(), False))
+        resp.close()
+
+        resp = self.client.get(f'/{filename}', headers={'If-None-Match': resp.headers['ETag']})
+        self.assertStatus(resp, 304)
+        resp.close()
+        resp = self.client.get(f'/{filename}', headers={'Range': 'bytes=2-5'})
+        self.assertStatus(resp, 206)
+        self.assertEqual(resp.data, b'2345')
+        resp.close()
+
+        os.environ['FILE_SENDING_MODE'] = 'x-accel-redirect'
+        try:
+            resp = self.client.get(f'/{filename}')
+        finally:
+            del os.environ['FILE_SENDING_MODE']
+        self.assert200(resp)
+        self.assertEqual(resp.headers['X-Accel-Redirect'], f'/_uploads/{filename}')
+        self.assertEqual(resp.data, b'')
+
+        self.assert404(self.client.get('/unknown.png'))
+
+    @unittest.skipUnless(thumbnails_enabled(), 'Pillow is not installed')
+    @with_config({"firstname": {"type": "str"}, "photo": {"type": "image"}})
+    @with_instances({"firstname": "Finn"}, {"firstname": "Rose"}, ignore_deleted_on_delete=True)
+    def test_thumbnail_get(self, instances):
+        image = BytesIO()
+        Image.new('RGB', (600, 300), (255, 232, 31)).save(image, format='PNG')
+        image.seek(0)
+        resp = self.client.post(
+            f'/contact/{instances[0].id}/files',
+            data={'photo': (image, 'photo.png')},
+            content_type='multipart/form-data',
+        )
+        self.assert200(resp)
+        filename = resp.json['photo'].split('/')[-1]
+        self.assertEqual(
+            resp.json['_thumbnails']['photo'],
+            {
+                '64': f'http://localhost/thumbnails/64/{filename}',
+                '64.webp': f'http://localhost/thumbnails/64/{filename}.webp',
+                '256': f'http://localhost/thumbnails/256/{filename}',
+                '256.webp': f'http://localhost/thumbnails/256/{filename}.webp',
+            }
+        )
+
+        # Removed from the cache on disk, and generated again when requested
+        path = os.path.join(os.environ.get('UPLOAD_FOLDER', 'uploads'), 'thumbnails', '256', filename + '.webp')
+        if os.path.exists(path):
+            os.remove(path)
+        resp = self.client.get(f'/thumbnails/256/{filename}.webp')
+        self.assert200(resp)
+        self.assertEqual(resp.headers['Cache-Control'], 'public, max-age=31536000, immutable')
+        with Image.open(BytesIO(resp.data)) as thumbnail:
+            self.assertEqual((thumbnail.format, thumbnail.size), ('WEBP', (256, 128)))
+        resp.close()
+        self.assertTrue(os.path.isfile(path))
+
+        self.assert404(self.client.get(f'/thumbnails/100/{filename}'))
+        self.assert404(self.client.get('/thumbnails/64/unknown.png'))
+
+        # In the format of their name
+        image = BytesIO()
+        Image.new('P', (600, 300)).save(image, format='GIF')
+        image.seek(0)
+        resp = self.client.post(
+            f'/contact/{instances[1].id}/files',
+            data={'photo': (image, 'photo.gif')},
+            content_type='multipart/form-data',
+        )
+        resp = self.client.get(f'/thumbnails/64/{resp.json["photo"].split("/")[-1]}')
+        self.assert200(resp)
+        self.assertEqual(resp.content_type, 'image/gif')
+        with Image.open(BytesIO(resp.data)) as thumbnail:
+            self.assertEqual((thumbnail.format, thumbnail.size), ('GIF', (64, 32)))
+        resp.close()
+
+        # Never stored with the contact
+        self.assert200(self.client.put(f'/contact/{instances[0].id}', json={"_thumbnails": {}, "firstname": "FN-2187"}))
+        self.assertNotIn('_thumbnails', json.loads(Contact.query.get(instances[0].id).infos))
+
+        self.assert200(self.client.delete(f'/contact/{instances[0].id}'))
+        drain_file_removals()
+        self.assertFalse(os.path.isfile(path))
+
+    @with_config({"firstname": {"type": "str"}, "lastname": {"type": "str"}})
+    @with_instances({"firstname": "Ben", "lastname": "Solo"})
+    def test_contact_get_conditional(self, instances):
+        resp = self.client.get('/contact')
+        self.assert200(resp)
+        etag, _ = resp.get_etag()
+        self.assertIsNotNone(resp.last_modified)
+
+        resp = self.client.get('/contact', headers={'If-None-Match': f'"{etag}"'})
+        self.assertStatus(resp, 304)
+        self.assertEqual(resp.data, b'')
+        resp = self.client.get('/contact?limit=1', headers={'If-None-Match': f'"{etag}"'})
+        self.assertStatus(resp, 304)
+
+        # Every change gives a new version
+        etags = {etag}
+        for method, url, body in [
+            ('post', '/contact', {"firstname": "Kylo"}),
+            ('put', f'/contact/{instances[0].id}', {"lastname": "Ren"}),
+            ('delete', '/contact/2', None),
+        ]:
+            self.assert200(getattr(self.client, method)(url, json=body))
+            resp = self.client.get('/contact', headers={'If-None-Match': f'"{etag}"'})
+            self.assert200(resp)
+            etag, _ = resp.get_etag()
+            self.assertNotIn(etag, etags)
+            etags.add(etag)
+
+        # The dates cannot tell apart the changes made within the same second
+        last_modified = self.client.get('/contact').headers['Last-Modified']
+        self.assert200(self.client.post('/contact', json={"firstname": "Rey"}))
+        resp = self.client.get('/contact', headers={'If-Modified-Since': last_modified})
+        self.assert200(resp)
+        self.assertIn('Rey', [contact['firstname'] for contact in resp.json])
+
+    @with_config({"firstname": {"type": "str"}, "lastname": {"type": "str"}})
+    @with_instances(
+        {"firstname": "Ben", "lastname": "Solo"},
+        {"firstname": "Han", "lastname": "Solo"},
+        ignore_deleted_on_delete=True,
+    )
+    def test_contact_changes_get(self, instances):
+        resp = self.client.get('/contact/changes')
+        self.assert200(resp)
+        version = resp.json['version']
+        self.assertEqual([contact['firstname'] for contact in resp.json['contacts']], ['Ben', 'Han'])
+        self.assertEqual(resp.json['deleted'], [])
+
+        resp = self.client.get(f'/contact/changes?since={version}')
+        self.assertEqual(resp.json, {"version": version, "contacts": [], "deleted": []})
+
+        self.client.put(f'/contact/{instances[0].id}', json={"firstname": "Kylo", "lastname": "Ren"})
+        self.client.post('/contact/bulk', json=[{"firstname": "Rey"}])
+        self.client.delete(f'/contact/{instances[1].id}')
+        resp = self.client.get(f'/contact/changes?since={version}')
+        self.assertEqual(resp.json['version'], version + 3)
+        self.assertEqual(
+            [(contact['id'], contact['firstname']) for contact in resp.json['contacts']],
+            [(instances[0].id, 'Kylo'), (3, 'Rey')]
+        )
+        self.assertEqual(resp.json['deleted'], [instances[1].id])
+
+        self.assert400(self.client.get('/contact/changes?since=-1'))
+
+    @with_config({"id": {"type": "str", "primary_key": True, "required": True}}, working_dir=".")
+    def test_config_get_conditional(self):
+        resp = self.client.get('/config')
+        etag, _ = resp.get_etag()
+        resp.close()
+        resp = self.client.get('/config', headers={'If-None-Match': f'"{etag}"'})
+        self.assertStatus(resp, 304)
+
+        self.assert200(self.client.put('/config', json={
+            "id": {"type": "str", "primary_key": True, "required": True},
+            "firstname": {"type": "str"},
+        }))
+        resp = self.client.get('/config', headers={'If-None-Match': f'"{etag}"'})
+        self.assert200(resp)
+        self.assertIn("firstname", resp.json)
+        resp.close()
+
+    @with_config({
+        "number": {"type": "str", "primary_key": True, "required": True},
+        "age": {"type": "str"},
+        "jedi": {"type": "str"},
+        "nickname": {"type": "str"},
+    }, working_dir=".")
+    @with_instances(
+        {"number": "1", "age": "19", "jedi": "yes", "nickname": "Wormie"},
+        {"number": "2", "age": "unknown"},
+        {"number": "3", "age": "53", "jedi": "no"},
+    )
+    def test_config_migration(self, instances):
+        ids = [instance.id for instance in instances]
+        self.assert404(self.client.get('/config/migration'))
+
+        new_config = {
+            "number": {"type": "integer", "primary_key": True, "required": True},
+            "age": {"type": "integer"},
+            "jedi": {"type": "toggle"},
+            "side": {
+                "type": "select",
+                "required": True,
+                "default": "light",
+                "additional_type_parameters": {"allowed_values": ["light", "dark"]},
+            },
+        }
+        resp = self.client.put('/config', json=new_config)
+        self.assertStatus(resp, 202)
+        self.assertEqual(resp.json['status'], 'running')
+        self.assertEqual(resp.json['total'], 3)
+        self.assertEqual(resp.json['changes'], {
+            "removed": ["nickname"],
+            "added": ["side"],
+            "changed": {"number": ["type"], "age": ["type"], "jedi": ["type"]},
+        })
+        # Not changed again until all the contacts are migrated
+        self.assertStatus(self.client.put('/config', json=new_config), 409)
+        # Even by a change that was not refused before this one was saved
+        with db.engine.begin() as connection:
+            with self.assertRaises(MigrationRunningException):
+                start_migration(connection, new_config, dict(new_config, age={"type": "str"}))
+
+        self.assertTrue(run_migration_batch(2))
+        resp = self.client.get('/config/migration')
+        self.assertEqual((resp.json['status'], resp.json['processed'], resp.json['migrated']), ('running', 2, 1))
+        # Not run by a worker while another one migrates
+        self.assertTrue(acquire_lease(MIGRATION_LEASE, 'other', 60))
+        run_migrations(holder='worker')
+        self.assertEqual(self.client.get('/config/migration').json['processed'], 2)
+        release_lease(MIGRATION_LEASE, 'other')
+        run_migrations(holder='worker')
+        resp = self.client.get('/config/migration')
+        self.assertEqual((resp.json['status'], resp.json['processed'], resp.json['migrated']), ('done', 3, 2))
+        self.assertEqual(resp.json['failures'], [
+            {"id": ids[1], "errors": [{"field": "age", "code": "WRONG_TYPE", "expected_type": "integer"}]},
+        ])
+
+        db.session.expire_all()
+        resp = self.client.get('/contact')
+        self.assertEqual(resp.json, [
+            {"id": ids[0], "number": 1, "age": 19, "jedi": True, "side": "light"},
+            # Left as it was
+            {"id": ids[1], "number": "2", "age": "unknown"},
+            {"id": ids[2], "number": 3, "age": 53, "jedi": False, "side": "light"},
+        ])
+        # Nothing to migrate
+        self.assert200(self.client.put('/config', json=dict(new_config, age={"type": "integer", "display_name": "Age"})))
+
+    @with_config({"number": {"type": "str", "primary_key": True, "required": True}, "age": {"type": "str"}})
+    @with_instances({"number": "1", "age": "19"}, {"number": "2", "age": "unknown"}, {"number": "3"})
+    def test_config_dry_run_post(self, instances):
+        ids = [instance.id for instance in instances]
+        new_config = {
+            "number": {"type": "str", "primary_key": True, "required": True},
+            "age": {"type": "integer", "required": True},
+        }
+        resp = self.client.post('/config/dry-run', json=new_config)
+        self.assert200(resp)
+        self.assertEqual(resp.json, {
+            "changes": {"removed": [], "added": [], "changed": {"age": ["type", "required"]}},
+            "total": 3,
+            "migrated": 1,
+            "failed": 2,
+            "fields": {"age": {"failed": 2, "codes": {"WRONG_TYPE": 1, "MISSING_VALUE_REQUIRED": 1}, "sample_ids": ids[1:]}},
+        })
+        # Nothing changed
+        self.assertEqual(self.client.get('/contact').json[0]['age'], '19')
+        self.assertEqual(
+            dry_run_migration(dict(get_config().raw), new_config, processes=2, pool_threshold=0),
+            resp.json,
+        )
+        self.assert400(self.client.post('/config/dry-run', json={"age": {"type": "integer"}}))
+
+        # The new primary keys are checked as by the migration
+        new_config = {
+            "number": {"type": "str"},
+            "code": {"type": "str", "primary_key": True, "required": True, "default": "x"},
+            "age": {"type": "str"},
+        }
+        expected = {
+            "changes": {"removed": [], "added": ["code"], "changed": {"number": ["required"]}},
+            "total": 3,
+            "migrated": 1,
+            "failed": 2,
+            "fields": {"code": {"failed": 2, "codes": {"DUPLICATE_VALUE": 2}, "sample_ids": ids[1:]}},
+        }
+        self.assertEqual(self.client.post('/config/dry-run', json=new_config).json, expected)
+        self.assertEqual(dry_run_migration(dict(get_config().raw), new_config, processes=2, pool_threshold=0), expected)
+
     # This test will trigger a "ResourceWarning: unclosed file" warning, because it looks like Flask
     # never closes the file when sending it from directory (see flask.helpers:send_file). This
     # function was moved to Werkzeug in Flask 2.0.0, so perhaps it'll be fixed then. To be checked
@@ -214,6 +1246,67 @@ class ConfigTest(unittest.TestCase):
             self.assertTrue(status)
             self.assertEqual(msg, 'Valid config file!')
 
+    def test_get_config_registry(self):
+        with NamedTemporaryFile(mode='w+', suffix=".json") as temp_config:
+            temp_config.write(json.dumps({"firstname": {"type": "str"}}))
+            temp_config.flush()
+            config = get_config(temp_config.name)
+            # Same file, unchanged: the same instance is handed out
+            self.assertIs(get_config(temp_config.name), config)
+            self.assertEqual([field.name for field in config.fields], ['firstname'])
+            with self.assertRaises(AttributeError):
+                config.fields = []
+
+            # File changed on disk: reloaded
+            temp_config.seek(0)
+            temp_config.write(json.dumps({"firstname": {"type": "str"}, "photo": {"type": "image"}}))
+            temp_config.flush()
+            reloaded = get_config(temp_config.name)
+            self.assertIsNot(reloaded, config)
+            self.assertEqual(reloaded.file_fields, ('photo',))
+
+            # Explicit invalidation
+            invalidate_config(temp_config.name)
+            self.assertIsNot(get_config(temp_config.name), reloaded)
+
+    def test_config_check(self):
+        config = Config.from_dict({
+            "firstname": {"type": "str", "required": True},
+            "age": {"type": "integer"},
+            "tags": {"type": "list", "additional_type_parameters": {"inner_type": "str"}},
+            "photo": {"type": "image", "additional_type_parameters": {"accepted_types": ["png", "JPG"]}},
+            "logo": {"type": "image"},
+            "side": {"type": "select", "additional_type_parameters": {"allowed_values": ["light", "dark"]}},
+        })
+        self.assertTrue(config.check({"firstname": "Luke", "age": 19, "tags": ["pilot"], "photo": "luke.jpg", "side": "light"}))
+        self.assertTrue(config.check({"firstname": "Luke", "logo": "rebels.gif"}))
+        self.assertTrue(config.check({"age": 19}, fields_to_skip=['firstname']))
+        for value, exception, field in [
+            ({"age": 19}, MissingRequiredValueException, "firstname"),
+            ({"firstname": "Luke", "age": "19"}, WrongTypeException, "age"),
+            ({"firstname": "Luke", "tags": ["pilot", 1]}, WrongTypeException, "tags"),
+            ({"firstname": "Luke", "photo": "luke.gif"}, InvalidValueException, "photo"),
+            ({"firstname": "Luke", "photo": "luke"}, InvalidValueException, "photo"),
+            ({"firstname": "Luke", "logo": "rebels"}, InvalidValueException, "logo"),
+            ({"firstname": "Luke", "side": "grey"}, InvalidValueException, "side"),
+        ]:
+            with self.subTest(value=value):
+                with self.assertRaises(exception) as context:
+                    config.check(value)
+                self.assertEqual(context.exception.field, field)
+
+        self.assertEqual(config.validate({"firstname": "Luke"}), [])
+        errors = config.validate({"age": "19", "tags": "pilot", "side": "grey"})
+        self.assertEqual(
+            [(type(error), error.field) for error in errors],
+            [
+                (MissingRequiredValueException, "firstname"),
+                (WrongTypeException, "age"),
+                (WrongTypeException, "tags"),
+                (InvalidValueException, "side"),
+            ],
+        )
+
     def test_valid_config(self):
         params = [
             # primary key related configs
@@ -358,6 +1451,21 @@ class ConfigTest(unittest.TestCase):
                 }
             },
 
+            {
+                'name': '"default" param must be one of "allowed_values" with "type": "select"',
+                'config': {
+                    "param": {"type": "select", "default": "c", "additional_type_parameters": {
+                        "allowed_values": ["a", "b"]
+                    }}
+                },
+                'with_pk': True,
+                'exception_params': {
+                    'field': 'param',
+                    'param': 'default',
+                    'msg': 'Invalid value of parameter "default" for field "param": c',
+                }
+            },
+
             # Config params specifics to "type": "image"
             {
                 'name': '"additional_type_parameters" parameter must be a dict if provided with "type": "image"',
@@ -425,6 +1533,20 @@ class ConfigTest(unittest.TestCase):
                     'msg': "Invalid value of parameter \"accepted_types\" for field \"param\": ['a', 1]",
                 }
             },
+            {
+                'name': '"max_size" param must be a positive integer with "type": "image"',
+                'config': {
+                    "param": {"type": "image", "additional_type_parameters": {
+                        "max_size": 0
+                    }}
+                },
+                'with_pk': True,
+                'exception_params': {
+                    'field': 'param',
+                    'param': 'max_size',
+                    'msg': "Invalid value of parameter \"max_size\" for field \"param\": 0",
+                }
+            },
 
             # Config params specifics to "type": "toggle"
             {
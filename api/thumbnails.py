@@ -0,0 +1,141 @@
+from concurrent.futures import ThreadPoolExecutor
+from io import BytesIO
+import logging
+import os
+from threading import Lock
+from typing import Callable, Dict, Optional
+
+from werkzeug.utils import secure_filename
+
+from storage import file_extension, get_storage
+
+try:
+    # Optional, the thumbnails are not generated nor exposed without it
+    from PIL import Image
+except ImportError:
+    Image = None
+
+logger = logging.getLogger(__name__)
+
+# Largest side of the thumbnails, in pixels
+THUMBNAIL_SIZES = (64, 256)
+# Extension added to the name of the source to get the WebP variant of a thumbnail
+WEBP_SUFFIX = '.webp'
+# Name of the key holding the URLs of the thumbnails in the contacts returned by the API
+THUMBNAILS_KEY = '_thumbnails'
+# Extensions of the images that can be resized, with the format used to save their thumbnails, the
+# one their name is served as
+RESIZABLE_FORMATS = {
+    'png': 'PNG',
+    'jpg': 'JPEG',
+    'jpeg': 'JPEG',
+    'gif': 'GIF',
+    'bmp': 'BMP',
+    'webp': 'WEBP',
+}
+# Modes of the images each format can save, the images in another mode are converted to the last one
+SAVED_MODES = {
+    'JPEG': ('L', 'RGB'),
+    'GIF': ('L', 'P', 'RGB', 'RGBA'),
+    'BMP': ('1', 'L', 'P', 'RGB'),
+}
+DEFAULT_SAVED_MODES = ('RGB', 'L', 'LA', 'RGBA')
+
+_executor: Optional[ThreadPoolExecutor] = None
+_EXECUTOR_LOCK = Lock()
+
+
+def thumbnails_enabled() -> bool:
+    return Image is not None
+
+def can_resize(name: str) -> bool:
+    return thumbnails_enabled() and file_extension(name) in RESIZABLE_FORMATS
+
+def thumbnail_name(size: int, name: str) -> str:
+    return f'thumbnails/{size}/{name}'
+
+def thumbnail_variants(name: str) -> Dict[str, str]:
+    """Return the thumbnails of the uploaded file `name`, as a mapping of their key in the API (the
+    size, followed by '.webp' for the WebP variant) to their name in the storage.
+    """
+    if not can_resize(name):
+        return {}
+    variants = {}
+    for size in THUMBNAIL_SIZES:
+        variants[str(size)] = thumbnail_name(size, name)
+        variants[f'{size}{WEBP_SUFFIX}'] = thumbnail_name(size, name + WEBP_SUFFIX)
+    return variants
+
+def thumbnail_urls(name: str, file_url: Callable[[str], str]) -> Optional[Dict[str, str]]:
+    variants = thumbnail_variants(name)
+    return {key: file_url(path) for key, path in variants.items()} if variants else None
+
+def thumbnail_source(size: int, name: str) -> Optional[str]:
+    """Return the name of the uploaded file the thumbnail `name` of `size` is made from, or None if
+    there can't be such a thumbnail.
+    """
+    if size not in THUMBNAIL_SIZES or secure_filename(name) != name:
+        return None
+    source = name[:-len(WEBP_SUFFIX)] if name.endswith(WEBP_SUFFIX) else name
+    return source if can_resize(source) else None
+
+
+def generate_thumbnail(size: int, name: str) -> Optional[str]:
+    """Return the name in the storage of the thumbnail `name` of `size`, generating it from its
+    source if it is not in the cache yet. Return None if it can't be generated.
+    """
+    source = thumbnail_source(size, name)
+    if source is None:
+        return None
+    storage = get_storage()
+    variant = thumbnail_name(size, name)
+    if storage.stat(variant) is not None:
+        return variant
+
+    image_format = 'WEBP' if name.endswith(WEBP_SUFFIX) else RESIZABLE_FORMATS[file_extension(source)]
+    output = BytesIO()
+    try:
+        with storage.open(source) as source_file, Image.open(source_file) as image:
+            image.thumbnail((size, size))
+            modes = SAVED_MODES.get(image_format, DEFAULT_SAVED_MODES)
+            if image.mode not in modes:
+                image = image.convert(modes[-1])
+            image.save(output, format=image_format)
+    except FileNotFoundError:
+        return None
+    except (OSError, ValueError, Image.DecompressionBombError) as exp:
+        logger.warning('Cannot generate the thumbnail %s of %s: %s', name, source, exp)
+        return None
+    storage.save(variant, output.getvalue())
+    return variant
+
+def _generate_thumbnails(name: str) -> None:
+    for size in THUMBNAIL_SIZES:
+        for variant in (name, name + WEBP_SUFFIX):
+            generate_thumbnail(size, variant)
+
+def schedule_thumbnails(name: str) -> None:
+    """Generate the thumbnails of the uploaded file `name` in the background. The ones not ready
+    yet when requested are generated on the fly.
+    """
+    global _executor
+    if not can_resize(name):
+        return
+    # Requests are handled by several threads, which must not each start their own pool
+    with _EXECUTOR_LOCK:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=int(os.environ.get('THUMBNAIL_WORKERS', 2)), thread_name_prefix='thumbnails'
+            )
+    _executor.submit(_generate_thumbnails, name)
+
+def remove_thumbnails(name: str) -> int:
+    """Remove the thumbnails of the uploaded file `name`, and return the size they used"""
+    if secure_filename(name) != name:
+        return 0
+    storage = get_storage()
+    removed = 0
+    for size in THUMBNAIL_SIZES:
+        for variant in (name, name + WEBP_SUFFIX):
+            removed += storage.remove(thumbnail_name(size, variant)) or 0
+    return removed
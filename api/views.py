@@ -1,7 +1,10 @@
 from datetime import datetime
+from functools import lru_cache
+from hashlib import sha1
 from json import (dumps, loads)
+import mimetypes
 import os
-from typing import Union
+from typing import Callable, List, Optional, Tuple
 
 from dotenv import load_dotenv
 from flask import (
@@ -9,33 +12,110 @@ from flask import (
     Blueprint,
     jsonify,
     request,
+    redirect,
     Response,
+    send_file,
     send_from_directory,
+    stream_with_context,
 )
-from werkzeug.utils import secure_filename
+from sqlalchemy.exc import IntegrityError
 
 # Load .env file in the env variables
 load_dotenv()
 
 api = Blueprint('api', __name__, url_prefix="")
 
+from bulk import (
+    export_contacts,
+    format_from_content_type,
+    FORMATS,
+    import_contacts,
+    InvalidRecordException,
+    read_records,
+)
+from cache import get_contact_cache
 from config import (
     Config,
-    FILE_FIELDS,
+    config_file_signature,
+    get_config,
+    IntegerFieldType,
+    invalidate_config,
     InvalidConfigException,
     MissingRequiredValueException,
     validate_config,
-    WrongTypeException,
+    value_error_body,
+    ValueException,
+)
+from migrations import (
+    dry_run_migration,
+    get_running_migration,
+    migration_status,
+    MigrationRunningException,
+    start_migration,
+    wake_up_migration_worker,
 )
 from models import (
+    bump_data_version,
+    ConfigMigration,
     Contact,
     db,
+    DeletedContact,
+    DuplicateValueException,
+    ensure_key_indexes,
+    get_data_version,
+    infos_to_json,
+    is_duplicate_key_error,
+    search_contacts,
+    sync_key_indexes,
+)
+from multipart import (
+    commit_uploads,
+    discard_uploads,
+    InvalidMultipartException,
+    stream_uploads,
+    UploadTooLargeException,
+)
+from queries import (
+    explain,
+    filter_conditions,
+    group_index,
+    InvalidQueryException,
+    page_query,
+    paginate,
+    parse_fields,
+    parse_filters,
+    parse_sort,
+    projected_infos,
+    projection_columns,
+)
+from storage import (
+    content_digest,
+    get_storage,
+    is_valid_name,
+)
+from thumbnails import (
+    generate_thumbnail,
+    schedule_thumbnails,
+    thumbnail_source,
+    thumbnail_urls,
+    THUMBNAILS_KEY,
+    WEBP_SUFFIX,
 )
 
+PAGINATION_PARAMETERS = ('limit', 'cursor', 'sort')
+DEFAULT_SEARCH_LIMIT = 20
+# Number of contacts that could not be migrated returned by default with the progress of a migration
+DEFAULT_FAILURES_LIMIT = 100
+# One year, the longest recommended
+IMMUTABLE_MAX_AGE = 365 * 24 * 60 * 60
+
 @api.route('/contact', methods=['GET', 'POST'])
 def contacts_get_post():
     if request.method == 'GET':
-        return jsonify([add_full_url_to_file_fields(contact.format_infos(), request.url_root) for contact in Contact.query.all()])
+        version, updated_at = get_data_version()
+        # Several changes can be made within the second of If-Modified-Since, only the version of
+        # the data tells them apart
+        return _conditional_response(str(version), updated_at, _contacts_get, check_date=False)
 
     if not request.json:
         abort(400, 'Missing data')
@@ -46,53 +126,258 @@ def contacts_get_post():
     # checks that the Content-Type header is set to application/json and that the request body is a
     # valid JSON. This way we are sure the data we insert in the DB is a valid JSON.
     new_contact = create_or_update_contact_instance_or_abort(None, request.json)
-    return jsonify(add_full_url_to_file_fields(new_contact.format_infos(), request.url_root))
+    return _contact_response(new_contact)
+
+def _contacts_get() -> Response:
+    config = _get_config()
+    plan = None
+    try:
+        filters = parse_filters(request.args.items(multi=True), config)
+        fields = parse_fields(request.args.get('fields'), config)
+        query = Contact.query.filter(*filter_conditions(filters))
+        if fields is not None:
+            query = query.with_entities(*projection_columns(fields))
+        paginated = any(param in request.args for param in PAGINATION_PARAMETERS)
+        if paginated:
+            sort = parse_sort(request.args.get('sort'), config)
+            limit = _parse_limit(request.args.get('limit'))
+            query = page_query(query, sort, limit, request.args.get('cursor'))
+        else:
+            query = query.order_by(Contact.id)
+        if filters and request.args.get('explain', '').lower() in ('1', 'true'):
+            # Tell how the filters are run, to see which ones need an index, only when asked as it
+            # costs another round trip to the DB
+            plan = explain(query)
+        contacts, next_cursor = paginate(query, sort, limit) if paginated else (query.all(), None)
+    except InvalidQueryException as exp:
+        abort(_build_response_query_error(exp))
+    response = _contacts_response(contacts, config, fields)
+    if next_cursor:
+        response.headers['X-Next-Cursor'] = next_cursor
+    if plan:
+        response.headers['X-Query-Plan'] = plan.encode('ascii', 'backslashreplace').decode()
+    return response
+
+@api.route('/contact/groups')
+def contacts_groups_get():
+    try:
+        sort = parse_sort(request.args.get('sort'), _get_config())
+    except InvalidQueryException as exp:
+        abort(_build_response_query_error(exp))
+    return jsonify(group_index(sort))
+
+@api.route('/contact/bulk', methods=['POST'])
+def contacts_bulk_post():
+    format_ = format_from_content_type(request.content_type or '')
+    if not format_:
+        abort(415, 'Body must be a JSON array, NDJSON or CSV')
+
+    config = _get_config()
+    try:
+        report = import_contacts(
+            read_records(request.stream, format_, config),
+            config,
+            # Only validate the records, without inserting them
+            validate_only=request.args.get('validate_only', '').lower() in ('1', 'true'),
+        )
+    except InvalidRecordException as exp:
+        abort(400, exp.message)
+    return jsonify(report)
+
+@api.route('/contact/changes')
+def contacts_changes_get():
+    since = request.args.get('since', '0')
+    if not since.isdigit():
+        abort(_build_response_query_error(InvalidQueryException('since', f'Invalid version "{since}"')))
+    since = int(since)
+
+    # Read the version first, the changes made after are sent on the next call
+    version, _ = get_data_version()
+    config = get_config()
+    contacts = Contact.query.filter(
+        Contact.updated_version > since,
+        Contact.updated_version <= version,
+    ).order_by(Contact.updated_version, Contact.id)
+    deleted = db.session.query(DeletedContact.id).filter(
+        DeletedContact.deleted_version > since,
+        DeletedContact.deleted_version <= version,
+    ).order_by(DeletedContact.deleted_version)
+    body = ','.join(_contact_json(contact, config) for contact in contacts)
+    return Response(
+        f'{{"version": {version}, "contacts": [{body}], "deleted": {dumps([id_contact for (id_contact,) in deleted])}}}',
+        mimetype='application/json',
+    )
+
+@api.route('/contact/export')
+def contacts_export_get():
+    format_ = request.args.get('format', 'ndjson')
+    if format_ not in FORMATS:
+        abort(_build_response_query_error(InvalidQueryException('format', f'Invalid format "{format_}"')))
+    content_type, extension = FORMATS[format_]
+    return Response(
+        stream_with_context(export_contacts(format_, get_config())),
+        content_type=content_type,
+        headers={'Content-Disposition': f'attachment; filename=contacts{extension}'},
+    )
+
+@api.route('/contact/search')
+def contacts_search_get():
+    try:
+        limit = _parse_limit(request.args.get('limit')) or DEFAULT_SEARCH_LIMIT
+    except InvalidQueryException as exp:
+        abort(_build_response_query_error(exp))
+    config = get_config()
+    return _contacts_response(search_contacts(request.args.get('q', ''), limit), config)
+
+@api.route('/contact/by-key/<value>')
+def contact_by_key_get(value: str):
+    config = _get_config()
+    if not config.primary_key:
+        abort(404)
+    if isinstance(config.fields_by_name[config.primary_key].field_type, IntegerFieldType):
+        try:
+            value = int(value)
+        except ValueError:
+            abort(404)
+    try:
+        fields = parse_fields(request.args.get('fields'), config)
+    except InvalidQueryException as exp:
+        abort(_build_response_query_error(exp))
+    query = Contact.query.filter(Contact.info_field(config.primary_key) == value)
+    if fields is not None:
+        row = query.with_entities(*projection_columns(fields)).first()
+        if row is None:
+            abort(404)
+        return Response(_projected_json(row, fields, config), mimetype='application/json')
+    return _contact_response(query.first_or_404(), config)
+
+@api.route('/contact/cache')
+def contact_cache_get():
+    # Counters of this process only, each worker has its own cache
+    return jsonify(get_contact_cache().stats())
+
+@api.route('/contact/<int:id_contact>', methods=['GET', 'DELETE', 'PUT'])
+def contacts_get_delete_put(id_contact: int):
+    if request.method == 'GET':
+        return _contact_get(id_contact)
 
-@api.route('/contact/<int:id_contact>', methods=['DELETE', 'PUT'])
-def contacts_delete_put(id_contact: int):
     contact = Contact.query.get_or_404(id_contact)
 
     if request.method == 'DELETE':
         db.session.delete(contact)
         db.session.commit()
+        get_contact_cache().invalidate(id_contact)
         return ('', 200)
 
     if not request.json:
         abort(400, 'Missing data')
 
     contact = create_or_update_contact_instance_or_abort(contact, request.json)
-    return jsonify(add_full_url_to_file_fields(contact.format_infos(), request.url_root))
+    get_contact_cache().invalidate(id_contact)
+    return _contact_response(contact)
+
+def _contact_get(id_contact: int) -> Response:
+    config = get_config()
+    try:
+        fields = parse_fields(request.args.get('fields'), config)
+    except InvalidQueryException as exp:
+        abort(_build_response_query_error(exp))
+
+    # Only the version is read to answer a client that has the contact already, or to find its body
+    # in the cache, by the primary key
+    row = db.session.query(Contact.updated_version, Contact.updated_at).filter(Contact.id == id_contact).first()
+    if row is None:
+        abort(404)
+    version, updated_at = row
+    # The body depends on the config, and on the URL the app is reached at for the file fields
+    variant = (config, fields, request.url_root)
+    # The contact is also displayed differently once the config changed
+    config_changed_at = datetime.utcfromtimestamp(
+        config_file_signature(os.environ.get('CONFIG_FILE', 'config.json'))[0] / 1e9
+    )
+    if _not_modified(_contact_etag(version, variant), max(updated_at or config_changed_at, config_changed_at)):
+        response = Response(status=304)
+    else:
+        cache = get_contact_cache()
+        body = cache.get(id_contact, variant, version)
+        if body is None:
+            # Read again with the version, the contact may have changed in the meantime
+            if fields is None:
+                contact = Contact.query.get_or_404(id_contact)
+                version, updated_at, body = contact.updated_version, contact.updated_at, _contact_json(contact, config)
+            else:
+                row = Contact.query.filter(Contact.id == id_contact).with_entities(
+                    Contact.updated_version, Contact.updated_at, *projection_columns(fields)
+                ).first_or_404()
+                version, updated_at, body = row[0], row[1], _projected_json(row[2:], fields, config)
+            cache.put(id_contact, variant, version, body)
+        response = Response(body, mimetype='application/json')
+    response.set_etag(_contact_etag(version, variant))
+    response.last_modified = max(updated_at or config_changed_at, config_changed_at)
+    return response
+
+@lru_cache(maxsize=64)
+def _contact_etag_suffix(variant: tuple) -> str:
+    config, fields, url_root = variant
+    return sha1(repr((dumps(dict(config.raw), sort_keys=True), fields, url_root)).encode()).hexdigest()[:8]
+
+def _contact_etag(version: int, variant: tuple) -> str:
+    """ETag of the `variant` of a contact at `version`, the same in every process"""
+    return f'{version}-{_contact_etag_suffix(variant)}'
 
 @api.route('/contact/<int:id_contact>/files', methods=['POST', 'PUT'])
 def contacts_file_post_put(id_contact: int):
     contact = Contact.query.get_or_404(id_contact)
 
-    if not request.files:
+    if request.mimetype != 'multipart/form-data':
+        abort(400)
+
+    config = get_config()
+    # Parse the body ourselves, so the files are written once, straight to the upload folder
+    try:
+        uploads = stream_uploads(request.stream, request.mimetype_params, request.content_length, config)
+    except InvalidMultipartException as exp:
+        abort(_build_response_multipart_error(exp))
+    except UploadTooLargeException as exp:
+        abort(_build_response_upload_size_error(exp))
+    if not uploads:
         abort(400)
 
-    config = Config(os.environ.get('CONFIG_FILE', 'config.json'))
-    file_fields = [field for field in config.fields if field.field_type in FILE_FIELDS]
-
-    new_infos = {}
-    for field in file_fields:
-        if field.required and not request.files.get(field.name):
-            abort(_build_response_config_error(MissingRequiredValueException(field.name)))
-        if request.files.get(field.name):
-            file = request.files.get(field.name)
-            if not file.filename:
-                abort(400, f'Missing filename for field {field.name}')
-            filename = secure_filename(file.filename)
-            file.save(os.path.join(os.environ.get('UPLOAD_FOLDER'), filename))
-            new_infos[field.name] = filename
+    missing = [
+        MissingRequiredValueException(field_name)
+        for field_name in config.file_fields
+        if config.fields_by_name[field_name].required and field_name not in uploads
+    ]
+    # Check the names the files will be stored under before storing them, so a rejected upload
+    # leaves nothing behind
+    new_infos = {field_name: upload.writer.name() for field_name, upload in uploads.items()}
+    errors = missing or config.validate(new_infos, fields_to_skip=['id'])
+    if errors:
+        discard_uploads(uploads)
+        abort(_build_response_config_error(errors))
+
+    commit_uploads(uploads)
+    for name in new_infos.values():
+        schedule_thumbnails(name)
 
     contact = create_or_update_contact_instance_or_abort(contact, new_infos)
-    return jsonify(add_full_url_to_file_fields(contact.format_infos(), request.url_root))
+    get_contact_cache().invalidate(id_contact)
+    response = _contact_response(contact)
+    response.headers['X-Upload-Stats'] = dumps({field_name: upload.stats() for field_name, upload in uploads.items()})
+    return response
 
 @api.route('/config', methods=['GET', 'PUT'])
 def config_get():
     if request.method == 'GET':
         filename = os.path.join('.', os.environ.get('CONFIG_FILE', 'config.json'))
-        return send_from_directory('.', filename) if os.path.isfile(filename) else jsonify()
+        if not os.path.isfile(filename):
+            return jsonify()
+        signature = config_file_signature(filename)
+        return _conditional_response(
+            sha1(repr(signature).encode()).hexdigest()[:16],
+            datetime.utcfromtimestamp(signature[0] / 1e9),
+            lambda: send_from_directory('.', filename),
+        )
 
     if not request.json:
         abort(400, 'Missing data')
@@ -100,59 +385,281 @@ def config_get():
     try:
         validate_config(request.json)
     except InvalidConfigException as ex:
-        response = jsonify({
-            "field": ex.field,
-            "param": ex.param,
-            "message": ex.message,
-        })
-        response.status = '400'
-        abort(response)
+        abort(_build_response_invalid_config_error(ex))
+
+    # The contacts must all be migrated to the current config before changing it again
+    running = get_running_migration()
+    if running is not None:
+        abort(_build_response_migration_running_error(MigrationRunningException(running.id)))
 
-    with open(os.environ.get('CONFIG_FILE', 'config.json'), 'w') as file:
-        file.write(dumps(request.json, indent=4))
+    # Update the key indexes before saving the new config, to refuse a primary key that would not
+    # be unique with the contacts already saved
+    old_config, new_config = get_config(), Config.from_dict(request.json)
+    try:
+        sync_key_indexes(new_config)
+    except DuplicateValueException as exp:
+        abort(_build_response_duplicate_error(exp))
+
+    # The migration of the contacts saved with the old config, run in the background along with
+    # their indexing for the search if the searchable fields changed, is saved before the new
+    # config, in the transaction holding the write lock, so that another change of the config can't
+    # start one at the same time
+    try:
+        with db.engine.begin() as connection:
+            # The contacts are displayed differently with the new config
+            bump_data_version(connection)
+            migration_id = start_migration(connection, dict(old_config.raw), request.json)
+            with open(os.environ.get('CONFIG_FILE', 'config.json'), 'w') as file:
+                file.write(dumps(request.json, indent=4))
+    except MigrationRunningException as exp:
+        abort(_build_response_migration_running_error(exp))
+    invalidate_config()
+
+    if migration_id is None:
+        return Response(status=200)
+    wake_up_migration_worker()
+    response = jsonify(migration_status(ConfigMigration.query.get(migration_id), 0))
+    response.status = '202'
+    return response
+
+@api.route('/config/dry-run', methods=['POST'])
+def config_dry_run_post():
+    """What changing the config would do to the saved contacts, without changing anything"""
+    if not request.json:
+        abort(400, 'Missing data')
+    try:
+        validate_config(request.json)
+    except InvalidConfigException as ex:
+        abort(_build_response_invalid_config_error(ex))
+    return jsonify(dry_run_migration(dict(get_config().raw), request.json))
 
-    return Response(status=200)
+@api.route('/config/migration')
+def config_migration_get():
+    """Progress of the last migration of the contacts to a new config"""
+    migration = ConfigMigration.query.order_by(ConfigMigration.id.desc()).first_or_404()
+    try:
+        limit = _parse_limit(request.args.get('limit')) or DEFAULT_FAILURES_LIMIT
+    except InvalidQueryException as exp:
+        abort(_build_response_query_error(exp))
+    return jsonify(migration_status(migration, limit))
 
 @api.route('/<filename>')
 def filename_get(filename: str):
-    return send_from_directory(os.environ.get('UPLOAD_FOLDER', 'uploads'), filename)
+    if not is_valid_name(filename):
+        abort(404)
+    return _send_upload(filename, content_digest(filename))
+
+@api.route('/thumbnails/<int:size>/<filename>')
+def thumbnail_get(size: int, filename: str):
+    # Thumbnails are cached in the storage, the missing ones are generated on the fly
+    name = generate_thumbnail(size, filename)
+    if not name:
+        abort(404)
+    digest = content_digest(thumbnail_source(size, filename))
+    return _send_upload(
+        name,
+        f'{digest}-{size}{WEBP_SUFFIX if filename.endswith(WEBP_SUFFIX) else ""}' if digest else None,
+    )
 
 def create_or_update_contact_instance_or_abort(instance: Contact, new_infos: dict) -> Contact:
     if not new_infos:
         return instance
 
-    config = Config(os.environ.get('CONFIG_FILE', 'config.json'))
-    try:
-        config.check(new_infos, fields_to_skip=['id'])
-    except (MissingRequiredValueException, WrongTypeException) as exp:
-        abort(_build_response_config_error(exp))
+    config = _get_config()
+    # The URLs of the thumbnails are computed when sending the contact, never store them
+    new_infos = {key: value for key, value in new_infos.items() if key != THUMBNAILS_KEY}
+    errors = config.validate(new_infos, fields_to_skip=['id'])
+    if errors:
+        abort(_build_response_config_error(errors))
 
     # In case the initial instance is None, this means we want to create a new instance
     is_add = bool(instance is None)
     instance = instance or Contact(infos= '{}', inserted_timestamp=datetime.now())
-    current_infos = loads(instance.infos)
-    instance.infos = dumps(dict(current_infos, **new_infos))
+    infos = dict(loads(instance.infos), **new_infos)
+    instance.infos = dumps(infos)
     if is_add:
         db.session.add(instance)
-    db.session.commit()
+    try:
+        db.session.commit()
+    except IntegrityError as exp:
+        db.session.rollback()
+        if not is_duplicate_key_error(exp):
+            raise
+        abort(_build_response_duplicate_error(
+            DuplicateValueException(config.primary_key, infos.get(config.primary_key))
+        ))
     db.session.refresh(instance)
     return instance
 
-def add_full_url_to_file_fields(infos: dict, base_url: str) -> dict:
-    config = Config(os.environ.get('CONFIG_FILE', 'config.json'))
-    file_fields = [field.name for field in config.fields if field.field_type in FILE_FIELDS]
-    for field in file_fields:
-        if infos.get(field):
-            infos[field] = os.path.join(base_url, infos[field])
-    return infos
+def _file_url(filename: str) -> str:
+    return os.path.join(request.url_root, filename)
+
+def _thumbnail_urls(filename: str) -> Optional[dict]:
+    return thumbnail_urls(filename, _file_url)
+
+def _contact_json(contact: Contact, config: Config) -> str:
+    return contact.format_infos_json(config.file_fields, _file_url, _thumbnail_urls, THUMBNAILS_KEY)
+
+def _projected_json(row: tuple, fields: Tuple[str, ...], config: Config) -> str:
+    # Only the URLs of the file fields returned are built
+    file_fields = [field for field in config.file_fields if field in fields]
+    infos = dumps(projected_infos(row, fields, config))
+    return infos_to_json(row[0], infos, file_fields, _file_url, _thumbnail_urls, THUMBNAILS_KEY)
+
+def _send_upload(name: str, digest: Optional[str]) -> Response:
+    """Send the file `name` of the storage. `digest` is the hash of its content if it can never
+    change, so it can be cached forever.
+    """
+    storage = get_storage()
+    url = storage.presigned_url(name)
+    if url:
+        # Let the client download it from the file store directly, while the URL is valid
+        response = redirect(url)
+        response.headers['Cache-Control'] = f'private, max-age={storage.url_expiration // 2}'
+        return response
 
-def _build_response_config_error(error: Union[MissingRequiredValueException, WrongTypeException]) -> Response:
-    body = {
+    path = storage.local_path(name)
+    if not os.path.isfile(path):
+        abort(404)
+    mode = os.environ.get('FILE_SENDING_MODE', '')
+    offloaded = mode in ('x-accel-redirect', 'x-sendfile')
+    if offloaded:
+        # Let the web server in front of the app send the file, without holding a worker
+        response = Response(mimetype=mimetypes.guess_type(name)[0] or 'application/octet-stream')
+        if mode == 'x-accel-redirect':
+            response.headers['X-Accel-Redirect'] = os.environ.get('X_ACCEL_REDIRECT_PREFIX', '/_uploads/') + name
+        else:
+            response.headers['X-Sendfile'] = os.path.abspath(path)
+    else:
+        response = send_file(os.path.abspath(path), conditional=False, add_etags=False)
+
+    if digest:
+        response.set_etag(digest)
+        response.headers['Cache-Control'] = f'public, max-age={IMMUTABLE_MAX_AGE}, immutable'
+    else:
+        stat = os.stat(path)
+        response.set_etag(f'{stat.st_mtime_ns}-{stat.st_size}')
+        response.headers['Cache-Control'] = 'no-cache'
+    if offloaded:
+        return response
+    return response.make_conditional(request, accept_ranges=True, complete_length=os.path.getsize(path))
+
+def _not_modified(etag: str, last_modified: datetime, check_date: bool=True) -> bool:
+    """Whether the client already has the version with the validators `etag` and `last_modified`,
+    the latter only checked if `check_date`
+    """
+    if request.if_none_match:
+        return request.if_none_match.contains(etag)
+    return bool(
+        check_date and
+        request.if_modified_since and
+        last_modified.replace(microsecond=0) <= request.if_modified_since
+    )
+
+def _conditional_response(
+    etag: str,
+    last_modified: datetime,
+    build_response: Callable[[], Response],
+    check_date: bool=True,
+) -> Response:
+    """Return the response built by `build_response`, with `etag` and `last_modified` as validators,
+    or a 304 without building it if the client already has this version. Without `check_date`,
+    If-Modified-Since is ignored, and only the ETag is checked.
+    """
+    response = Response(status=304) if _not_modified(etag, last_modified, check_date) else build_response()
+    response.set_etag(etag)
+    response.last_modified = last_modified
+    return response
+
+def _contact_response(contact: Contact, config: Optional[Config]=None) -> Response:
+    config = config or get_config()
+    return Response(_contact_json(contact, config), mimetype='application/json')
+
+def _contacts_response(contacts: list, config: Config, fields: Optional[Tuple[str, ...]]=None) -> Response:
+    """Response listing the `contacts`, or the rows of `projection_columns` when only some of the
+    `fields` are returned
+    """
+    # Build the list from the JSON of each contact, instead of decoding and encoding them again
+    if fields is None:
+        body = ','.join(_contact_json(contact, config) for contact in contacts)
+    else:
+        body = ','.join(_projected_json(row, fields, config) for row in contacts)
+    return Response(f'[{body}]', mimetype='application/json')
+
+def _get_config() -> Config:
+    # Make sure the key indexes of the config are there before using it to query the DB
+    config = get_config()
+    ensure_key_indexes(config)
+    return config
+
+def _parse_limit(limit: Optional[str]) -> Optional[int]:
+    if limit is None:
+        return None
+    try:
+        limit = int(limit)
+    except ValueError:
+        raise InvalidQueryException('limit', f'Invalid limit "{limit}"')
+    if limit <= 0:
+        raise InvalidQueryException('limit', f'Invalid limit "{limit}"')
+    return limit
+
+def _build_response_config_error(errors: List[ValueException]) -> Response:
+    # The first error is kept at the top level for the clients handling a single one
+    body = value_error_body(errors[0])
+    body["errors"] = [value_error_body(error) for error in errors]
+    response = jsonify(body)
+    response.status = '400'
+    return response
+
+def _build_response_query_error(error: InvalidQueryException) -> Response:
+    response = jsonify({
+        "param": error.param,
+        "code": error.code,
+        "message": error.message,
+    })
+    response.status = '400'
+    return response
+
+def _build_response_multipart_error(error: InvalidMultipartException) -> Response:
+    response = jsonify({
+        "code": error.code,
+        "message": error.message,
+    })
+    response.status = '400'
+    return response
+
+def _build_response_upload_size_error(error: UploadTooLargeException) -> Response:
+    response = jsonify({
         "field": error.field,
         "code": error.code,
-    }
-    if isinstance(error, WrongTypeException):
-        body["expected_type"] = error.expect_type
-    response = jsonify(body)
+        "limit": error.limit,
+    })
+    response.status = '413'
+    return response
+
+def _build_response_invalid_config_error(error: InvalidConfigException) -> Response:
+    response = jsonify({
+        "field": error.field,
+        "param": error.param,
+        "message": error.message,
+    })
     response.status = '400'
     return response
+
+def _build_response_migration_running_error(error: MigrationRunningException) -> Response:
+    response = jsonify({
+        "code": error.code,
+        "message": 'The contacts are still being migrated to the current config',
+        "migration_id": error.migration_id,
+    })
+    response.status = '409'
+    return response
+
+def _build_response_duplicate_error(error: DuplicateValueException) -> Response:
+    response = jsonify({
+        "field": error.field,
+        "code": error.code,
+        "value": error.value,
+    })
+    response.status = '409'
+    return response
@@ -8,7 +8,7 @@ content=$content"[supervisord]\n"
 content=$content"nodaemon=true\n"
 content=$content"\n"
 content=$content"[program:gunicorn]\n"
-content=$content"command=$(which gunicorn) --access-logfile /dev/stdout --error-logfile /dev/stderr --bind 0.0.0.0:${GUNICORN_PORT} main:create_app()\n"
+content=$content"command=$(which gunicorn) --access-logfile /dev/stdout --error-logfile /dev/stderr --bind 0.0.0.0:${GUNICORN_PORT} --workers ${GUNICORN_WORKERS} --threads ${GUNICORN_THREADS} main:create_app()\n"
 content=$content"directory=${API_DIR}\n"
 content=$content"stdout_logfile=${API_LOG_DIR}/${ACCESS_LOG_FILE}\n"
 content=$content"stdout_logfile_maxbytes=0\n"
@@ -168,23 +168,31 @@ class ContactForm extends Component<PropsType, StateType> {
                                     this.setState({hasErrorInSubmit: true});
                                     const error_body =
                                         await error.response.json();
-                                    let error_message: string;
-                                    switch (error_body.code) {
-                                        case "WRONG_TYPE":
-                                            error_message = `Wrong type of value. Expected ${error_body.expected_type}`;
-                                            break;
-                                        case "MISSING_VALUE_REQUIRED":
-                                            error_message =
-                                                "Missing required value";
-                                            break;
-                                        default:
-                                            error_message = "";
-                                            break;
+                                    // All the invalid fields are reported at once
+                                    for (const field_error of error_body.errors || [
+                                        error_body,
+                                    ]) {
+                                        let error_message: string;
+                                        switch (field_error.code) {
+                                            case "WRONG_TYPE":
+                                                error_message = `Wrong type of value. Expected ${field_error.expected_type}`;
+                                                break;
+                                            case "MISSING_VALUE_REQUIRED":
+                                                error_message =
+                                                    "Missing required value";
+                                                break;
+                                            case "INVALID_VALUE":
+                                                error_message = "Invalid value";
+                                                break;
+                                            default:
+                                                error_message = "";
+                                                break;
+                                        }
+                                        setFieldError(
+                                            field_error.field,
+                                            error_message
+                                        );
                                     }
-                                    setFieldError(
-                                        error_body.field,
-                                        error_message
-                                    );
                                 });
                         }
                     }}